@@ -0,0 +1,146 @@
+"""
+Benchmarks of the admin pages, the views and the review queries on generated data. The number of queries and the
+best wall time of every benchmark are compared with the baselines committed in benchmark_baselines.json: more queries
+than the baseline, or a time exceeding it by more than the tolerance and the slack, fail the benchmark.
+
+Run with WAREHOUSE_BENCHMARK_RECORD=1 to write the measured values as the new baselines.
+"""
+import json
+import os
+import time
+
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from warehouse.generator import generate
+from warehouse.models import MonthlyProductSummary, Product, ProductsProcessing, Warehouse
+
+from .test_views import StaffTestCase
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+
+RECORD = bool(os.environ.get('WAREHOUSE_BENCHMARK_RECORD'))
+
+# Timings of shared CI machines vary a lot, so only gross slowdowns fail
+TIME_TOLERANCE = float(os.environ.get('WAREHOUSE_BENCHMARK_TIME_TOLERANCE', 5))
+TIME_SLACK = 0.05
+
+REPEAT = 3
+
+
+def _load_baselines():
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+
+    with open(BASELINES_PATH) as baselines:
+        return json.load(baselines)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Baselines are recorded on SQLite")
+class BenchmarkTestCase(StaffTestCase):
+    baselines = _load_baselines()
+    measured = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super(BenchmarkTestCase, cls).tearDownClass()
+
+        if RECORD and cls.measured:
+            baselines = dict(_load_baselines(), **cls.measured)
+
+            with open(BASELINES_PATH, 'w') as output:
+                json.dump(baselines, output, indent=4, separators=(',', ': '), sort_keys=True)
+                output.write("\n")
+
+    def setUp(self):
+        super(BenchmarkTestCase, self).setUp()
+        cache.clear()
+
+        self.processings = generate(units=3, products=60, warehouses=4, processings=40, nodes=5, closed=0.5)
+
+    def measure(self, name, function, repeat=REPEAT):
+        """
+        Runs the function the given number of times and checks the query count of the first run and the best time
+        against the baseline of the benchmark
+        """
+        timings = []
+
+        for run in range(repeat):
+            with CaptureQueriesContext(connection) as context:
+                started = time.time()
+                function()
+                timings.append(time.time() - started)
+
+            if run == 0:
+                queries = len(context.captured_queries)
+
+        result = {'queries': queries, 'time': round(min(timings), 4)}
+        self.measured[name] = result
+
+        if RECORD:
+            return result
+
+        baseline = self.baselines.get(name)
+
+        self.assertIsNotNone(baseline, "{} has no baseline, record it with WAREHOUSE_BENCHMARK_RECORD=1".format(name))
+        self.assertLessEqual(queries, baseline['queries'], "{} executed {} queries, the baseline is {}".format(
+            name, queries, baseline['queries']))
+        self.assertLessEqual(result['time'], baseline['time'] * TIME_TOLERANCE + TIME_SLACK,
+                             "{} took {} s, the baseline is {} s"
+                             .format(name, result['time'], baseline['time']))
+
+        return result
+
+    def get(self, url_name, *args, **params):
+        def request():
+            response = self.client.get(reverse(url_name, args=args), params)
+            self.assertEqual(200, response.status_code)
+
+        return request
+
+    def test_product_changelist(self):
+        self.measure('product_changelist', self.get('admin:warehouse_product_changelist'))
+
+    def test_warehouse_changelist(self):
+        self.measure('warehouse_changelist', self.get('admin:warehouse_warehouse_changelist'))
+
+    def test_processing_changelist(self):
+        self.measure('processing_changelist', self.get('admin:warehouse_productsprocessing_changelist'))
+
+    def test_processing_close(self):
+        processing = ProductsProcessing.objects.filter(closed=False, type=ProductsProcessing.PROCESSING_RELEASE)[0]
+
+        def close():
+            response = self.client.get(reverse('warehouse_productsprocessing_close', args=[processing.pk]))
+            self.assertEqual(302, response.status_code)
+
+        self.measure('processing_close', close, repeat=1)
+        self.assertTrue(ProductsProcessing.objects.get(pk=processing.pk).closed)
+
+    def test_product_details(self):
+        self.measure('product_details', self.get('warehouse_product_details', Product.objects.all()[0].pk))
+
+    def test_products_details(self):
+        ids = ",".join(str(pk) for pk in Product.objects.values_list('pk', flat=True)[:20])
+
+        self.measure('products_details', self.get('warehouse_products_details', ids=ids))
+
+    def test_monthly_review(self):
+        self.measure('monthly_review', self.get('warehouse_productsprocessing_review'))
+
+    def test_review_queries(self):
+        year, month = MonthlyProductSummary.objects.values_list('year', 'month')[0]
+
+        def review():
+            for products in ProductsProcessing.objects.review_for_month(year, month).values():
+                list(products)
+
+        self.measure('review_queries', review)
+
+    def test_warehouse_stock_value(self):
+        self.measure('warehouse_stock_value',
+                     lambda: [warehouse.stock_value() for warehouse in Warehouse.objects.with_stock_totals()])
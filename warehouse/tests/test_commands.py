@@ -0,0 +1,410 @@
+import datetime
+import os
+import shutil
+import tempfile
+import zipfile
+
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.encoding import force_str
+from django.utils.six import StringIO
+from reversion.models import Revision, Version
+
+import reversion
+
+from warehouse.models import ArchivedProcessing, ArchivedProcessingNode, AuditEntry, ClosingJob, \
+    MonthlyProductSummary, ProcessingSearchToken, Product, ProductsProcessing, ProductProcessingNode, StockMovement, \
+    Unit, Warehouse
+
+from warehouse.closing import close_processings, close_processings_batch
+from warehouse.importing import ProcessingsImport
+from warehouse.jobs import enqueue_close
+from warehouse.reviews import review_name, review_storage
+from warehouse.valuation import valuation_report
+
+from .test_models import create_product_processing
+
+
+class RebuildReservationsTestCase(TestCase):
+    def test_drifted_reservations_are_reported_and_fixed(self):
+        """
+        Tests whether the rebuild command reports products with a drifted reserved quantity and recomputes it
+        """
+        product, _ = create_product_processing(0, 10, ProductsProcessing.PROCESSING_RELEASE)
+        Product.objects.filter(pk=product.pk).update(name=u"M\u0105ka", reserved_quantity=3)
+
+        output = StringIO()
+        call_command('rebuild_reservations', stdout=output)
+
+        self.assertIn(force_str(u"M\u0105ka (#{}): stored 3, actual 10.000".format(product.pk)), output.getvalue())
+        self.assertIn("1 product(s) drifted, fixed", output.getvalue())
+        self.assertEqual(10, Product.objects.get(pk=product.pk).reserved_quantity)
+
+
+class InventoryValuationTestCase(TestCase):
+    def test_stock_is_valued_per_product(self):
+        """
+        Tests whether the command lists the stock value of products with non-ASCII names
+        """
+        product, _ = create_product_processing(2, 3, ProductsProcessing.PROCESSING_RELEASE)
+        Product.objects.filter(pk=product.pk).update(name=u"M\u0105ka")
+
+        output = StringIO()
+        call_command('inventory_valuation', stdout=output)
+
+        self.assertIn(force_str(u"  M\u0105ka: 24.00 PLN"), output.getvalue())
+
+
+class SeedWarehouseStockTestCase(TestCase):
+    def test_quantities_are_placed_in_the_linked_warehouses(self):
+        """
+        Tests whether products linked to a single warehouse are stored in it, the others only in the given warehouse,
+        and whether the seeded stock limits the releases of the warehouses
+        """
+        main, other = Warehouse.objects.create(name="Main"), Warehouse.objects.create(name="Other")
+        single, release = create_product_processing(100, 10, ProductsProcessing.PROCESSING_RELEASE)
+        single.warehouses.add(main)
+        shared = Product.objects.create(name="Shared", unit=single.unit, quantity=7)
+        shared.warehouses.add(main, other)
+
+        output = StringIO()
+        call_command('seed_warehouse_stock', stdout=output)
+
+        self.assertIn("1 product(s) seeded, 1 skipped", output.getvalue())
+        self.assertEqual({main.pk: 100}, single.warehouse_quantities())
+        self.assertEqual({}, shared.warehouse_quantities())
+
+        call_command('seed_warehouse_stock', warehouse=other.pk, stdout=StringIO())
+        call_command('seed_warehouse_stock', warehouse=other.pk, stdout=StringIO())
+
+        self.assertEqual({main.pk: 100}, single.warehouse_quantities())
+        self.assertEqual({other.pk: 7}, shared.warehouse_quantities())
+
+        release.warehouse = other
+        release.save()
+
+        self.assertEqual([release], [processing for processing, _ in close_processings_batch([release.pk])[1]])
+
+
+class BackfillMonthlySummariesTestCase(TestCase):
+    def test_summaries_are_rebuilt_from_history(self):
+        """
+        Tests whether the backfill produces the same summaries as closing does
+        """
+        for processing_type in (ProductsProcessing.PROCESSING_ADMISSION, ProductsProcessing.PROCESSING_RELEASE):
+            _, pp = create_product_processing(10, 3, processing_type)
+            pp.close()
+            pp.save()
+
+        create_product_processing(10, 3, ProductsProcessing.PROCESSING_RELEASE)
+
+        summaries = list(MonthlyProductSummary.objects.order_by('type').values_list('type', 'product', 'quantity_change'))
+        MonthlyProductSummary.objects.update(quantity_change=0)
+
+        call_command('backfill_monthly_summaries', stdout=StringIO())
+
+        self.assertEqual(2, len(summaries))
+        self.assertEqual(summaries, list(MonthlyProductSummary.objects.order_by('type')
+                                         .values_list('type', 'product', 'quantity_change')))
+
+    def test_cached_reviews_are_cleared(self):
+        """
+        Tests whether the review periods cached before the backfill are read again from the rebuilt summaries
+        """
+        cache.clear()
+        _, pp = create_product_processing(10, 3, ProductsProcessing.PROCESSING_ADMISSION)
+        ProductsProcessing.objects.filter(pk=pp.pk).update(closed=True)
+
+        self.assertEqual([], ProductsProcessing.objects.reviews())
+
+        call_command('backfill_monthly_summaries', stdout=StringIO())
+
+        self.assertEqual([MonthlyProductSummary.period_of(pp.created)], ProductsProcessing.objects.reviews())
+
+
+class ExportReviewsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+
+    def test_reviews_of_the_year_are_archived(self):
+        """
+        Tests whether the reviews of every month of the year end up in the archive
+        """
+        with override_settings(WAREHOUSE_REVIEW_STORAGE_OPTIONS={'location': self.location}):
+            for created in ("2014-12-10 10:00Z", "2015-01-10 10:00Z", "2015-03-10 10:00Z"):
+                _, pp = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+                ProductsProcessing.objects.filter(pk=pp.pk).update(created=created)
+                ProductsProcessing.objects.get(pk=pp.pk).close()
+
+            for month in (1, 3):
+                review_storage().save(review_name(2015, month), ContentFile("%PDF {}".format(month).encode()))
+
+            path = os.path.join(self.location, "reviews.zip")
+            call_command('export_reviews', "2015", path, processes=1, stdout=StringIO())
+
+            with zipfile.ZipFile(path) as archive:
+                self.assertEqual(["review-2015-01.pdf", "review-2015-03.pdf"], sorted(archive.namelist()))
+                self.assertEqual(b"%PDF 3", archive.read("review-2015-03.pdf"))
+
+
+class VerifyStockLedgerTestCase(TestCase):
+    def test_mismatching_quantities_are_rebuilt(self):
+        """
+        Tests whether quantities changed outside of the ledger are reported and rebuilt from it
+        """
+        product, pp = create_product_processing(4, 10, ProductsProcessing.PROCESSING_ADMISSION)
+        pp.close()
+        Product.objects.filter(pk=product.pk).update(quantity=100)
+
+        output = StringIO()
+        call_command('verify_stock_ledger', rebuild=True, stdout=output)
+
+        self.assertIn("1 product(s) mismatched, rebuilt", output.getvalue())
+        self.assertEqual(14, Product.objects.get(pk=product.pk).quantity)
+
+    def test_ledgers_are_opened_before_the_recorded_movements(self):
+        """
+        Tests whether a ledger with movements but no opening is opened at the quantity less the recorded changes, and
+        whether products without an opening are left alone by the rebuild
+        """
+        product, pp = create_product_processing(4, 10, ProductsProcessing.PROCESSING_ADMISSION)
+        close_processings([pp.pk])
+        _, other = create_product_processing(7, 1, ProductsProcessing.PROCESSING_ADMISSION)
+        StockMovement.objects.filter(processing__isnull=True).delete()
+
+        output = StringIO()
+        call_command('verify_stock_ledger', rebuild=True, stdout=output)
+
+        self.assertIn("2 product(s) skipped", output.getvalue())
+        self.assertEqual(14, Product.objects.get(pk=product.pk).quantity)
+
+        call_command('open_stock_ledger', stdout=StringIO())
+        opening = StockMovement.objects.get(product=product, processing__isnull=True)
+        now = timezone.now()
+
+        self.assertEqual(4, opening.balance)
+        self.assertLess(opening.created, StockMovement.objects.get(processing=pp).created)
+        self.assertEqual(14, StockMovement.objects.quantity_at(product, now))
+        self.assertEqual({product.pk: 14, other.pk: 7}, StockMovement.objects.quantities_at(now))
+
+        output = StringIO()
+        call_command('verify_stock_ledger', stdout=output)
+
+        self.assertEqual("0 product(s) mismatched\n", output.getvalue())
+
+
+class ImportProcessingsTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.unit = Unit.objects.create(name="kilogram", slug="kg")
+        self.product = Product.objects.create(name="Flour", unit=self.unit, price="2.00")
+        Product.objects.create(name="Sugar", unit=self.unit, price="3.00")
+        Product.objects.create(name="Sugar", unit=Unit.objects.create(name="piece", slug="pc"), price="0.10")
+
+    def _import(self, content, **options):
+        path = os.path.join(self.directory, "import.csv")
+
+        with open(path, 'wb') as fileobj:
+            fileobj.write(content.encode('utf-8'))
+
+        errors = StringIO()
+        call_command('import_processings', path, stdout=StringIO(), stderr=errors, **options)
+
+        return errors.getvalue()
+
+    def test_processings_are_imported_in_batches(self):
+        """
+        Tests whether lines are grouped into processings and their products resolved by id or by name and unit
+        """
+        self._import(
+            "processing,name,type,product,unit,quantity_change,custom_price\n"
+            "WZ-1,Delivery,release,Sugar,pc,5,\n"
+            "WZ-1,Delivery,release,{},,2.5,1.99\n"
+            "PZ-1,Supply,AN,Sugar,kg,10,\n".format(self.product.pk),
+            batch_size=2
+        )
+
+        release = ProductsProcessing.objects.get(name="Delivery")
+
+        self.assertEqual(ProductsProcessing.PROCESSING_RELEASE, release.type)
+        self.assertEqual(2, release.nodes.count())
+        self.assertEqual(Decimal("1.99"), release.nodes.get(product=self.product).custom_price)
+        self.assertEqual(2.5, Product.objects.get(pk=self.product.pk).reserved_quantity)
+        self.assertEqual("kg", ProductsProcessing.objects.get(name="Supply").nodes.get().product.unit.slug)
+
+    def test_all_errors_are_reported_and_nothing_is_imported(self):
+        """
+        Tests whether every invalid line is reported at once and no processing is created
+        """
+        content = (
+            "processing,type,product,unit,quantity_change\n"
+            "WZ-1,release,Sugar,,5\n"
+            "WZ-1,release,Flour,,x\n"
+            "WZ-2,bogus,Flour,,1\n"
+            "WZ-3,admission,Flour,,1\n"
+            "WZ-3,admission,{},,1\n".format(self.product.pk)
+        )
+
+        with self.assertRaises(CommandError):
+            self._import(content)
+
+        self.assertEqual(0, ProductsProcessing.objects.count())
+        self.assertEqual(0, ProductProcessingNode.objects.count())
+
+    def test_invalid_rows_are_reported(self):
+        """
+        Tests whether the errors point to the invalid rows
+        """
+        result = ProcessingsImport().run([
+            {'processing': "WZ-1", 'type': "release", 'product': "Sugar", 'quantity_change': "5"},
+            {'processing': "WZ-1", 'type': "release", 'product': "Flour", 'quantity_change': "x"},
+            {'processing': "WZ-2", 'type': "bogus", 'product': "Flour", 'quantity_change': "1"},
+            {'processing': "WZ-3", 'type': "admission", 'product': "Flour", 'quantity_change': "1"},
+            {'processing': "WZ-3", 'type': "admission", 'product': str(self.product.pk), 'quantity_change': "1"},
+        ])
+
+        self.assertEqual([1, 2, 3, 5], [number for number, _ in result.errors])
+
+    def test_non_ascii_references_are_reported(self):
+        """
+        Tests whether errors about processings and products with non-ASCII names are reported
+        """
+        with self.assertRaises(CommandError):
+            self._import(u"processing,type,product,quantity_change\nWZ-\u0105,release,M\u0105ka,1\n")
+
+        result = ProcessingsImport().run([{'processing': u"WZ-\u0105", 'type': "release", 'product': u"M\u0105ka",
+                                           'unit': u"szt\u0119", 'quantity_change': "1"}])
+
+        self.assertEqual([(1, u"Product 'M\u0105ka' in unit 'szt\u0119' does not exist")], result.errors)
+
+
+class StressCloseProcessingsTestCase(TestCase):
+    def test_quantities_match_after_closing(self):
+        """
+        Tests whether the stress run closes overlapping processings with consistent quantities and cleans up
+        """
+        output = StringIO()
+        call_command('stress_close_processings', processings=20, products=3, processes=1, stdout=output,
+                     stderr=StringIO())
+
+        self.assertIn("All quantities match the closed processings", output.getvalue())
+        self.assertEqual(0, ProductsProcessing.objects.count())
+        self.assertEqual(0, Product.objects.count())
+
+
+class CompactReversionHistoryTestCase(TestCase):
+    def setUp(self):
+        reversion.register(ProductsProcessing)
+        self.addCleanup(reversion.unregister, ProductsProcessing)
+
+    def test_versions_are_converted_to_deltas(self):
+        """
+        Tests whether full snapshots are converted into entries of the changed fields and deleted on request
+        """
+        with reversion.create_revision():
+            processing = ProductsProcessing.objects.create(name="test", type=ProductsProcessing.PROCESSING_RELEASE)
+
+        for description in ("first", "first", "second"):
+            with reversion.create_revision():
+                processing.description = description
+                processing.save()
+                reversion.set_comment("Changed")
+
+        AuditEntry.objects.all().delete()
+        call_command('compact_reversion_history', delete=True, stdout=StringIO())
+
+        entries = AuditEntry.objects.filter(processing=processing).order_by('created', 'id')
+
+        self.assertEqual([AuditEntry.ACTION_CREATED, AuditEntry.ACTION_CHANGED, AuditEntry.ACTION_CHANGED],
+                         [entry.action for entry in entries])
+        self.assertEqual([("description", "first", "second")], entries[2].changed_fields())
+        self.assertEqual("Changed", entries[2].comment)
+        self.assertFalse(Version.objects.exists())
+        self.assertFalse(Revision.objects.exists())
+
+
+class RebuildSearchIndexTestCase(TestCase):
+    def test_index_is_rebuilt_from_names(self):
+        """
+        Tests whether the rebuild recreates the tokens of every processing and drops the tokens of deleted ones
+        """
+        _, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+
+        ProcessingSearchToken.objects.all().delete()
+        ProcessingSearchToken.objects.create(processing_id=processing.pk + 1, token="stale")
+
+        call_command('rebuild_search_index', batch_size=1, stdout=StringIO())
+
+        self.assertEqual(["test", "test_product"],
+                         sorted(ProcessingSearchToken.objects.values_list('token', flat=True)))
+
+
+class ProcessClosingJobsTestCase(TransactionTestCase):
+    # The worker closes the connections between jobs, which cannot happen inside the transaction of a TestCase
+    def test_queued_jobs_are_run(self):
+        _, first = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        _, second = create_product_processing(10, 4, ProductsProcessing.PROCESSING_ADMISSION)
+        enqueue_close(first.pk)
+        enqueue_close(second.pk)
+
+        call_command('process_closing_jobs', once=True, stdout=StringIO())
+
+        self.assertEqual([ClosingJob.STATUS_DONE] * 2, list(ClosingJob.objects.values_list('status', flat=True)))
+        self.assertEqual(2, ProductsProcessing.objects.filter(closed=True).count())
+
+
+class ArchiveProcessingsTestCase(TestCase):
+    def setUp(self):
+        self.product, self.old = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        _, self.open = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        _, self.recent = create_product_processing(10, 4, ProductsProcessing.PROCESSING_ADMISSION)
+
+        ProductsProcessing.objects.filter(pk__in=[self.old.pk, self.open.pk]) \
+            .update(created=datetime.datetime(2014, 3, 10, tzinfo=timezone.utc))
+        close_processings([self.old.pk, self.recent.pk])
+
+    def test_closed_processings_before_the_cutoff_are_archived(self):
+        """
+        Tests whether only closed processings of the months before the cutoff are moved, keeping their keys, totals,
+        summaries and audit entries
+        """
+        node_id = self.old.nodes.get().pk
+        summaries = list(MonthlyProductSummary.objects.order_by('pk').values_list('year', 'month', 'quantity_change'))
+
+        call_command('archive_processings', before="2014-04", batch_size=1, stdout=StringIO())
+
+        archived = ArchivedProcessing.objects.get(pk=self.old.pk)
+
+        self.assertEqual([self.open.pk, self.recent.pk],
+                         list(ProductsProcessing.objects.order_by('pk').values_list('pk', flat=True)))
+        self.assertEqual([node_id], list(archived.nodes.values_list('pk', flat=True)))
+        self.assertEqual(Decimal("48.00"), archived.closed_total_cost)
+        self.assertEqual(summaries, list(MonthlyProductSummary.objects.order_by('pk')
+                                         .values_list('year', 'month', 'quantity_change')))
+        self.assertTrue(AuditEntry.objects.filter(processing=self.old.pk).exists())
+        self.assertEqual(Decimal("96.00"), valuation_report(2014, 3)['processings_total'])
+        self.assertEqual(2, len(valuation_report(2014, 3)['processings']))
+
+        call_command('backfill_monthly_summaries', stdout=StringIO())
+
+        self.assertEqual(summaries, list(MonthlyProductSummary.objects.order_by('year', 'month')
+                                         .values_list('year', 'month', 'quantity_change')))
+
+    def test_dry_run_only_counts(self):
+        output = StringIO()
+        call_command('archive_processings', before="2014-04", dry_run=True, stdout=output)
+
+        self.assertIn("1 processing(s) with 1 node(s)", output.getvalue())
+        self.assertFalse(ArchivedProcessing.objects.exists())
+        self.assertFalse(ArchivedProcessingNode.objects.exists())
@@ -1,5 +1,24 @@
-from warehouse.models import ProductProcessingNode, Product, Unit, Warehouse, Currency, ProductsProcessing
-from django.test import TestCase
+from warehouse.models import ProductProcessingNode, Product, Unit, Warehouse, ProductsProcessing, MonthlyProductSummary, \
+    AuditEntry, ClosingJob, ProcessingSearchToken, StockMovement, StockSnapshot, UNIT_CACHE_VERSION_KEY
+from warehouse import reviews
+from warehouse.audit import audit_context
+from warehouse.closing import ClosingError, ProcessingsClosing, close_processings, close_processings_batch
+from warehouse.jobs import Heartbeat, claim_job, enqueue_close, recover_stale_jobs, run_job
+from warehouse.reviews import get_review, review_name, review_storage
+from warehouse.search import deferred_indexing, search_processings, tokenize
+from warehouse.valuation import to_cents, value_processings, value_stock
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import override_settings
+from django.utils import timezone
 from decimal import *
 
 
@@ -12,10 +31,7 @@ def create_product_processing(product_quantity, quantity_change, processing_type
     u = Unit(name="test_unit", slug="tu")
     u.save()
 
-    c = Currency(name="Euro", slug="EUR")
-    c.save()
-
-    p = Product(name="Test_product", quantity=product_quantity, price="12.00", unit=u, currency=c)
+    p = Product(name="Test_product", quantity=product_quantity, price="12.00", unit=u)
     p.save()
 
     pp = ProductsProcessing(name="test", description="test", type=processing_type)
@@ -39,6 +55,86 @@ class ProductTestCase(TestCase):
 
         self.assertEqual(25, product.reservation())
 
+    def test_reserved_quantity_is_maintained(self):
+        """
+        Tests whether the stored reserved quantity follows the nodes of open releases
+        """
+        product, products_processing = create_product_processing(20, 10, ProductsProcessing.PROCESSING_RELEASE)
+        _, admission = create_product_processing(0, 10, ProductsProcessing.PROCESSING_ADMISSION)
+
+        create_product_processing_node(product, admission, 5)
+        self.assertEqual(10, Product.objects.get(pk=product.pk).reserved_quantity)
+
+        node = products_processing.nodes.get()
+        node.quantity_change = 4
+        node.save()
+        self.assertEqual(4, Product.objects.get(pk=product.pk).reserved_quantity)
+
+        products_processing.close()
+        self.assertEqual(0, Product.objects.get(pk=product.pk).reserved_quantity)
+        products_processing.save()
+
+        _, release = create_product_processing(0, 10, ProductsProcessing.PROCESSING_RELEASE)
+        create_product_processing_node(product, release, 3)
+        self.assertEqual(3, Product.objects.get(pk=product.pk).reserved_quantity)
+
+        release.nodes.filter(product=product).get().delete()
+        self.assertEqual(0, Product.objects.get(pk=product.pk).reserved_quantity)
+
+
+@override_settings(WAREHOUSE_UNIT_CACHE='default')
+class UnitCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.unit = Unit.objects.create(name="test_unit", slug="tu")
+        self.products = [Product.objects.create(name="Product {}".format(i), unit=self.unit, quantity=2,
+                                                 reserved_quantity=1) for i in range(3)]
+
+    def test_units_are_resolved_from_memory(self):
+        """
+        Tests whether the units of products are loaded once and resolved without queries afterwards
+        """
+        products = list(Product.objects.all())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(["2 tu"] * 3, [product.amount() for product in products])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(["1 tu"] * 3, [product.reservation_amount() for product in Product.objects.all()])
+
+    def test_changed_units_are_reloaded(self):
+        """
+        Tests whether changes of units are seen by this process at once and by other processes at their next request
+        """
+        self.assertEqual("tu", self.products[0].unit.slug)
+
+        self.unit.slug = "kg"
+        self.unit.save()
+
+        self.assertEqual("kg", Product.objects.get(pk=self.products[0].pk).unit.slug)
+
+        Unit.objects.filter(pk=self.unit.pk).update(slug="g")
+        cache.set(UNIT_CACHE_VERSION_KEY, "changed by another process")
+        Unit.objects.synchronize()
+
+        self.assertEqual("g", Product.objects.get(pk=self.products[0].pk).unit.slug)
+
+    def test_changes_are_announced_after_the_commit(self):
+        """
+        Tests whether a change of units made in a transaction is announced to other processes once it is committed
+        """
+        cache.set(UNIT_CACHE_VERSION_KEY, "before the change")
+
+        with transaction.atomic():
+            self.unit.slug = "kg"
+            self.unit.save()
+
+            self.assertEqual("before the change", cache.get(UNIT_CACHE_VERSION_KEY))
+
+        self.assertEqual("kg", Product.objects.get(pk=self.products[0].pk).unit.slug)
+        self.assertNotEqual("before the change", cache.get(UNIT_CACHE_VERSION_KEY))
+
 
 class ProductProcessingOperationsTestCase(TestCase):
     def test_total_cost_always_returns_decimal_without_custom_price(self):
@@ -86,4 +182,644 @@ class ProductProcessingOperationsTestCase(TestCase):
         pp.close()
 
         self.assertTrue(0 == Product.objects.get(pk=p.id).quantity)
-        self.assertTrue(pp.closed)
\ No newline at end of file
+        self.assertTrue(pp.closed)
+
+
+class ProductsProcessingClosingTestCase(TestCase):
+    def _create_release(self, nodes_count, product_quantity=10, quantity_change=5):
+        u = Unit(name="test_unit", slug="tu")
+        u.save()
+
+        pp = ProductsProcessing(name="test", description="test", type=ProductsProcessing.PROCESSING_RELEASE)
+        pp.save()
+
+        for i in range(nodes_count):
+            p = Product(name="Test_product_{}".format(i), quantity=product_quantity, price="12.00", unit=u)
+            p.save()
+
+            create_product_processing_node(p, pp, quantity_change)
+
+        return pp
+
+    def test_closing_query_count_does_not_depend_on_nodes_count(self):
+        """
+        Tests whether validating and closing a processing takes the same number of queries for any number of nodes
+        """
+        for nodes_count in (1, 25):
+            pp = self._create_release(nodes_count)
+
+            with self.assertNumQueries(6):
+                self.assertTrue(pp.clean_for_processing())
+                pp.close()
+
+            self.assertEqual(nodes_count, Product.objects.filter(nodes__processing=pp, quantity=5).count())
+
+    def test_release_exceeding_quantity_is_not_clean(self):
+        """
+        Tests whether a release taking more than the available quantity of any product is rejected
+        """
+        pp = self._create_release(3)
+        node = pp.nodes.all()[0]
+        node.quantity_change = 11
+        node.save()
+
+        self.assertFalse(pp.clean_for_processing())
+
+    def test_closed_processing_cannot_be_closed_again(self):
+        """
+        Tests whether the locked close rejects a processing closed meanwhile and leaves the quantities untouched
+        """
+        pp = self._create_release(2)
+        close_processings([pp.pk])
+
+        with self.assertRaises(ClosingError):
+            close_processings([pp.pk])
+
+        self.assertTrue(ProductsProcessing.objects.get(pk=pp.pk).closed)
+        self.assertEqual(2, Product.objects.filter(nodes__processing=pp, quantity=5).count())
+
+    def test_releases_closed_together_are_validated_by_their_sum(self):
+        """
+        Tests whether releases of the same product, each fitting into its quantity, are rejected when their sum does not
+        """
+        product, first = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        second = ProductsProcessing.objects.create(name="test", type=ProductsProcessing.PROCESSING_RELEASE)
+        create_product_processing_node(product, second, 3)
+
+        with self.assertRaises(ClosingError):
+            close_processings([first.pk, second.pk])
+
+        self.assertEqual(5, Product.objects.get(pk=product.pk).quantity)
+        self.assertFalse(ProductsProcessing.objects.filter(closed=True).exists())
+
+
+class ProductsProcessingBatchClosingTestCase(TestCase):
+    def test_combined_releases_are_validated(self):
+        """
+        Tests whether releases of the same product are closed while their combined quantity fits into the stock
+        """
+        product, first = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        processings = [first]
+
+        for processing_type in (ProductsProcessing.PROCESSING_RELEASE, ProductsProcessing.PROCESSING_RELEASE,
+                                ProductsProcessing.PROCESSING_ADMISSION):
+            processing = ProductsProcessing.objects.create(name="test", type=processing_type)
+            create_product_processing_node(product, processing, 4)
+            processings.append(processing)
+
+        closed, rejected = close_processings_batch([processing.pk for processing in processings])
+
+        self.assertEqual([processings[0], processings[1], processings[3]], closed)
+        self.assertEqual([(processings[2], "Not enough quantity of Test_product")], rejected)
+        self.assertEqual(6, Product.objects.get(pk=product.pk).quantity)
+        self.assertEqual(4, Product.objects.get(pk=product.pk).reserved_quantity)
+        self.assertEqual([6, 2, 6], list(StockMovement.objects.filter(processing__isnull=False)
+                                         .order_by('processing').values_list('balance', flat=True)))
+
+    def test_closed_processings_are_rejected(self):
+        """
+        Tests whether already closed processings are reported and not applied again
+        """
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        close_processings([processing.pk])
+
+        closed, rejected = close_processings_batch([processing.pk])
+
+        self.assertEqual([], closed)
+        self.assertEqual("It has been already closed", rejected[0][1])
+        self.assertEqual(6, Product.objects.get(pk=product.pk).quantity)
+
+
+class ProductsProcessingConcurrentClosingTestCase(TransactionTestCase):
+    def test_close_is_repeated_after_a_deadlock(self):
+        """
+        Tests whether a close failing with a transient error is rolled back and repeated
+        """
+        product, pp = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        close = ProcessingsClosing.close
+        failures = []
+
+        def close_once_deadlocked(closing):
+            close(closing)
+
+            if not failures:
+                failures.append(True)
+                raise OperationalError(1213, "Deadlock found when trying to get lock; try restarting transaction")
+
+        ProcessingsClosing.close = close_once_deadlocked
+
+        try:
+            close_processings([pp.pk])
+        finally:
+            ProcessingsClosing.close = close
+
+        self.assertEqual(6, Product.objects.get(pk=product.pk).quantity)
+        self.assertEqual(1, StockMovement.objects.filter(processing=pp).count())
+
+    def test_reviews_are_invalidated_after_the_close_is_committed(self):
+        """
+        Tests whether the stored reviews are invalidated outside of the close transaction, so no review can be
+        rendered and stored from the data before the close
+        """
+        product, pp = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        invalidate_review = reviews.invalidate_review
+        invalidations = []
+
+        reviews.invalidate_review = lambda year, month: invalidations.append(
+            (year, month, connection.in_atomic_block, ProductsProcessing.objects.get(pk=pp.pk).closed))
+
+        try:
+            close_processings([pp.pk])
+        finally:
+            reviews.invalidate_review = invalidate_review
+
+        self.assertEqual([MonthlyProductSummary.period_of(pp.created) + (False, True)], invalidations)
+
+
+class ValuationTestCase(TestCase):
+    def test_totals_match_the_decimal_path(self):
+        """
+        Tests whether the integer valuation gives the totals formatted from Decimals, rounding ties to even cents
+        """
+        warehouse = Warehouse.objects.create(name="Main")
+        unit = Unit.objects.create(name="kilogram", slug="kg")
+        products = [Product.objects.create(name="Product {}".format(i), unit=unit, price=price)
+                    for i, price in enumerate(("1.00", "0.33", "12.49"))]
+
+        for quantities in (("0.005", "3", "1.5"), ("0.015", "2.125", "0.001"), ("7", "0.333", "0")):
+            processing = ProductsProcessing.objects.create(name="test", type=ProductsProcessing.PROCESSING_ADMISSION,
+                                                           warehouse=warehouse)
+
+            for product, quantity in zip(products, quantities):
+                create_product_processing_node(product, processing, quantity)
+
+        ProductProcessingNode.objects.filter(product=products[1], quantity_change="2.125").update(custom_price="0.25")
+
+        processings = ProductsProcessing.objects.all()
+        totals = value_processings(processings)
+
+        self.assertEqual(dict((processing.pk, Decimal(processing.total_cost())) for processing in processings),
+                         totals['processings'])
+        self.assertEqual(dict((node.pk, Decimal(node.total_cost_amount())) for node in
+                              ProductProcessingNode.objects.select_related('product')), totals['lines'])
+        self.assertEqual({warehouse.pk: sum(totals['processings'].values())}, totals['warehouses'])
+        self.assertEqual(Decimal("0.00"), to_cents(500))
+        self.assertEqual(Decimal("0.02"), to_cents(1500))
+
+    def test_stock_is_valued_per_warehouse(self):
+        """
+        Tests whether the stock values match the values computed by the database
+        """
+        warehouse = Warehouse.objects.create(name="Main")
+        product, processing = create_product_processing(0, "2.125", ProductsProcessing.PROCESSING_ADMISSION)
+        processing.warehouse = warehouse
+        processing.save()
+        processing.close()
+
+        stock = value_stock()
+
+        self.assertEqual({warehouse.pk: Decimal("25.50")}, stock['warehouses'])
+        self.assertEqual("25.50 PLN", Warehouse.objects.with_stock_totals().get().stock_value())
+        self.assertEqual(Decimal("25.50"), stock['total'])
+
+    def test_closed_processings_keep_their_frozen_totals(self):
+        """
+        Tests whether price changes after the close only revalue the lines and products of closed processings
+        """
+        warehouse = Warehouse.objects.create(name="Main")
+        product, closed = create_product_processing(0, "2.125", ProductsProcessing.PROCESSING_ADMISSION)
+        closed.warehouse = warehouse
+        closed.close()
+        closed.save()
+
+        pending = ProductsProcessing.objects.create(name="pending", type=ProductsProcessing.PROCESSING_ADMISSION,
+                                                    warehouse=warehouse)
+        create_product_processing_node(product, pending, 1)
+        Product.objects.filter(pk=product.pk).update(price="100.00")
+
+        totals = value_processings(ProductsProcessing.objects.all())
+
+        self.assertEqual({closed.pk: Decimal("25.50"), pending.pk: Decimal("100.00")}, totals['processings'])
+        self.assertEqual({warehouse.pk: Decimal("125.50")}, totals['warehouses'])
+        self.assertEqual(Decimal("125.50"), totals['total'])
+        self.assertEqual({product.pk: Decimal("312.50")}, totals['products'])
+
+
+class ClosingJobTestCase(TestCase):
+    def test_job_closes_the_processing(self):
+        """
+        Tests whether a queued close is claimed once, performed and reported as done
+        """
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        job = enqueue_close(processing.pk)
+
+        self.assertTrue(processing.is_closing())
+        self.assertRaises(ClosingError, enqueue_close, processing.pk)
+
+        claimed = claim_job()
+
+        self.assertEqual(job.pk, claimed.pk)
+        self.assertIsNone(claim_job())
+
+        run_job(claimed)
+        job = ClosingJob.objects.get(pk=job.pk)
+
+        self.assertEqual((ClosingJob.STATUS_DONE, 100), (job.status, job.progress))
+        self.assertEqual(6, Product.objects.get(pk=product.pk).quantity)
+        self.assertFalse(processing.is_closing())
+        self.assertRaises(ClosingError, enqueue_close, processing.pk)
+
+    def test_failed_job_reports_the_error(self):
+        product, processing = create_product_processing(2, 4, ProductsProcessing.PROCESSING_RELEASE)
+        enqueue_close(processing.pk)
+
+        job = run_job(claim_job())
+
+        self.assertEqual(ClosingJob.STATUS_FAILED, job.status)
+        self.assertEqual("Operation has been terminated due to the validation errors.", job.message)
+        self.assertEqual(2, Product.objects.get(pk=product.pk).quantity)
+        self.assertFalse(ProductsProcessing.objects.get(pk=processing.pk).closed)
+
+    def test_jobs_of_dead_workers_are_recovered(self):
+        """
+        Tests whether stale running jobs are queued again, or done if their processing has been closed
+        """
+        _, first = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        _, second = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        jobs = [enqueue_close(first.pk), enqueue_close(second.pk)]
+        claim_job(), claim_job()
+        close_processings([first.pk])
+
+        ClosingJob.objects.update(heartbeat=timezone.now() - datetime.timedelta(hours=2))
+
+        self.assertEqual(2, recover_stale_jobs(timeout=3600))
+        self.assertEqual([ClosingJob.STATUS_DONE, ClosingJob.STATUS_QUEUED],
+                         [ClosingJob.objects.get(pk=job.pk).status for job in jobs])
+
+    def test_long_running_jobs_with_a_heartbeat_are_not_recovered(self):
+        """
+        Tests whether a job started long ago is left running while its worker beats its heartbeat
+        """
+        _, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        job = enqueue_close(processing.pk)
+        claim_job()
+
+        ClosingJob.objects.update(started=timezone.now() - datetime.timedelta(hours=2))
+
+        self.assertEqual(0, recover_stale_jobs(timeout=3600))
+        self.assertEqual(ClosingJob.STATUS_RUNNING, ClosingJob.objects.get(pk=job.pk).status)
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ClosingJobHeartbeatTestCase(TransactionTestCase):
+    def test_heartbeat_is_stored_while_the_job_runs(self):
+        """
+        Tests whether the heartbeat thread stores the heartbeat of the job on its own connection
+        """
+        _, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        job = ClosingJob.objects.create(processing=processing, status=ClosingJob.STATUS_RUNNING,
+                                        heartbeat=timezone.now() - datetime.timedelta(hours=2))
+
+        heartbeat = Heartbeat(job.pk, interval=0.05)
+        heartbeat.start()
+        time.sleep(0.3)
+        heartbeat.stop()
+
+        self.assertEqual(0, recover_stale_jobs(timeout=60))
+
+
+class SearchIndexTestCase(TestCase):
+    def search(self, term):
+        return sorted(search_processings(ProductsProcessing.objects.all(), term).values_list('name', flat=True))
+
+    def test_words_are_normalized(self):
+        self.assertEqual({"maka", "zolta", "100g"}, tokenize(u"M\u0105ka  \u017c\u00f3\u0142ta, 100g"))
+
+    def test_index_follows_processings_nodes_and_products(self):
+        """
+        Tests whether processings are found by prefixes of their words and of their product names after every change
+        """
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        _, other = create_product_processing(10, 4, ProductsProcessing.PROCESSING_ADMISSION)
+        other.name = "Supply"
+        other.save()
+
+        self.assertEqual(["Supply", "test"], self.search("test_prod"))
+        self.assertEqual(["Supply"], self.search("SUP"))
+        self.assertEqual(["Supply"], self.search("sup test"))
+
+        product.name = u"M\u0105ka"
+        product.save()
+
+        self.assertEqual(["test"], self.search("maka"))
+        self.assertEqual(["Supply"], self.search("test_prod"))
+
+        processing.nodes.get().delete()
+
+        self.assertEqual([], self.search("maka"))
+
+        other.delete()
+
+        self.assertEqual(0, ProcessingSearchToken.objects.filter(processing=other.pk).count())
+
+    def test_nodes_of_a_block_are_indexed_once(self):
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        products = [Product.objects.create(name="Extra {}".format(i), unit=product.unit) for i in range(3)]
+
+        # Three queries per node and four to reindex the processing at the end
+        with self.assertNumQueries(13):
+            with deferred_indexing():
+                for extra in products:
+                    create_product_processing_node(extra, processing, 1)
+
+        self.assertEqual(["test"], self.search("extra"))
+
+
+class AuditTestCase(TestCase):
+    def test_only_changed_fields_are_recorded(self):
+        """
+        Tests whether a change of a node records only its changed fields and the quantity delta
+        """
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        node = ProductProcessingNode.objects.get(processing=processing)
+        node.quantity_change = Decimal("6.5")
+        node.save()
+
+        entry = AuditEntry.objects.filter(action=AuditEntry.ACTION_CHANGED, product=product).get()
+
+        self.assertEqual(processing.pk, entry.processing_id)
+        self.assertEqual(Decimal("2.5"), entry.quantity_change)
+        self.assertEqual([("quantity_change", 4, Decimal("6.5"))],
+                         [(field, Decimal(previous), Decimal(new)) for field, previous, new in entry.changed_fields()])
+
+        node.save()
+
+        self.assertEqual(1, AuditEntry.objects.filter(action=AuditEntry.ACTION_CHANGED, product=product).count())
+
+    def test_entries_of_a_context_are_written_at_once(self):
+        """
+        Tests whether the entries of an audit context are inserted with a single query at its end
+        """
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        product.name, product.price = "renamed", "13.00"
+
+        # The search index of the renamed product is updated after the audit context
+        with deferred_indexing(), self.assertNumQueries(3):
+            with audit_context(comment="test"):
+                product.save(update_fields=['name'])
+                product.save(update_fields=['price'])
+
+        self.assertEqual([[("name", "Test_product", "renamed")], [("price", "12.00", "13.00")]],
+                         [entry.changed_fields() for entry in AuditEntry.objects.filter(comment="test").order_by('id')])
+
+    def test_entries_are_discarded_with_the_transaction(self):
+        """
+        Tests whether a failed block does not write its entries
+        """
+        product, processing = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        processing.name = "renamed"
+
+        with self.assertRaises(ValueError):
+            with audit_context(comment="test"):
+                processing.save(update_fields=['name'])
+                raise ValueError
+
+        self.assertFalse(AuditEntry.objects.filter(comment="test").exists())
+
+
+class ProductsProcessingTotalCostTestCase(TestCase):
+    def test_total_cost_is_annotated_by_the_database(self):
+        """
+        Tests whether the totals of many processings are read with a single query
+        """
+        for i in range(5):
+            p, pp = create_product_processing(10, 2, ProductsProcessing.PROCESSING_ADMISSION)
+            ProductProcessingNode.objects.filter(processing=pp).update(custom_price="1.50")
+            create_product_processing_node(Product.objects.create(name="Other", price="3.25", unit=p.unit), pp, 3)
+
+        ProductsProcessing.objects.create(name="empty", type=ProductsProcessing.PROCESSING_ADMISSION)
+
+        with self.assertNumQueries(1):
+            amounts = [pp.total_cost_amount() for pp in ProductsProcessing.objects.with_total_cost().order_by('pk')]
+
+        self.assertEqual(["12.75 PLN"] * 5 + ["(None)"], amounts)
+
+    def test_total_cost_is_frozen_when_closed(self):
+        """
+        Tests whether price changes do not affect the total of a closed processing
+        """
+        p, pp = create_product_processing(10, 2, ProductsProcessing.PROCESSING_ADMISSION)
+
+        pp.close()
+        pp.save()
+        Product.objects.filter(pk=p.pk).update(price="100.00")
+
+        self.assertEqual(Decimal("24.00"), ProductsProcessing.objects.get(pk=pp.pk).closed_total_cost)
+        self.assertEqual("24.00 PLN", ProductsProcessing.objects.with_total_cost().get(pk=pp.pk).total_cost_amount())
+
+
+class ProductsProcessingReviewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_reviews_are_sorted_and_cached(self):
+        """
+        Tests whether the review periods are sorted, cached, and extended when a processing of a new month is closed
+        """
+        for created in ("2015-03-10 10:00Z", "2014-11-02 10:00Z", "2015-01-01 10:00Z", "2015-04-20 10:00Z"):
+            _, pp = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+            ProductsProcessing.objects.filter(pk=pp.pk).update(created=created)
+
+            if created < "2015-04":
+                ProductsProcessing.objects.get(pk=pp.pk).close()
+
+        self.assertEqual([(2014, 11), (2015, 1), (2015, 3)], ProductsProcessing.objects.reviews())
+
+        with self.assertNumQueries(0):
+            self.assertEqual([(2014, 11), (2015, 1), (2015, 3)], ProductsProcessing.objects.reviews())
+
+        _, pp = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+        ProductsProcessing.objects.filter(pk=pp.pk).update(created="2014-12-31 23:00Z")
+        ProductsProcessing.objects.get(pk=pp.pk).close()
+
+        self.assertEqual([(2014, 11), (2014, 12), (2015, 1), (2015, 3)], ProductsProcessing.objects.reviews())
+
+    def test_review_sums_closed_processings_of_the_month(self):
+        """
+        Tests whether the monthly review sums the changes of the closed processings per product name and type
+        """
+        p, admission = create_product_processing(0, 10, ProductsProcessing.PROCESSING_ADMISSION)
+        _, other_admission = create_product_processing(0, 5, ProductsProcessing.PROCESSING_ADMISSION)
+        create_product_processing_node(p, other_admission, 2)
+        _, release = create_product_processing(10, 4, ProductsProcessing.PROCESSING_RELEASE)
+        create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+
+        for pp in (admission, other_admission, release):
+            pp.close()
+            pp.save()
+
+        year, month = MonthlyProductSummary.period_of(admission.created)
+        review = ProductsProcessing.objects.review_for_month(year, month)
+
+        self.assertEqual([("Test_product", 17)], [(r['name'], r['change']) for r in review['admissions']])
+        self.assertEqual([("Test_product", 4)], [(r['name'], r['change']) for r in review['releases']])
+        self.assertFalse(ProductsProcessing.objects.review_for_month(year - 1, month)['admissions'])
+
+    def test_stored_review_is_invalidated_when_its_month_changes(self):
+        """
+        Tests whether a stored review PDF is served until a processing of its month gets closed
+        """
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+
+        with override_settings(WAREHOUSE_REVIEW_STORAGE_OPTIONS={'location': location}):
+            _, pp = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+            year, month = MonthlyProductSummary.period_of(pp.created)
+
+            review_storage().save(review_name(year, month), ContentFile(b"%PDF stored"))
+            review_storage().save(review_name(year - 1, month), ContentFile(b"%PDF other"))
+
+            with self.assertNumQueries(0):
+                self.assertEqual(b"%PDF stored", get_review(year, month))
+
+            pp.close()
+
+            self.assertFalse(review_storage().exists(review_name(year, month)))
+            self.assertTrue(review_storage().exists(review_name(year - 1, month)))
+
+    def test_review_outdated_while_rendered_is_not_stored(self):
+        """
+        Tests whether a review rendered while a processing of its month got closed is served but not stored, and
+        whether a review stored meanwhile by another render is replaced without leaving files behind
+        """
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        render_review = reviews.render_review
+        self.addCleanup(setattr, reviews, 'render_review', render_review)
+
+        with override_settings(WAREHOUSE_REVIEW_STORAGE_OPTIONS={'location': location}):
+            _, first = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+            _, second = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+            year, month = MonthlyProductSummary.period_of(first.created)
+            first.close()
+
+            def render_during_close(year, month):
+                second.close()
+                return b"%PDF before the close"
+
+            reviews.render_review = render_during_close
+
+            self.assertEqual(b"%PDF before the close", get_review(year, month))
+            self.assertFalse(review_storage().exists(review_name(year, month)))
+
+            def render_concurrently(year, month):
+                review_storage().save(review_name(year, month), ContentFile(b"%PDF other render"))
+                return b"%PDF after the close"
+
+            reviews.render_review = render_concurrently
+
+            self.assertEqual(b"%PDF after the close", get_review(year, month))
+            self.assertEqual([review_name(year, month)], os.listdir(location))
+
+            with review_storage().open(review_name(year, month)) as review:
+                self.assertEqual(b"%PDF after the close", review.read())
+
+
+class StockLedgerTestCase(TestCase):
+    def test_quantities_are_answered_from_the_ledger(self):
+        """
+        Tests whether the quantity at a moment is the balance of the last movement before it
+        """
+        p, admission = create_product_processing(5, 10, ProductsProcessing.PROCESSING_ADMISSION)
+        opened = timezone.now()
+
+        admission.close()
+        StockMovement.objects.filter(processing=admission).update(created=opened + datetime.timedelta(days=1))
+
+        _, release = create_product_processing(0, 1, ProductsProcessing.PROCESSING_RELEASE)
+        create_product_processing_node(p, release, 12)
+        release.close()
+        StockMovement.objects.filter(processing=release).update(created=opened + datetime.timedelta(days=2))
+
+        self.assertEqual([5, 10, -12], list(StockMovement.objects.filter(product=p).order_by('id')
+                                          .values_list('quantity_change', flat=True)))
+        self.assertEqual(0, StockMovement.objects.quantity_at(p, opened - datetime.timedelta(days=1)))
+        self.assertEqual(15, StockMovement.objects.quantity_at(p, opened + datetime.timedelta(days=1)))
+        self.assertEqual(3, StockMovement.objects.quantity_at(p, opened + datetime.timedelta(days=3)))
+
+        StockSnapshot.objects.create(taken=opened + datetime.timedelta(hours=36), product=p, quantity=15)
+        quantities = StockMovement.objects.quantities_at(opened + datetime.timedelta(days=3))
+
+        self.assertEqual(3, quantities[p.pk])
+        self.assertEqual(3, Product.objects.get(pk=p.pk).quantity)
+
+
+class WarehouseStockTestCase(TestCase):
+    def test_processings_move_stock_of_their_warehouse(self):
+        """
+        Tests whether closed processings move the quantities into and out of their warehouses
+        """
+        main, other = Warehouse.objects.create(name="Main"), Warehouse.objects.create(name="Other")
+        p, admission = create_product_processing(0, 10, ProductsProcessing.PROCESSING_ADMISSION)
+        p.warehouses.add(main)
+
+        for warehouse, processing_type, quantity_change in ((main, ProductsProcessing.PROCESSING_ADMISSION, 10),
+                                                            (other, ProductsProcessing.PROCESSING_ADMISSION, 5),
+                                                            (main, ProductsProcessing.PROCESSING_RELEASE, 4)):
+            pp = ProductsProcessing.objects.create(name="test", type=processing_type, warehouse=warehouse)
+            create_product_processing_node(p, pp, quantity_change)
+            pp.close()
+
+        admission.close()
+
+        self.assertEqual({main.pk: 6, other.pk: 5}, p.warehouse_quantities())
+        self.assertEqual(21, Product.objects.get(pk=p.pk).quantity)
+
+        with self.assertNumQueries(1):
+            totals = [(w.products_count(), w.stock_value()) for w in Warehouse.objects.with_stock_totals().order_by('pk')]
+
+        self.assertEqual([(1, "72.00 PLN"), (1, "60.00 PLN")], totals)
+
+    def test_releases_are_validated_against_the_stock_of_their_warehouse(self):
+        """
+        Tests whether a release taking more than the stock of its warehouse is rejected, although the total quantity
+        of the product suffices
+        """
+        main, other = Warehouse.objects.create(name="Main"), Warehouse.objects.create(name="Other")
+        p, admission = create_product_processing(0, 10, ProductsProcessing.PROCESSING_ADMISSION)
+        admission.warehouse = main
+        admission.save()
+        close_processings([admission.pk])
+
+        release = ProductsProcessing.objects.create(name="test", type=ProductsProcessing.PROCESSING_RELEASE,
+                                                    warehouse=other)
+        create_product_processing_node(p, release, 4)
+
+        self.assertFalse(release.clean_for_processing())
+        self.assertRaises(ClosingError, close_processings, [release.pk])
+        self.assertEqual([(release, "Not enough quantity of Test_product")], close_processings_batch([release.pk])[1])
+
+        release.warehouse = main
+        release.save()
+        close_processings([release.pk])
+
+        self.assertEqual({main.pk: 6}, p.warehouse_quantities())
+
+    def test_products_without_warehouse_stock_are_limited_by_their_quantity(self):
+        """
+        Tests whether releases of products predating the stock of warehouses are validated against their total
+        quantity only, without writing negative stock, and whether the products are counted in their warehouses
+        """
+        main = Warehouse.objects.create(name="Main")
+        p, release = create_product_processing(100, 10, ProductsProcessing.PROCESSING_RELEASE)
+        p.warehouses.add(main)
+        release.warehouse = main
+        release.save()
+
+        self.assertTrue(release.clean_for_processing())
+
+        self.assertEqual(([release], []), close_processings_batch([release.pk]))
+        self.assertEqual(90, Product.objects.get(pk=p.pk).quantity)
+        self.assertEqual({}, p.warehouse_quantities())
+        self.assertEqual([1], [w.products_count() for w in Warehouse.objects.with_stock_totals()])
+        self.assertEqual(1, main.products_count())
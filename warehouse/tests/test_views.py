@@ -0,0 +1,678 @@
+import datetime
+import io
+import json
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from decimal import Decimal
+
+from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.db import connections
+from django.test import RequestFactory, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from warehouse import exports, reviews
+from warehouse.archiving import archive_processings
+from warehouse.closing import close_processings
+from warehouse.models import ArchivedProcessing, AuditEntry, ClosingJob, Product, ProductsProcessing, ReviewArchive, \
+    Unit, Warehouse
+from warehouse.views import PRODUCT_LOOKUP_PAGE_SIZE
+from warehouse.jobs import claim_job, run_job
+from warehouse.profiling import profiling
+from warehouse.reviews import archive_name, review_name, review_storage
+from warehouse.routing import PIN_COOKIE
+
+from .test_models import create_product_processing, create_product_processing_node
+
+
+class StaffTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+
+class ProductsDetailsTestCase(StaffTestCase):
+    def test_details_of_many_products_are_returned_at_once(self):
+        """
+        Tests whether the batch endpoint returns the details of all requested products with their units
+        """
+        products = [create_product_processing(i, 1, ProductsProcessing.PROCESSING_RELEASE)[0] for i in range(3)]
+        ids = ",".join(str(product.pk) for product in products)
+
+        response = self.client.get(reverse('warehouse_products_details'), {'ids': ids})
+        details = json.loads(response.content.decode('utf-8'))['products']
+
+        self.assertEqual(sorted(str(product.pk) for product in products), sorted(details.keys()))
+        self.assertEqual("tu", details[str(products[2].pk)]['unit']['slug'])
+        self.assertEqual(2, Decimal(details[str(products[2].pk)]["quantity"]))
+
+    def test_unchanged_products_are_not_modified(self):
+        """
+        Tests whether the details are answered with 304 until a returned field of one of the products changes
+        """
+        product, processing = create_product_processing(1, 1, ProductsProcessing.PROCESSING_RELEASE)
+        url = reverse('warehouse_products_details')
+        modified = Product.objects.get(pk=product.pk).modified
+
+        response = self.client.get(url, {'ids': product.pk})
+        headers = {'HTTP_IF_NONE_MATCH': response['ETag']}
+
+        self.assertEqual(304, self.client.get(url, {'ids': product.pk}, **headers).status_code)
+
+        node = processing.nodes.get()
+        node.quantity_change = 2
+        node.save()
+
+        self.assertEqual(modified, Product.objects.get(pk=product.pk).modified)
+        self.assertEqual(200, self.client.get(url, {'ids': product.pk}, **headers).status_code)
+
+        product.name = "Renamed"
+        product.save()
+
+        self.assertEqual(200, self.client.get(url, {'ids': product.pk}, **headers).status_code)
+
+
+class ProductLookupTestCase(StaffTestCase):
+    def setUp(self):
+        super(ProductLookupTestCase, self).setUp()
+
+        self.unit = Unit.objects.create(name="kilogram", slug="kg")
+        self.warehouse = Warehouse.objects.create(name="North")
+
+        for i in range(PRODUCT_LOOKUP_PAGE_SIZE + 5):
+            Product.objects.create(name="Flour {}".format(str(i).zfill(2)), unit=self.unit)
+
+        self.sugar = Product.objects.create(name="Sugar", unit=self.unit)
+        self.sugar.warehouses.add(self.warehouse)
+
+    def lookup(self, **params):
+        return json.loads(self.client.get(reverse('warehouse_product_lookup'), params).content.decode('utf-8'))
+
+    def test_products_are_looked_up_by_name_prefix_in_pages(self):
+        first = self.lookup(q="flo")
+        second = self.lookup(q="flo", page=2)
+
+        self.assertEqual(PRODUCT_LOOKUP_PAGE_SIZE, len(first['results']))
+        self.assertEqual("Flour 00 (kg)", first['results'][0]['text'])
+        self.assertTrue(first['more'])
+        self.assertEqual(["Flour {} (kg)".format(PRODUCT_LOOKUP_PAGE_SIZE + i) for i in range(5)],
+                         [product['text'] for product in second['results']])
+        self.assertFalse(second['more'])
+
+    def test_non_ascii_names_are_looked_up(self):
+        Product.objects.create(name=u"M\u0105ka", unit=Unit.objects.create(name=u"sztuka", slug=u"szt\u0119"))
+
+        self.assertEqual([u"M\u0105ka (szt\u0119)"], [product['text'] for product in self.lookup(q=u"M\u0105")['results']])
+
+    def test_products_are_filtered_by_warehouse(self):
+        self.assertEqual([self.sugar.pk], [product['id'] for product in self.lookup(warehouse=self.warehouse.pk)['results']])
+
+    def test_change_page_renders_only_the_selected_products(self):
+        _, processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+
+        response = self.client.get(reverse('admin:warehouse_productsprocessing_change', args=[processing.pk]))
+
+        self.assertContains(response, 'class="product-lookup-id"')
+        self.assertNotContains(response, "Flour")
+
+
+class StreamExportTestCase(StaffTestCase):
+    def setUp(self):
+        super(StreamExportTestCase, self).setUp()
+
+        self.products = []
+
+        for i in range(3):
+            product, pp = create_product_processing(0, i + 1, ProductsProcessing.PROCESSING_ADMISSION)
+            self.products.append(product)
+
+        create_product_processing_node(self.products[0], pp, "0.5")
+        ProductsProcessing.objects.create(name="empty", type=ProductsProcessing.PROCESSING_RELEASE)
+
+    def _export(self, file_format, **params):
+        url = reverse('admin:warehouse_productsprocessing_stream_export', args=[file_format])
+        response = self.client.get(url, params)
+
+        self.assertTrue(response.streaming)
+
+        return b"".join(response.streaming_content).decode('utf-8').splitlines()
+
+    def test_csv_export_contains_every_node(self):
+        """
+        Tests whether the CSV export has a line per node and a line for every processing without nodes
+        """
+        lines = self._export('csv')
+
+        self.assertTrue(lines[0].startswith("processing_id,processing_name"))
+        self.assertEqual(6, len(lines))
+        self.assertTrue(lines[-1].startswith("{},empty,RS".format(ProductsProcessing.objects.get(name="empty").pk)))
+
+    def test_jsonl_export_respects_filters(self):
+        """
+        Tests whether the JSON Lines export nests the nodes of the processings matching the changelist filters
+        """
+        exports.CHUNK_SIZE, chunk_size = 1, exports.CHUNK_SIZE
+        self.addCleanup(setattr, exports, 'CHUNK_SIZE', chunk_size)
+
+        processings = [json.loads(line) for line in self._export('jsonl', type__exact='AN')]
+
+        self.assertEqual(3, len(processings))
+        self.assertEqual(["Test_product", "Test_product"], [node['product'] for node in processings[2]['nodes']])
+        self.assertEqual("42.00", processings[2]['total_cost'])
+        self.assertEqual("tu", processings[0]['nodes'][0]['unit'])
+
+    def test_jsonl_totals_match_the_processings(self):
+        """
+        Tests whether the exported totals are rounded once, like the processings round them, and whether closed
+        processings are exported with their frozen totals
+        """
+        open_processing = ProductsProcessing.objects.create(name="open", type=ProductsProcessing.PROCESSING_RELEASE)
+
+        for i in range(3):
+            create_product_processing_node(Product.objects.create(name="Extra {}".format(i), unit=self.products[0].unit,
+                                                                  price="1.00"), open_processing, "0.333")
+
+        closed = self.products[1].nodes.get().processing
+        close_processings([closed.pk])
+        Product.objects.filter(pk=self.products[1].pk).update(price="50.00")
+
+        totals = dict((line['id'], line['total_cost']) for line in map(json.loads, self._export('jsonl')))
+
+        self.assertEqual("1.00", ProductsProcessing.objects.get(pk=open_processing.pk).total_cost())
+        self.assertEqual("1.00", totals[open_processing.pk])
+        self.assertEqual("24.00", totals[closed.pk])
+
+
+class BulkImportTestCase(StaffTestCase):
+    def _upload(self, content):
+        upload = SimpleUploadedFile("import.csv", content.encode('utf-8'), content_type="text/csv")
+
+        return self.client.post(reverse('admin:warehouse_productsprocessing_bulk_import'),
+                                {'file': upload, 'format': 'csv'})
+
+    def test_valid_file_is_imported(self):
+        """
+        Tests whether an uploaded file creates the processings and redirects to the changelist
+        """
+        product, _ = create_product_processing(5, 1, ProductsProcessing.PROCESSING_ADMISSION)
+
+        response = self._upload("processing,type,product,quantity_change\nWZ-1,release,{},3\n".format(product.pk))
+
+        self.assertRedirects(response, reverse('admin:warehouse_productsprocessing_changelist'))
+        self.assertEqual(3, ProductsProcessing.objects.get(name="WZ-1").nodes.get(product=product).quantity_change)
+
+    def test_errors_are_listed(self):
+        """
+        Tests whether every invalid row is listed and nothing is imported
+        """
+        response = self._upload("processing,type,product,quantity_change\nWZ-1,release,Missing,3\nWZ-2,x,Missing,1\n")
+
+        self.assertContains(response, "Row 1:")
+        self.assertContains(response, "Row 2:")
+        self.assertFalse(ProductsProcessing.objects.filter(name__startswith="WZ-").exists())
+
+
+class CloseSelectedTestCase(StaffTestCase):
+    def test_selected_processings_are_closed_together(self):
+        """
+        Tests whether the changelist action closes the processings, audits them and reports the rejected ones
+        """
+        product, first = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        second = ProductsProcessing.objects.create(name="second", type=ProductsProcessing.PROCESSING_RELEASE)
+        create_product_processing_node(product, second, 3)
+
+        response = self.client.post(reverse('admin:warehouse_productsprocessing_changelist'), {
+            'action': 'close_selected',
+            '_selected_action': [first.pk, second.pk],
+        }, follow=True)
+
+        self.assertContains(response, "1 processing(s) have been closed.")
+        self.assertContains(response, "second has not been closed: Not enough quantity of Test_product")
+        self.assertEqual(2, Product.objects.get(pk=product.pk).quantity)
+        self.assertEqual("admin", AuditEntry.objects.get(processing=first, comment="Processings closed").user.username)
+
+    def test_non_ascii_names_are_reported(self):
+        """
+        Tests whether rejections of processings and products with non-ASCII names are reported
+        """
+        product, processing = create_product_processing(5, 8, ProductsProcessing.PROCESSING_RELEASE)
+        Product.objects.filter(pk=product.pk).update(name=u"M\u0105ka")
+        ProductsProcessing.objects.filter(pk=processing.pk).update(name=u"Wydanie \u017cytnie")
+
+        response = self.client.post(reverse('admin:warehouse_productsprocessing_changelist'), {
+            'action': 'close_selected',
+            '_selected_action': [processing.pk],
+        }, follow=True)
+
+        self.assertContains(response, u"Wydanie \u017cytnie has not been closed: Not enough quantity of M\u0105ka")
+
+
+class BackgroundCloseTestCase(StaffTestCase):
+    def test_processing_is_locked_while_it_is_closed_in_the_background(self):
+        """
+        Tests whether a queued processing cannot be edited, deleted or closed again and its job status can be polled
+        """
+        product, processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        change_url = reverse('admin:warehouse_productsprocessing_change', args=[processing.pk])
+
+        self.client.get(reverse('warehouse_productsprocessing_close_in_background', args=[processing.pk]))
+        job = ClosingJob.objects.get(processing=processing)
+
+        response = self.client.get(change_url)
+
+        self.assertContains(response, "Waiting for a worker")
+        self.assertNotContains(response, reverse('warehouse_productsprocessing_close', args=[processing.pk]))
+        self.assertNotIn('name', response.context['adminform'].form.fields)
+
+        self.client.get(reverse('warehouse_productsprocessing_close', args=[processing.pk]))
+        self.client.get(reverse('warehouse_productsprocessing_close_in_background', args=[processing.pk]))
+
+        self.assertFalse(ProductsProcessing.objects.get(pk=processing.pk).closed)
+        self.assertEqual(1, ClosingJob.objects.count())
+        self.assertEqual(403, self.client.get(reverse('admin:warehouse_productsprocessing_delete',
+                                                      args=[processing.pk])).status_code)
+
+        run_job(claim_job())
+        status = json.loads(self.client.get(reverse('warehouse_closing_job_status', args=[job.pk]))
+                            .content.decode('utf-8'))
+
+        self.assertEqual((ClosingJob.STATUS_DONE, 100, False), (status['status'], status['progress'], status['active']))
+        self.assertTrue(ProductsProcessing.objects.get(pk=processing.pk).closed)
+
+
+class ProcessingSearchTestCase(StaffTestCase):
+    def test_changelist_searches_the_index(self):
+        """
+        Tests whether the changelist finds processings by their product names and reindexes the edited ones
+        """
+        product, processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        url = reverse('admin:warehouse_productsprocessing_changelist')
+
+        self.assertEqual(1, self.client.get(url, {'q': "test_pro"}).context['cl'].result_count)
+        self.assertEqual(0, self.client.get(url, {'q': "missing"}).context['cl'].result_count)
+
+        self.client.post(reverse('admin:warehouse_productsprocessing_change', args=[processing.pk]), {
+            'name': "Delivery", 'type': processing.type, 'description': "",
+            'nodes-TOTAL_FORMS': 1, 'nodes-INITIAL_FORMS': 1, 'nodes-MAX_NUM_FORMS': 1000,
+            'nodes-0-id': processing.nodes.get().pk, 'nodes-0-processing': processing.pk,
+            'nodes-0-product': product.pk, 'nodes-0-quantity_change': 3,
+        })
+
+        self.assertEqual("Delivery", ProductsProcessing.objects.get(pk=processing.pk).name)
+        self.assertEqual(1, self.client.get(url, {'q': "deliv test"}).context['cl'].result_count)
+
+    def test_deleted_nodes_are_reindexed_once(self):
+        """
+        Tests whether deleting a processing with many nodes in the admin reindexes it once, not once per node
+        """
+        product, processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+
+        for i in range(20):
+            create_product_processing_node(Product.objects.create(name="Flour {}".format(i), unit=product.unit),
+                                           processing, 1)
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.client.post(reverse('admin:warehouse_productsprocessing_delete', args=[processing.pk]), {'post': "yes"})
+
+        self.assertFalse(ProductsProcessing.objects.filter(pk=processing.pk).exists())
+        self.assertLessEqual(len([query for query in queries if 'warehouse_processingsearchtoken' in query['sql']]), 3)
+
+
+class AuditHistoryTestCase(StaffTestCase):
+    def test_changes_are_audited_and_listed(self):
+        """
+        Tests whether a change made in the admin is audited with its user and listed in the history of the processing
+        """
+        product, processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        node = processing.nodes.get()
+
+        self.client.post(reverse('admin:warehouse_productsprocessing_change', args=[processing.pk]), {
+            'name': "renamed", 'description': "test", 'type': processing.type, 'warehouse': "",
+            'nodes-TOTAL_FORMS': 1, 'nodes-INITIAL_FORMS': 1, 'nodes-MIN_NUM_FORMS': 0, 'nodes-MAX_NUM_FORMS': 1000,
+            'nodes-0-id': node.pk, 'nodes-0-processing': processing.pk, 'nodes-0-product': product.pk,
+            'nodes-0-quantity_change': 5, 'nodes-0-custom_price': "",
+        })
+
+        entries = AuditEntry.objects.filter(processing=processing, user__username="admin")
+
+        self.assertEqual([("name", "test", "renamed")], entries.get(product=None).changed_fields())
+        self.assertEqual(2, entries.get(product=product).quantity_change)
+
+        response = self.client.get(reverse('admin:warehouse_productsprocessing_history', args=[processing.pk]))
+
+        self.assertContains(response, "renamed")
+        self.assertContains(response, "Test_product")
+
+
+class ArchivedProcessingTestCase(StaffTestCase):
+    def test_archived_processings_are_read_only(self):
+        """
+        Tests whether an archived processing can be viewed with its nodes and history, but not edited or deleted
+        """
+        product, processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        self.client.get(reverse('warehouse_productsprocessing_close', args=[processing.pk]))
+        archive_processings(timezone.now() + datetime.timedelta(days=1))
+
+        response = self.client.get(reverse('admin:warehouse_archivedprocessing_change', args=[processing.pk]))
+
+        self.assertContains(response, "Test_product")
+        self.assertNotIn('name', response.context['adminform'].form.fields)
+        self.assertEqual(403, self.client.get(reverse('admin:warehouse_archivedprocessing_delete',
+                                                      args=[processing.pk])).status_code)
+        self.assertEqual(403, self.client.get(reverse('admin:warehouse_archivedprocessing_add')).status_code)
+        self.assertContains(self.client.get(reverse('admin:warehouse_archivedprocessing_history',
+                                                    args=[processing.pk])), "Test_product")
+        self.assertTrue(ArchivedProcessing.objects.filter(pk=processing.pk).exists())
+
+
+class ReviewsArchiveTestCase(StaffTestCase):
+    def setUp(self):
+        super(ReviewsArchiveTestCase, self).setUp()
+        cache.clear()
+
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+
+        storage_settings = override_settings(WAREHOUSE_REVIEW_STORAGE_OPTIONS={'location': location})
+        storage_settings.enable()
+        self.addCleanup(storage_settings.disable)
+
+    def test_archives_are_built_in_the_background(self):
+        """
+        Tests whether a requested archive is built by the export_reviews command and then served from the storage,
+        until a close of its year invalidates it
+        """
+        _, processing = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+        close_processings([processing.pk])
+        year, month = processing.created.year, processing.created.month
+        review_storage().save(review_name(year, month), ContentFile(b"%PDF"))
+        url = reverse('warehouse_productsprocessing_review_archive', args=[year])
+
+        self.assertRedirects(self.client.get(url), reverse('warehouse_productsprocessing_review'))
+        self.assertTrue(ReviewArchive.objects.get(year=year).is_pending())
+
+        call_command('export_reviews', requested=True, processes=1, stdout=StringIO())
+        response = self.client.get(url)
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            self.assertEqual([review_name(year, month)], archive.namelist())
+
+        _, processing = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+        close_processings([processing.pk])
+
+        self.assertEqual(302, self.client.get(url).status_code)
+        self.assertTrue(ReviewArchive.objects.get(year=year).is_pending())
+
+    def test_archive_outdated_while_built_stays_pending(self):
+        """
+        Tests whether an archive of a year in which a processing got closed during the build is not stored
+        """
+        _, processing = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+        _, other = create_product_processing(0, 1, ProductsProcessing.PROCESSING_ADMISSION)
+        close_processings([processing.pk])
+        year, month = processing.created.year, processing.created.month
+        review_storage().save(review_name(year, month), ContentFile(b"%PDF"))
+        ReviewArchive.objects.create(year=year)
+
+        write_reviews_archive = reviews.write_reviews_archive
+        self.addCleanup(setattr, reviews, 'write_reviews_archive', write_reviews_archive)
+
+        def write_during_close(periods, fileobj, processes=None):
+            write_reviews_archive(periods, fileobj, processes)
+            close_processings([other.pk])
+
+        reviews.write_reviews_archive = write_during_close
+
+        self.assertEqual([], reviews.build_requested_archives(processes=1))
+        self.assertFalse(review_storage().exists(archive_name(year)))
+        self.assertTrue(ReviewArchive.objects.get(year=year).is_pending())
+
+
+class InventoryValuationTestCase(StaffTestCase):
+    def test_processings_of_the_month_are_valued(self):
+        """
+        Tests whether the report lists the stock value and the totals of the processings of the requested month
+        """
+        product, processing = create_product_processing(2, 3, ProductsProcessing.PROCESSING_RELEASE)
+
+        response = self.client.get(reverse('warehouse_inventory_valuation'),
+                                   {'month': processing.created.strftime("%Y-%m")})
+
+        self.assertContains(response, "Stock value: 24.00 PLN")
+        self.assertContains(response, ": 36.00 PLN</h2>")
+
+
+@override_settings(WAREHOUSE_REPLICA_DATABASE='replica')
+class ReplicaRoutingTestCase(StaffTestCase):
+    """
+    A second, empty SQLite database stands in for a replica lagging behind the default database
+    """
+
+    def setUp(self):
+        super(ReplicaRoutingTestCase, self).setUp()
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults('replica')
+
+        with connections['replica'].schema_editor() as editor:
+            for model in apps.get_models():
+                editor.create_model(model)
+
+        self.product, self.processing = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)
+        self.changelist_url = reverse('admin:warehouse_productsprocessing_changelist')
+
+    def tearDown(self):
+        connections['replica'].close()
+        del connections.databases['replica']
+        del connections._connections.replica
+
+    def test_reports_and_changelists_are_read_from_the_replica(self):
+        """
+        Tests whether the changelist and the valuation report read the replica and the change view the default database
+        """
+        self.assertEqual(0, self.client.get(self.changelist_url).context['cl'].result_count)
+        self.assertContains(self.client.get(reverse('warehouse_inventory_valuation')), "Stock value: 0.00 PLN")
+        self.assertEqual(1, len(self.client.get(reverse('admin:warehouse_productsprocessing_change',
+                                                        args=[self.processing.pk])).context['inline_admin_formsets']))
+
+    def test_cached_reviews_are_read_from_the_default_database(self):
+        """
+        Tests whether the review page, which caches the reviewed months, lists the months of the default database
+        """
+        close_processings([self.processing.pk])
+        cache.clear()
+
+        response = self.client.get(reverse('warehouse_productsprocessing_review'))
+
+        self.assertEqual([self.processing.created.year], response.context['years'])
+
+    def test_clients_are_pinned_to_the_default_database_after_writing(self):
+        """
+        Tests whether a client reads its own close from the default database while the others read the replica
+        """
+        response = self.client.get(reverse('warehouse_productsprocessing_close', args=[self.processing.pk]))
+
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(1, self.client.get(self.changelist_url).context['cl'].result_count)
+
+        del self.client.cookies[PIN_COOKIE]
+
+        self.assertEqual(0, self.client.get(self.changelist_url).context['cl'].result_count)
+
+
+class QueryProfilingTestCase(StaffTestCase):
+    def setUp(self):
+        super(QueryProfilingTestCase, self).setUp()
+        cache.clear()
+
+    def test_repeated_queries_are_reported_with_their_caller(self):
+        """
+        Tests whether a statement executed once per product is flagged as an N+1 suspect of the model method
+        """
+        unit = Unit.objects.create(name="test_unit", slug="tu")
+
+        for i in range(3):
+            Product.objects.create(name="Product {}".format(i), unit=unit)
+
+        with profiling() as profile:
+            [product.reservation() for product in Product.objects.all()]
+
+        summary = profile.summary()
+
+        self.assertEqual(4, summary['queries'])
+        self.assertEqual(0, summary['duplicates'])
+        self.assertEqual(1, len(summary['suspects']))
+        self.assertEqual(3, summary['suspects'][0]['count'])
+        self.assertIn("models.py", summary['suspects'][0]['caller'])
+        self.assertIn("Product.reservation", summary['suspects'][0]['caller'])
+
+    @override_settings(WAREHOUSE_SQL_PROFILING=True)
+    def test_profiled_requests_are_summarized(self):
+        """
+        Tests whether profiled responses carry the SQL headers and their endpoints are listed on the summary page
+        """
+        product, _ = create_product_processing(1, 1, ProductsProcessing.PROCESSING_RELEASE)
+
+        response = self.client.get(reverse('warehouse_product_details', args=[product.pk]))
+
+        self.assertGreater(int(response['X-SQL-Queries']), 0)
+        self.assertEqual("0", response['X-SQL-Suspects'])
+        self.assertContains(self.client.get(reverse('warehouse_sql_profile')), "GET warehouse_product_details")
+
+    def test_requests_are_not_profiled_by_default(self):
+        response = self.client.get(reverse('warehouse_sql_profile'))
+
+        self.assertNotIn('X-SQL-Queries', response)
+        self.assertContains(response, "No requests have been profiled")
+
+
+class AdminViewsConfigurationTestCase(TestCase):
+    THREADS = 8
+    REQUESTS = 200
+
+    def setUp(self):
+        self.user = User(username="admin", is_active=True, is_staff=True, is_superuser=True)
+        self.model_admin = admin.site._registry[ProductsProcessing]
+        self.open = ProductsProcessing(pk=1, name="open", closed=False)
+        self.closed = ProductsProcessing(pk=2, name="closed", closed=True)
+
+        for processing in (self.open, self.closed):
+            processing.closing_jobs_count = 0
+
+    def _configuration(self, obj=None):
+        "Returns the inlines with their read only fields and limits, as the add or the change view builds them"
+        request = RequestFactory().get("/")
+        request.user = self.user
+
+        return [(type(inline).__name__, tuple(inline.get_readonly_fields(request, obj)), inline.get_max_num(request, obj),
+                 inline.has_delete_permission(request, obj))
+                for inline in self.model_admin.get_inline_instances(request, obj)]
+
+    def test_requests_do_not_share_their_configuration(self):
+        """
+        Tests whether the inlines of the add and change views, requested from many threads at once, are chosen per
+        request without changing the shared admin
+        """
+        objs = (None, self.open, self.closed)
+        expected = dict((index, self._configuration(obj)) for index, obj in enumerate(objs))
+        inlines = self.model_admin.inlines
+        mismatches = []
+
+        self.assertEqual("ProductProcessingNodeInlineCreateAdmin", expected[0][0][0])
+        self.assertNotEqual(expected[1], expected[2])
+
+        def request_views(offset):
+            try:
+                for i in range(self.REQUESTS):
+                    index = (offset + i) % len(objs)
+                    configuration = self._configuration(objs[index])
+
+                    if configuration != expected[index]:
+                        mismatches.append((index, configuration))
+            except Exception as error:
+                mismatches.append(error)
+
+        threads = [threading.Thread(target=request_views, args=(offset,)) for offset in range(self.THREADS)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], mismatches)
+        self.assertIs(inlines, self.model_admin.inlines)
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ConcurrentAdminViewsTestCase(TransactionTestCase):
+    THREADS = 8
+    REQUESTS = 30
+
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.model_admin = admin.site._registry[ProductsProcessing]
+        self.open = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)[1]
+        self.closed = create_product_processing(5, 3, ProductsProcessing.PROCESSING_RELEASE)[1]
+        close_processings([self.closed.pk])
+
+    def _configuration(self, object_id=None):
+        "Returns the editable fields and the inlines with their limits, as the add or the change view shows them"
+        request = RequestFactory().get("/")
+        request.user = self.user
+
+        if object_id is None:
+            context = self.model_admin.add_view(request).context_data
+        else:
+            context = self.model_admin.change_view(request, str(object_id)).context_data
+
+        return sorted(context['adminform'].form.fields), [
+            (type(inline.opts).__name__, tuple(inline.readonly_fields), inline.formset.max_num,
+             inline.formset.can_delete) for inline in context['inline_admin_formsets']
+        ]
+
+    def test_views_do_not_share_their_configuration(self):
+        """
+        Tests whether the add and change views requested from many threads at once always show their own inlines
+        and read only fields
+        """
+        object_ids = (None, self.open.pk, self.closed.pk)
+        expected = dict((object_id, self._configuration(object_id)) for object_id in object_ids)
+        mismatches = []
+
+        self.assertNotEqual(expected[self.open.pk], expected[self.closed.pk])
+        self.assertNotEqual(expected[None], expected[self.open.pk])
+
+        def request_views(offset):
+            try:
+                for i in range(self.REQUESTS):
+                    object_id = object_ids[(offset + i) % len(object_ids)]
+                    configuration = self._configuration(object_id)
+
+                    if configuration != expected[object_id]:
+                        mismatches.append((object_id, configuration))
+            except Exception as error:
+                mismatches.append(error)
+            finally:
+                for connection in connections.all():
+                    connection.close()
+
+        threads = [threading.Thread(target=request_views, args=(offset,)) for offset in range(self.THREADS)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], mismatches)
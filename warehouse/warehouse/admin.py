@@ -1,29 +1,47 @@
 import resource
-from django.contrib import admin
+from django.conf.urls import patterns, url
+from django.contrib import admin, messages
+from django.core.urlresolvers import reverse
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect, render
 from import_export import resources
 from import_export.admin import ExportMixin
 
-from .models import Warehouse, Product, Unit, ProductsProcessing, ProductProcessingNode 
-from .admin_mixins import ModedInlinesMixin, ReadOnlyEditFieldsMixin
+from .models import ArchivedProcessing, ArchivedProcessingNode, ClosingJob, Warehouse, Product, Unit, ProductsProcessing, \
+    ProductProcessingNode
+from .admin_mixins import AuditedAdminMixin, DeferredIndexingAdminMixin, ModedInlinesMixin, ReadOnlyEditFieldsMixin, \
+    ReplicaChangelistMixin
+from .closing import close_processings_batch
+from .exports import export_csv, export_jsonl
+from .forms import BulkImportForm, ProductLookupWidget
+from .importing import READERS, ProcessingsImport
+from .jobs import closing_processing_ids
+from .routing import read_database, use_replica
+from .search import search_processings
 
-import reversion
 import re
 
 admin.site.register(Unit)
 
 
 @admin.register(Product)
-class ProductAdmin(ReadOnlyEditFieldsMixin, admin.ModelAdmin):
+class ProductAdmin(ReplicaChangelistMixin, DeferredIndexingAdminMixin, AuditedAdminMixin, ReadOnlyEditFieldsMixin,
+                   admin.ModelAdmin):
     fields = ('warehouses', 'name', 'price', 'quantity', 'unit')
     list_display = ('name', 'cost', 'amount', 'reservation_amount')
     list_editable = ('name',)
+    list_select_related = ('unit',)
 
     readonly_edit_fields = ('quantity', 'unit')
+    audit_lookup = 'product'
 
 
 @admin.register(Warehouse)
 class WarehouseAdmin(admin.ModelAdmin):
-    list_display = ('name', 'products_count')
+    list_display = ('name', 'products_count', 'stock_value')
+
+    def get_queryset(self, request):
+        return super(WarehouseAdmin, self).get_queryset(request).with_stock_totals()
 
 
 class ProductProcessingNodeInlineAdmin(admin.TabularInline):
@@ -39,22 +57,43 @@ class ProductProcessingNodeInlineAdmin(admin.TabularInline):
     fields = ('product', 'quantity_change', 'custom_price', 'total_cost_amount')
     readonly_fields = ('total_cost_amount',)
 
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if db_field.name == 'product':
+            kwargs['widget'] = ProductLookupWidget()
+
+        return super(ProductProcessingNodeInlineAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
 
 class ProductProcessingNodeInlineCreateAdmin(ProductProcessingNodeInlineAdmin):
     extra = 1
 
 
 class ProductProcessingNodeInlineChangeAdmin(ProductProcessingNodeInlineAdmin):
+    "Nodes of closed processings and of processings being closed are shown read only"
+
     extra = 0
 
+    def _is_locked(self, instance):
+        return instance is not None and (instance.closed or instance.is_closing())
+
     def get_readonly_fields(self, request, instance=None):
-        if instance is not None and instance.closed:
-            self.readonly_fields = ('product', 'quantity_change', 'custom_price', 'total_cost_amount')
-            self.max_num = 0
-            self.can_delete = False
+        if self._is_locked(instance):
+            return self.fields
 
         return super(ProductProcessingNodeInlineChangeAdmin, self).get_readonly_fields(request, instance)
 
+    def get_max_num(self, request, obj=None, **kwargs):
+        if self._is_locked(obj):
+            return 0
+
+        return super(ProductProcessingNodeInlineChangeAdmin, self).get_max_num(request, obj, **kwargs)
+
+    def has_delete_permission(self, request, obj=None):
+        if self._is_locked(obj):
+            return False
+
+        return super(ProductProcessingNodeInlineChangeAdmin, self).has_delete_permission(request, obj)
+
 
 class ProductProcessingResource(resources.ModelResource):
 
@@ -63,7 +102,13 @@ class ProductProcessingResource(resources.ModelResource):
 
 
 @admin.register(ProductsProcessing)
-class ProductsProcessingAdmin(ExportMixin, ModedInlinesMixin, reversion.VersionAdmin):
+class ProductsProcessingAdmin(ExportMixin, ReplicaChangelistMixin, ModedInlinesMixin, DeferredIndexingAdminMixin,
+                              AuditedAdminMixin, admin.ModelAdmin):
+    class Media:
+        js = (
+            'warehouse/js/closing_job.js',
+        )
+
     resource_class = ProductProcessingResource
 
     list_display = ('closed', 'type', 'name', 'created', 'total_cost_amount')
@@ -71,14 +116,144 @@ class ProductsProcessingAdmin(ExportMixin, ModedInlinesMixin, reversion.VersionA
     exclude = ('closed',)
     search_fields = ('name', 'nodes__product__name')
     list_filter = ('type', 'created', 'closed')
+    actions = ('close_selected',)
+    audit_lookup = 'processing'
 
     create_only_inlines = (ProductProcessingNodeInlineCreateAdmin,)
     change_only_inlines = (ProductProcessingNodeInlineChangeAdmin,)
 
+    stream_export_formats = {
+        'csv': (export_csv, 'text/csv'),
+        'jsonl': (export_jsonl, 'application/x-ndjson'),
+    }
+
+    def close_selected(self, request, queryset):
+        "Closes the selected processings in one transaction, reporting the rejected ones"
+        processing_ids = list(queryset.values_list('pk', flat=True))
+        closing_ids = closing_processing_ids(processing_ids)
+
+        for processing in queryset.filter(pk__in=closing_ids):
+            self.message_user(request, u"{} has not been closed: It is being closed in the background"
+                              .format(processing.name), messages.ERROR)
+
+        closed, rejected = close_processings_batch([pk for pk in processing_ids if pk not in closing_ids],
+                                                   user=request.user)
+
+        if closed:
+            self.message_user(request, "{} processing(s) have been closed. Products quantities have been modified."
+                              .format(len(closed)), messages.SUCCESS)
+
+        for processing, reason in rejected:
+            self.message_user(request, u"{} has not been closed: {}".format(processing.name, reason), messages.ERROR)
+
+    close_selected.short_description = "Close selected processings"
+
+    def get_urls(self):
+        urls = super(ProductsProcessingAdmin, self).get_urls()
+        my_urls = patterns(
+            '',
+            url(r'^export/stream/(csv|jsonl)/$',
+                self.admin_site.admin_view(self.stream_export_action),
+                name='warehouse_productsprocessing_stream_export'),
+            url(r'^import/bulk/$',
+                self.admin_site.admin_view(self.bulk_import_action),
+                name='warehouse_productsprocessing_bulk_import'),
+        )
+        return my_urls + urls
+
+    def bulk_import_action(self, request):
+        "Imports processings with their nodes from an uploaded file, listing all errors if any line is invalid"
+        form = BulkImportForm(request.POST or None, request.FILES or None)
+        result = None
+
+        if form.is_valid():
+            read = READERS[form.cleaned_data['format']]
+            result = ProcessingsImport().run(read(form.cleaned_data['file']), user=request.user)
+
+            if result.is_valid:
+                messages.success(request, "{} processing(s) with {} node(s) have been imported.".format(
+                    result.processings, result.nodes))
+
+                return redirect(reverse('admin:warehouse_productsprocessing_changelist'))
+
+        return render(request, "admin/warehouse/productsprocessing/bulk_import.html", {
+            'form': form,
+            'result': result,
+            'opts': self.model._meta,
+        })
+
+    def stream_export_action(self, request, file_format):
+        "Streams the processings matching the changelist filters and search together with their nodes"
+        export, content_type = self.stream_export_formats[file_format]
+
+        # The export is streamed after the view returns, so its queryset is bound to the replica here
+        with use_replica():
+            queryset = self.get_export_queryset(request).using(read_database())
+
+        response = StreamingHttpResponse(export(queryset), content_type=content_type)
+        response['Content-Disposition'] = "attachment; filename=productsprocessings.{}".format(file_format)
+
+        return response
+
+    def export_action(self, request, *args, **kwargs):
+        # The export file is posted for, but only read
+        with use_replica():
+            return super(ProductsProcessingAdmin, self).export_action(request, *args, **kwargs)
+
+    def get_queryset(self, request):
+        return super(ProductsProcessingAdmin, self).get_queryset(request).with_total_cost().with_closing_jobs()
+
+    def has_delete_permission(self, request, obj=None):
+        if obj is not None and obj.is_closing():
+            return False
+
+        return super(ProductsProcessingAdmin, self).has_delete_permission(request, obj)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        extra_context = dict(extra_context or {},
+                             closing_job=ClosingJob.objects.filter(processing=object_id).order_by('-pk').first())
+
+        return super(ProductsProcessingAdmin, self).change_view(request, object_id, form_url, extra_context)
+
+    def get_search_results(self, request, queryset, search_term):
+        "Looks the search term up in the search index instead of joining the nodes and products"
+        return search_processings(queryset, search_term), False
+
     def get_readonly_fields(self, request, instance=None):
-        if instance is not None and instance.closed:
-            self.readonly_fields = ('type', 'description', 'name')
-        else:
-            self.readonly_fields = ()
+        if instance is not None and (instance.closed or instance.is_closing()):
+            return ('type', 'warehouse', 'description', 'name')
+
+        return super(ProductsProcessingAdmin, self).get_readonly_fields(request, instance)
+
+
+class ArchivedProcessingNodeInlineAdmin(admin.TabularInline):
+    model = ArchivedProcessingNode
+
+    fields = ('product', 'quantity_change', 'custom_price')
+    readonly_fields = fields
+    extra = 0
+    max_num = 0
+    can_delete = False
+
+
+@admin.register(ArchivedProcessing)
+class ArchivedProcessingAdmin(ReplicaChangelistMixin, AuditedAdminMixin, admin.ModelAdmin):
+    "Archived processings are shown read only, together with the audit entries they had before archiving"
+
+    list_display = ('type', 'name', 'created', 'archived', 'total_cost_amount')
+    list_display_links = ('name',)
+    list_filter = ('type', 'created')
+    search_fields = ('name',)
+    date_hierarchy = 'created'
+    actions = None
+    audit_lookup = 'processing'
+
+    fields = ('name', 'type', 'warehouse', 'description', 'created', 'archived', 'total_cost_amount')
+    readonly_fields = fields
+    inlines = (ArchivedProcessingNodeInlineAdmin,)
+
+    def has_add_permission(self, request):
+        return False
 
-        return super(ProductsProcessingAdmin, self).get_readonly_fields(request, instance)
\ No newline at end of file
+    def has_delete_permission(self, request, obj=None):
+        return False
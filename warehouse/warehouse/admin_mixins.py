@@ -1,3 +1,14 @@
+import copy
+
+from django.db import transaction
+from django.utils.decorators import method_decorator
+
+from .audit import audit_context
+from .models import AuditEntry
+from .routing import replica_view
+from .search import deferred_indexing
+
+
 class ReadOnlyEditFieldsMixin(object):
     """
     Mixing allows the user to specify fields that will be marked as read only in change view
@@ -37,12 +48,76 @@ class ModedInlinesMixin(object):
 
         return inlines
 
-    def change_view(self, request, object_id, form_url='', extra_context=None):
-        self.inlines = self._construct_inlines(self.inlines, self.change_only_inlines, self.create_only_inlines)
+    def get_inline_instances(self, request, obj=None):
+        """
+        Instantiates the inlines of the add view, when obj is None, or of the change view. The inlines are chosen per
+        request and set on a copy of the admin, so the admin shared by the threads of the server is never changed.
+        """
+        if obj is None:
+            inlines = self._construct_inlines(self.inlines, self.create_only_inlines, self.change_only_inlines)
+        else:
+            inlines = self._construct_inlines(self.inlines, self.change_only_inlines, self.create_only_inlines)
+
+        model_admin = copy.copy(self)
+        model_admin.inlines = inlines
+
+        return super(ModedInlinesMixin, model_admin).get_inline_instances(request, obj)
+
+
+class ReplicaChangelistMixin(object):
+    """
+    Mixin serves the changelist from the read replica. The changelist actions are posted, so they are run on the
+    default database.
+    """
+
+    @method_decorator(replica_view)
+    def changelist_view(self, request, extra_context=None):
+        return super(ReplicaChangelistMixin, self).changelist_view(request, extra_context)
+
+
+class DeferredIndexingAdminMixin(object):
+    """
+    Mixin reindexes the processings affected by the change and delete views and by the changelist actions once, at the
+    end of their transaction, instead of once per saved or cascaded node
+    """
+
+    def changeform_view(self, request, *args, **kwargs):
+        with transaction.atomic(), deferred_indexing():
+            return super(DeferredIndexingAdminMixin, self).changeform_view(request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        with transaction.atomic(), deferred_indexing():
+            return super(DeferredIndexingAdminMixin, self).delete_view(request, *args, **kwargs)
+
+    def response_action(self, request, queryset):
+        with transaction.atomic(), deferred_indexing():
+            return super(DeferredIndexingAdminMixin, self).response_action(request, queryset)
+
+
+class AuditedAdminMixin(object):
+    """
+    Mixin records the changes made in the change and delete views in the audit trail, written at the end of their
+    transaction, and shows the audit entries of the object as its history. audit_lookup is the field of the entries
+    pointing to the objects of the admin.
+    """
+
+    audit_lookup = None
+    object_history_template = "admin/warehouse/audit_history.html"
+
+    def changeform_view(self, request, *args, **kwargs):
+        with transaction.atomic(), audit_context(user=request.user):
+            return super(AuditedAdminMixin, self).changeform_view(request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        with transaction.atomic(), audit_context(user=request.user):
+            return super(AuditedAdminMixin, self).delete_view(request, *args, **kwargs)
 
-        return super(ModedInlinesMixin, self).change_view(request, object_id, form_url, extra_context)
+    def history_view(self, request, object_id, extra_context=None):
+        response = super(AuditedAdminMixin, self).history_view(request, object_id, extra_context)
 
-    def add_view(self, request, form_url='', extra_context=None):
-        self.inlines = self._construct_inlines(self.inlines, self.create_only_inlines, self.change_only_inlines)
+        response.context_data['audit_entries'] = AuditEntry.objects \
+            .filter(**{self.audit_lookup: response.context_data['object'].pk}) \
+            .select_related('user', 'content_type', 'product') \
+            .order_by('created', 'id')
 
-        return super(ModedInlinesMixin, self).add_view(request, form_url, extra_context)
+        return response
@@ -0,0 +1,96 @@
+"""
+Archiving of closed processings. Closed processings created before a cutoff are moved with their nodes into the
+archive tables, keeping their primary keys, so the processings and nodes tables only hold the recent history. Whatever
+is computed from closed history does not read the moved rows: the monthly reviews come from the monthly product
+summaries and the stock history from the ledger, which both stay in place.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import ArchivedProcessing, ArchivedProcessingNode, ClosingJob, ProcessingSearchToken, \
+    ProductsProcessing, ProductsProcessingQuerySet, ProductProcessingNode
+
+BATCH_SIZE = 500
+
+PROCESSING_COLUMNS = ('id', 'name', 'description', 'type', 'warehouse_id', 'created', 'modified')
+NODE_COLUMNS = ('id', 'processing_id', 'product_id', 'quantity_change', 'custom_price', 'created', 'modified')
+
+
+def archive_cutoff(days=None, now=None):
+    """
+    Returns the start of the month (in UTC, like the monthly summaries) in which the archiving age of the given number
+    of days (WAREHOUSE_ARCHIVE_AFTER_DAYS by default) ends, so months are always archived whole
+    """
+    if days is None:
+        days = getattr(settings, 'WAREHOUSE_ARCHIVE_AFTER_DAYS', 730)
+
+    moment = (now or timezone.now()).astimezone(timezone.utc) - datetime.timedelta(days=days)
+
+    return datetime.datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def archivable_processings(cutoff):
+    "Returns the closed processings created before the cutoff which no background close refers to anymore"
+    return ProductsProcessing.objects.filter(closed=True, created__lt=cutoff) \
+        .exclude(closing_jobs__status__in=ClosingJob.ACTIVE_STATUSES)
+
+
+def _archive_batch(processing_ids, now):
+    "Copies the processings and their nodes into the archive tables and deletes them with their dependent rows"
+    ids = ", ".join(["%s"] * len(processing_ids))
+    tables = {
+        'processing': ProductsProcessing._meta.db_table,
+        'node': ProductProcessingNode._meta.db_table,
+        'archived_processing': ArchivedProcessing._meta.db_table,
+        'archived_node': ArchivedProcessingNode._meta.db_table,
+    }
+    cursor = connection.cursor()
+
+    # Total costs not frozen at closing time are frozen now, with the current prices
+    cursor.execute((
+        "INSERT INTO {archived_processing} ({columns}, closed_total_cost, archived) "
+        "SELECT {columns}, COALESCE(closed_total_cost, ({total_cost})), %s FROM {processing} WHERE id IN ({ids})"
+    ).format(columns=", ".join(PROCESSING_COLUMNS), total_cost=ProductsProcessingQuerySet.TOTAL_COST_SQL, ids=ids,
+             **tables), [connection.ops.value_to_db_datetime(now)] + processing_ids)
+
+    cursor.execute((
+        "INSERT INTO {archived_node} ({columns}) SELECT {columns} FROM {node} WHERE processing_id IN ({ids})"
+    ).format(columns=", ".join(NODE_COLUMNS), ids=ids, **tables), processing_ids)
+
+    # Rows are deleted without the ORM, since deleting them through it would audit the archiving as deletions
+    for model in (ClosingJob, ProcessingSearchToken, ProductProcessingNode):
+        cursor.execute("DELETE FROM {} WHERE processing_id IN ({})".format(model._meta.db_table, ids), processing_ids)
+
+    cursor.execute("DELETE FROM {processing} WHERE id IN ({ids})".format(ids=ids, **tables), processing_ids)
+
+
+def archive_processings(cutoff, batch_size=None, dry_run=False):
+    """
+    Moves the archivable processings created before the cutoff into the archive tables, in transactions of
+    batch_size processings. Returns the number of archived processings and nodes.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    queryset = archivable_processings(cutoff)
+
+    if dry_run:
+        return queryset.count(), ProductProcessingNode.objects.filter(processing__in=queryset.values('pk')).count()
+
+    processings, nodes = 0, 0
+    now = timezone.now()
+
+    while True:
+        with transaction.atomic():
+            processing_ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+
+            if not processing_ids:
+                break
+
+            nodes += ProductProcessingNode.objects.filter(processing__in=processing_ids).count()
+            _archive_batch(processing_ids, now)
+
+        processings += len(processing_ids)
+
+    return processings, nodes
@@ -0,0 +1,175 @@
+"""
+Delta-only audit trail. Instances of the audited models remember their field values when they are loaded, so a save
+records only the fields which differ from them, without reading the previous state from the database. Entries of an
+audit context are buffered and written with a single INSERT when it ends.
+"""
+import json
+import threading
+
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import AuditEntry, Product, ProductsProcessing, ProductProcessingNode
+
+IGNORED_FIELDS = ('id', 'created', 'modified')
+
+_local = threading.local()
+
+
+class AuditContext(object):
+    def __init__(self, user=None, comment=""):
+        self.user = user
+        self.comment = comment
+        self.entries = []
+
+
+def _contexts():
+    if not hasattr(_local, 'contexts'):
+        _local.contexts = []
+
+    return _local.contexts
+
+
+@contextmanager
+def audit_context(user=None, comment=""):
+    """
+    Buffers the audit entries recorded in the block and writes them at its end with a single INSERT. It has to run
+    inside the transaction of the changes, so the entries are discarded when the block raises. Entries of nested
+    blocks are written by the outermost one, keeping their own user and comment.
+    """
+    contexts = _contexts()
+    outer = contexts[-1] if contexts else None
+    context = AuditContext(user or (outer.user if outer else None), comment or (outer.comment if outer else ""))
+
+    contexts.append(context)
+
+    try:
+        yield context
+    finally:
+        contexts.pop()
+
+    if outer is not None:
+        outer.entries.extend(context.entries)
+    elif context.entries:
+        AuditEntry.objects.bulk_create(context.entries)
+
+
+def audited_values(instance):
+    "Returns the values of the audited fields loaded on the instance, deferred fields are left out"
+    values = {}
+
+    for field in instance._meta.concrete_fields:
+        if field.attname in IGNORED_FIELDS or field.attname not in instance.__dict__:
+            continue
+
+        value = instance.__dict__[field.attname]
+
+        try:
+            values[field.attname] = field.to_python(value) if value is not None else None
+        except ValidationError:
+            values[field.attname] = value
+
+    return values
+
+
+def remember_values(instance):
+    instance._audited_values = audited_values(instance)
+
+
+def _references(instance):
+    "Returns the processing and the product the change of the instance concerns"
+    if isinstance(instance, ProductsProcessing):
+        return instance.pk, None
+
+    if isinstance(instance, ProductProcessingNode):
+        return instance.processing_id, instance.product_id
+
+    return None, instance.pk
+
+
+def _quantity_change(instance, action, previous, current):
+    if isinstance(instance, Product):
+        field = 'quantity'
+    elif isinstance(instance, ProductProcessingNode):
+        # A node moved to another product does not change the quantity of a single product
+        if action == AuditEntry.ACTION_CHANGED and current.get('product_id', previous.get('product_id')) != \
+                previous.get('product_id'):
+            return None
+
+        field = 'quantity_change'
+    else:
+        return None
+
+    if action == AuditEntry.ACTION_CREATED:
+        return current.get(field)
+
+    if action == AuditEntry.ACTION_DELETED:
+        return -previous[field] if previous.get(field) is not None else None
+
+    if previous.get(field) is None or current.get(field) is None or previous[field] == current[field]:
+        return None
+
+    return current[field] - previous[field]
+
+
+def build_entry(instance, action, previous, current):
+    """
+    Returns an entry of the change between the previous and the current field values of the instance, or None if
+    no audited field has changed
+    """
+    if action == AuditEntry.ACTION_CREATED:
+        changes = dict((field, [None, value]) for field, value in current.items() if value is not None)
+    elif action == AuditEntry.ACTION_CHANGED:
+        changes = dict((field, [previous[field], value]) for field, value in current.items()
+                       if field in previous and previous[field] != value)
+
+        if not changes:
+            return None
+    else:
+        changes = {}
+
+    processing_id, product_id = _references(instance)
+
+    return AuditEntry(
+        action=action,
+        content_type=ContentType.objects.get_for_model(instance),
+        object_id=instance.pk,
+        processing_id=processing_id,
+        product_id=product_id,
+        quantity_change=_quantity_change(instance, action, previous, current),
+        changes=json.dumps(changes, cls=DjangoJSONEncoder, sort_keys=True) if changes else ""
+    )
+
+
+def record_change(instance, action, update_fields=None):
+    """
+    Records the change of the instance in the current audit context, or at once outside of any context. Saves limited
+    to some fields record only the changes of these fields.
+    """
+    previous = getattr(instance, '_audited_values', {})
+    current = audited_values(instance)
+
+    if update_fields is not None:
+        attnames = set(instance._meta.get_field(name).attname for name in update_fields)
+        current = dict((field, value) for field, value in current.items() if field in attnames)
+
+    entry = build_entry(instance, action, previous, current)
+
+    instance._audited_values = dict(previous, **current)
+
+    if entry is None:
+        return
+
+    contexts = _contexts()
+    entry.created = timezone.now()
+
+    if contexts:
+        entry.user = contexts[-1].user
+        entry.comment = contexts[-1].comment
+        contexts[-1].entries.append(entry)
+    else:
+        entry.save()
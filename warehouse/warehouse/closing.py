@@ -0,0 +1,463 @@
+import logging
+import random
+import time
+
+from decimal import Decimal
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import Sum
+from django.utils import six, timezone
+
+from .audit import audit_context
+from .models import MonthlyProductSummary, Product, ProductsProcessing, ProductProcessingNode, StockMovement, \
+    WarehouseStock
+
+CLOSE_ATTEMPTS = 5
+RETRY_DELAY = 0.05
+
+# Deadlocks and lock wait timeouts of MySQL
+TRANSIENT_ERROR_CODES = (1205, 1213)
+
+# Serialization failures and deadlocks of PostgreSQL
+TRANSIENT_ERROR_STATES = ('40001', '40P01')
+
+logger = logging.getLogger(__name__)
+
+
+class ClosingError(Exception):
+    pass
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def _signed_quantity_change_sql(processings, node_alias):
+    "Returns the SQL expression of the node quantity change, negated for releases, with its parameters"
+    admission_ids = [processing.pk for processing in processings if processing.is_admission()]
+
+    if len(admission_ids) == len(processings):
+        return "{0}.quantity_change".format(node_alias), []
+
+    if not admission_ids:
+        return "-{0}.quantity_change".format(node_alias), []
+
+    sql = "CASE WHEN {0}.processing_id IN ({1}) THEN {0}.quantity_change ELSE -{0}.quantity_change END".format(
+        node_alias, _placeholders(admission_ids))
+
+    return sql, admission_ids
+
+
+def _warehouse_stocks(product_ids):
+    """
+    Returns the stock quantities of the given products in all warehouses, keyed by (warehouse, product) ids. Products
+    without any stock row predate the stock of warehouses and are not tracked per warehouse until seeded by the
+    seed_warehouse_stock command, so only their total quantity limits their releases.
+    """
+    return dict(((warehouse_id, product_id), quantity) for warehouse_id, product_id, quantity in
+                WarehouseStock.objects.filter(product__in=product_ids).values_list('warehouse', 'product', 'quantity'))
+
+
+class ProcessingsClosing(object):
+    """
+    Closing engine validating and applying the quantity changes of the given processings with a fixed number
+    of queries, independently of the number of nodes they contain
+    """
+
+    def __init__(self, processings):
+        self.processings = list(processings)
+        self.now = timezone.now()
+
+    def processing_ids(self):
+        return [processing.pk for processing in self.processings]
+
+    def release_ids(self):
+        return [processing.pk for processing in self.processings if processing.is_release()]
+
+    def lock_products(self):
+        """
+        Locks the rows of all products changed by the processings until the end of the transaction, returning their
+        quantities by primary key. Rows are locked in the order of their primary keys, so parallel closes wait for
+        each other instead of deadlocking. The stock and summary rows of a product are only written by closes holding
+        its lock.
+        """
+        nodes = ProductProcessingNode.objects.filter(processing__in=self.processing_ids()).values('product')
+
+        return dict(Product.objects.select_for_update().filter(pk__in=nodes).order_by('pk')
+                    .values_list('pk', 'quantity'))
+
+    def is_clean(self):
+        """
+        Checks whether the releases do not take more than the current quantity of any product, nor more than the
+        stock of a tracked product in the warehouse of a release, summing the releases closed together. Admissions are
+        always clean, so they do not hit the database at all.
+        """
+        release_ids = self.release_ids()
+
+        if not release_ids:
+            return True
+
+        released = ProductProcessingNode.objects.filter(processing__in=release_ids) \
+            .values_list('processing__warehouse', 'product', 'product__quantity').annotate(Sum('quantity_change'))
+        products, stocks = {}, {}
+
+        for warehouse_id, product_id, quantity, quantity_change in released:
+            products[product_id] = (quantity, products.get(product_id, (quantity, 0))[1] + quantity_change)
+
+            if warehouse_id is not None:
+                stocks[(warehouse_id, product_id)] = quantity_change
+
+        if any(quantity < quantity_change for quantity, quantity_change in products.values()):
+            return False
+
+        if not stocks:
+            return True
+
+        available = _warehouse_stocks(set(product_id for _, product_id in stocks))
+        tracked = set(product_id for _, product_id in available)
+
+        return all(available.get(key, 0) >= quantity_change for key, quantity_change in stocks.items()
+                   if key[1] in tracked)
+
+    def apply_quantity_changes(self):
+        """
+        Applies the summed quantity change of every product with a single UPDATE using database-side arithmetic.
+        Closed releases stop reserving their quantities, so the reserved quantity is decremented in the same UPDATE.
+        """
+        processing_ids = self.processing_ids()
+
+        if not processing_ids:
+            return
+
+        release_ids = self.release_ids()
+        change_sql, change_params = _signed_quantity_change_sql(self.processings, 'ppn')
+
+        assignments = [
+            "quantity = quantity + (SELECT SUM({change}) FROM {node} AS ppn "
+            "WHERE ppn.product_id = {product}.id AND ppn.processing_id IN ({ids}))"
+        ]
+        params = change_params + processing_ids
+
+        if release_ids:
+            assignments.append(
+                "reserved_quantity = reserved_quantity - COALESCE((SELECT SUM(ppn.quantity_change) FROM {node} AS ppn "
+                "WHERE ppn.product_id = {product}.id AND ppn.processing_id IN ({release_ids})), 0)"
+            )
+            params += release_ids
+
+        assignments.append("modified = %s")
+        params += [connection.ops.value_to_db_datetime(self.now)] + processing_ids
+
+        sql = (
+            "UPDATE {product} SET " + ", ".join(assignments) + " "
+            "WHERE id IN (SELECT product_id FROM {node} WHERE processing_id IN ({ids}))"
+        ).format(
+            product=Product._meta.db_table,
+            node=ProductProcessingNode._meta.db_table,
+            change=change_sql,
+            ids=_placeholders(processing_ids),
+            release_ids=_placeholders(release_ids)
+        )
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+    def apply_warehouse_stock_changes(self):
+        """
+        Moves the quantities into or out of the warehouses of the processings. Every warehouse takes two queries:
+        one creating the missing stock rows and one applying the summed changes. Releases create no rows for products
+        not tracked per warehouse yet, so their untracked stock does not turn into a negative row.
+        """
+        warehouses = {}
+
+        for processing in self.processings:
+            if processing.warehouse_id is not None:
+                warehouses.setdefault(processing.warehouse_id, []).append(processing)
+
+        tables = {
+            'stock': WarehouseStock._meta.db_table,
+            'node': ProductProcessingNode._meta.db_table
+        }
+        cursor = connection.cursor()
+
+        for warehouse_id, processings in warehouses.items():
+            processing_ids = [processing.pk for processing in processings]
+            ids = _placeholders(processing_ids)
+            change_sql, change_params = _signed_quantity_change_sql(processings, 'ppn')
+            admission_ids = [processing.pk for processing in processings if processing.is_admission()]
+            tracked_sql = "EXISTS (SELECT 1 FROM {stock} AS tracked WHERE tracked.product_id = ppn.product_id)"
+
+            if admission_ids:
+                tracked_sql = "(ppn.processing_id IN ({0}) OR {1})".format(_placeholders(admission_ids), tracked_sql)
+
+            cursor.execute((
+                "INSERT INTO {stock} (product_id, warehouse_id, quantity) "
+                "SELECT ppn.product_id, %s, 0 FROM {node} AS ppn WHERE ppn.processing_id IN ({ids}) "
+                "AND NOT EXISTS (SELECT 1 FROM {stock} AS ws WHERE ws.product_id = ppn.product_id AND ws.warehouse_id = %s) "
+                "AND " + tracked_sql + " GROUP BY ppn.product_id"
+            ).format(ids=ids, **tables), [warehouse_id] + processing_ids + [warehouse_id] + admission_ids)
+
+            cursor.execute((
+                "UPDATE {stock} SET quantity = quantity + (SELECT SUM({change}) FROM {node} AS ppn "
+                "WHERE ppn.processing_id IN ({ids}) AND ppn.product_id = {stock}.product_id) "
+                "WHERE warehouse_id = %s AND product_id IN (SELECT product_id FROM {node} WHERE processing_id IN ({ids}))"
+            ).format(ids=ids, change=change_sql, **tables), change_params + processing_ids + [warehouse_id] + processing_ids)
+
+    def record_stock_movements(self):
+        """
+        Appends a movement for every node to the stock ledger with a single INSERT. It has to run after the quantities
+        were applied: the balance of a movement is the current quantity minus the changes of the later processings.
+        """
+        processing_ids = self.processing_ids()
+
+        if not processing_ids:
+            return
+
+        change_sql, change_params = _signed_quantity_change_sql(self.processings, 'ppn')
+        balance_sql, balance_params = "p.quantity", []
+
+        if len(processing_ids) > 1:
+            later_change_sql, later_change_params = _signed_quantity_change_sql(self.processings, 'later')
+            balance_sql = (
+                "p.quantity - COALESCE((SELECT SUM({change}) FROM {node} AS later WHERE later.product_id = p.id "
+                "AND later.processing_id IN ({ids}) AND later.processing_id > ppn.processing_id), 0)"
+            ).format(change=later_change_sql, node=ProductProcessingNode._meta.db_table,
+                     ids=_placeholders(processing_ids))
+            balance_params = later_change_params + processing_ids
+
+        sql = (
+            "INSERT INTO {movement} (product_id, processing_id, quantity_change, balance, created) "
+            "SELECT ppn.product_id, ppn.processing_id, {change}, {balance}, %s "
+            "FROM {node} AS ppn INNER JOIN {product} AS p ON p.id = ppn.product_id "
+            "WHERE ppn.processing_id IN ({ids}) ORDER BY ppn.processing_id"
+        ).format(
+            movement=StockMovement._meta.db_table,
+            node=ProductProcessingNode._meta.db_table,
+            product=Product._meta.db_table,
+            change=change_sql,
+            balance=balance_sql,
+            ids=_placeholders(processing_ids)
+        )
+        params = change_params + balance_params + [connection.ops.value_to_db_datetime(self.now)] + processing_ids
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+    def freeze_total_costs(self):
+        """
+        Stores the total cost of every processing on the instance, since prices cannot change it after closing.
+        The frozen value is persisted together with the closed flag.
+        """
+        totals = dict(ProductsProcessing.objects.with_total_cost().filter(pk__in=self.processing_ids())
+                      .values_list('pk', 'total_cost_value'))
+
+        for processing in self.processings:
+            total_cost = totals.get(processing.pk)
+
+            if total_cost is not None:
+                if not isinstance(total_cost, Decimal):
+                    total_cost = Decimal(repr(total_cost))
+
+                total_cost = total_cost.quantize(Decimal('0.01'))
+
+            processing.closed_total_cost = processing.total_cost_value = total_cost
+
+    def record_monthly_summaries(self):
+        """
+        Adds the quantity changes to the monthly summaries. Every (year, month, type) group of processings takes
+        two queries: one creating the missing summary rows and one incrementing all of them.
+        """
+        groups = {}
+
+        for processing in self.processings:
+            period = MonthlyProductSummary.period_of(processing.created)
+            groups.setdefault(period + (processing.type,), []).append(processing.pk)
+
+        tables = {
+            'summary': MonthlyProductSummary._meta.db_table,
+            'node': ProductProcessingNode._meta.db_table
+        }
+        cursor = connection.cursor()
+
+        for (year, month, processing_type), processing_ids in groups.items():
+            ids = _placeholders(processing_ids)
+            group = [year, month, processing_type]
+
+            cursor.execute((
+                "INSERT INTO {summary} (year, month, type, product_id, quantity_change) "
+                "SELECT %s, %s, %s, ppn.product_id, 0 FROM {node} AS ppn "
+                "WHERE ppn.processing_id IN ({ids}) AND NOT EXISTS (SELECT 1 FROM {summary} AS mps "
+                "WHERE mps.year = %s AND mps.month = %s AND mps.type = %s AND mps.product_id = ppn.product_id) "
+                "GROUP BY ppn.product_id"
+            ).format(ids=ids, **tables), group + processing_ids + group)
+
+            cursor.execute((
+                "UPDATE {summary} SET quantity_change = quantity_change + (SELECT SUM(ppn.quantity_change) "
+                "FROM {node} AS ppn WHERE ppn.processing_id IN ({ids}) AND ppn.product_id = {summary}.product_id) "
+                "WHERE year = %s AND month = %s AND type = %s "
+                "AND product_id IN (SELECT product_id FROM {node} WHERE processing_id IN ({ids}))"
+            ).format(ids=ids, **tables), processing_ids + group + processing_ids)
+
+    def close(self):
+        for processing in self.processings:
+            processing.closed = True
+
+        self.apply_quantity_changes()
+        self.apply_warehouse_stock_changes()
+        self.record_stock_movements()
+        self.freeze_total_costs()
+        self.record_monthly_summaries()
+
+    def invalidate_reviews(self):
+        """
+        Clears the cached review periods and deletes the stored reviews of the months of the processings. It has to run
+        after the close is committed, otherwise a review rendered meanwhile from the data before the close would be
+        stored.
+        """
+        from .reviews import invalidate_review
+
+        periods = set([MonthlyProductSummary.period_of(processing.created) for processing in self.processings])
+
+        ProductsProcessing.objects.invalidate_reviews()
+
+        for year, month in periods:
+            invalidate_review(year, month)
+
+
+def _is_transient(error):
+    "Checks whether the error is a deadlock or a serialization failure after which the transaction can be repeated"
+    if error.args and error.args[0] in TRANSIENT_ERROR_CODES:
+        return True
+
+    if getattr(getattr(error, '__cause__', None), 'pgcode', None) in TRANSIENT_ERROR_STATES:
+        return True
+
+    return 'database is locked' in six.text_type(error)
+
+
+def _close_locked(processing_ids, user):
+    with transaction.atomic(), audit_context(user=user, comment="Processing closed"):
+        processings = list(ProductsProcessing.objects.select_for_update().filter(pk__in=processing_ids).order_by('pk'))
+
+        if len(processings) != len(set(processing_ids)):
+            raise ClosingError("Products Processing Entry does not exist")
+
+        if any(processing.closed for processing in processings):
+            raise ClosingError("You cannot close Products Processing Entry which has been already closed")
+
+        closing = ProcessingsClosing(processings)
+        closing.lock_products()
+
+        # Quantities are validated again under the locks, since another close could have changed them meanwhile
+        if not closing.is_clean():
+            raise ClosingError("Operation has been terminated due to the validation errors.")
+
+        closing.close()
+
+        for processing in processings:
+            processing.save()
+
+        return processings
+
+
+def _close_batch_locked(processing_ids, user):
+    with transaction.atomic(), audit_context(user=user, comment="Processings closed"):
+        processings = list(ProductsProcessing.objects.select_for_update().filter(pk__in=processing_ids).order_by('pk'))
+        rejected = [(processing, "It has been already closed") for processing in processings if processing.closed]
+        processings = [processing for processing in processings if not processing.closed]
+
+        quantities = ProcessingsClosing(processings).lock_products()
+        nodes = {}
+
+        for processing_id, product_id, name, quantity_change in ProductProcessingNode.objects.filter(
+                processing__in=[processing.pk for processing in processings]) \
+                .values_list('processing', 'product', 'product__name', 'quantity_change'):
+            nodes.setdefault(processing_id, []).append((product_id, name, quantity_change))
+
+        warehouse_ids = set(processing.warehouse_id for processing in processings if processing.warehouse_id is not None)
+        stocks = _warehouse_stocks(quantities.keys()) if warehouse_ids else {}
+        tracked = set(product_id for _, product_id in stocks)
+
+        # Processings are accepted in the order of their primary keys, which is the order of their ledger movements,
+        # so releases have to fit into the quantities and warehouse stocks left by the releases accepted before them
+        accepted = []
+
+        for processing in processings:
+            processing_nodes = nodes.get(processing.pk, [])
+            warehouse_id = processing.warehouse_id
+
+            if processing.is_release():
+                shortages = [name for product_id, name, quantity_change in processing_nodes
+                             if quantities[product_id] < quantity_change or
+                             (warehouse_id is not None and product_id in tracked and
+                              stocks.get((warehouse_id, product_id), 0) < quantity_change)]
+
+                if shortages:
+                    rejected.append((processing, u"Not enough quantity of {}".format(u", ".join(shortages))))
+                    continue
+
+            for product_id, _, quantity_change in processing_nodes:
+                change = quantity_change if processing.is_admission() else -quantity_change
+                quantities[product_id] += change
+
+                # The same rows as apply_warehouse_stock_changes writes, where admissions start tracking a product
+                if warehouse_id is not None and (product_id in tracked or processing.is_admission()):
+                    stocks[(warehouse_id, product_id)] = stocks.get((warehouse_id, product_id), 0) + change
+                    tracked.add(product_id)
+
+            accepted.append(processing)
+
+        if accepted:
+            ProcessingsClosing(accepted).close()
+
+            for processing in accepted:
+                processing.save()
+
+        return accepted, sorted(rejected, key=lambda rejection: rejection[0].pk)
+
+
+def _with_retries(close, processing_ids, user, attempts):
+    """
+    Runs the close, repeating it with a random backoff after deadlocks and serialization failures. Inside an outer
+    transaction a failed attempt cannot be repeated, so the error is raised at once.
+    """
+    if attempts is None:
+        attempts = CLOSE_ATTEMPTS
+
+    if connection.in_atomic_block:
+        attempts = 1
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return close(processing_ids, user)
+        except OperationalError as error:
+            if attempt == attempts or not _is_transient(error):
+                raise
+
+            logger.warning("Closing of processings %s failed with %s, attempt %d of %d", processing_ids, error,
+                           attempt, attempts)
+
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1) * random.random())
+
+
+def close_processings(processing_ids, user=None, attempts=None):
+    """
+    Closes the processings in a transaction holding the locks of the processings and of their products, auditing it
+    as a change of the given user. Raises ClosingError if any of them cannot be closed.
+    """
+    processings = _with_retries(_close_locked, processing_ids, user, attempts)
+    ProcessingsClosing(processings).invalidate_reviews()
+
+    return processings
+
+
+def close_processings_batch(processing_ids, user=None, attempts=None):
+    """
+    Closes as many of the processings as the stock allows in a single transaction, validating the combined releases
+    of every product and applying one summed quantity change per product. Returns the closed processings and
+    (processing, reason) pairs of the rejected ones.
+    """
+    closed, rejected = _with_retries(_close_batch_locked, processing_ids, user, attempts)
+    ProcessingsClosing(closed).invalidate_reviews()
+
+    return closed, rejected
@@ -0,0 +1,113 @@
+"""
+Streaming export of products processings together with their nodes. Processings are read in primary key ordered
+chunks and the nodes of every chunk are fetched with a single query, so memory use does not depend on the export size.
+"""
+import csv
+import json
+
+from decimal import Context, Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+
+from .models import ProductProcessingNode
+
+CHUNK_SIZE = 100
+
+PROCESSING_FIELDS = ('id', 'name', 'type', 'closed', 'warehouse', 'created')
+
+NODE_FIELDS = ('product_id', 'product', 'unit', 'quantity_change', 'price', 'total_cost')
+
+
+def _exact_total(quantity_change, price):
+    return Context().multiply(Decimal(quantity_change), Decimal(price))
+
+
+def _rounded(value):
+    return Decimal("{0:.2f}".format(value))
+
+
+def iterate_processings(queryset, chunk_size=None):
+    """
+    Yields (processing, nodes) pairs, where processing and every node are dictionaries of the exported fields. The
+    processing also has its total_cost: the frozen total of a closed processing, otherwise the exact sum of its lines
+    rounded once, like ProductsProcessing.total_cost does, or None without lines.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    queryset = queryset.order_by('pk').values('pk', 'name', 'type', 'closed', 'warehouse__name', 'created',
+                                              'closed_total_cost')
+    last_pk = None
+
+    while True:
+        chunk = queryset.filter(pk__gt=last_pk) if last_pk is not None else queryset
+        chunk = list(chunk[:chunk_size])
+
+        if not chunk:
+            return
+
+        nodes, totals = {}, {}
+        rows = ProductProcessingNode.objects.using(queryset.db) \
+            .filter(processing__in=[processing['pk'] for processing in chunk]) \
+            .order_by('processing', 'pk') \
+            .values_list('processing', 'product', 'product__name', 'product__unit__slug', 'quantity_change',
+                         'custom_price', 'product__price')
+
+        for processing_id, product_id, product, unit, quantity_change, custom_price, product_price in rows:
+            price = custom_price or product_price
+            total = _exact_total(quantity_change, price)
+            totals[processing_id] = totals.get(processing_id, 0) + total
+            nodes.setdefault(processing_id, []).append(dict(zip(NODE_FIELDS, (
+                product_id, product, unit, quantity_change, price, _rounded(total)
+            ))))
+
+        for processing in chunk:
+            exported = dict(zip(PROCESSING_FIELDS, (
+                processing['pk'], processing['name'], processing['type'], processing['closed'],
+                processing['warehouse__name'], processing['created']
+            )))
+
+            if processing['closed_total_cost'] is not None:
+                exported['total_cost'] = _rounded(processing['closed_total_cost'])
+            else:
+                exported['total_cost'] = _rounded(totals[processing['pk']]) if processing['pk'] in totals else None
+
+            yield exported, nodes.get(processing['pk'], [])
+
+        last_pk = chunk[-1]['pk']
+
+
+class _Echo(object):
+    "File-like object returning what is written to it, so csv.writer can produce the lines one by one"
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+
+    value = six.text_type(value)
+
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def export_csv(queryset):
+    "Yields CSV lines, one per node. Processings without nodes take a single line with empty node columns."
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(['processing_' + field for field in PROCESSING_FIELDS] + list(NODE_FIELDS))
+
+    for processing, nodes in iterate_processings(queryset):
+        header = [_csv_value(processing[field]) for field in PROCESSING_FIELDS]
+
+        for node in nodes or [{}]:
+            yield writer.writerow(header + [_csv_value(node.get(field)) for field in NODE_FIELDS])
+
+
+def export_jsonl(queryset):
+    "Yields JSON Lines, one per processing with its nodes and total cost"
+    for processing, nodes in iterate_processings(queryset):
+        processing['nodes'] = nodes
+
+        yield json.dumps(processing, cls=DjangoJSONEncoder) + "\n"
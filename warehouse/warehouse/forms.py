@@ -1,4 +1,45 @@
 from django import forms
+from django.core.urlresolvers import reverse
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+
 
 class ReviewForm(forms.Form):
     date = forms.DateField()
+
+
+class ValuationForm(forms.Form):
+    month = forms.DateField(input_formats=['%Y-%m'], required=False, help_text="YYYY-MM")
+
+
+class BulkImportForm(forms.Form):
+    FORMATS = (
+        ('csv', 'CSV'),
+        ('json', 'JSON / JSON Lines'),
+    )
+
+    file = forms.FileField()
+    format = forms.ChoiceField(choices=FORMATS)
+
+
+class ProductLookupWidget(forms.Widget):
+    """
+    Product picker rendering only the id of the selected product, so the page does not contain the whole catalogue.
+    The product_lookup.js script shows the name of the selected product and looks other products up by their name.
+    """
+
+    class Media:
+        js = (
+            'warehouse/js/product_lookup.js',
+        )
+
+    def render(self, name, value, attrs=None):
+        attrs = self.build_attrs(attrs, type='hidden', name=name, value=value or "")
+        attrs['class'] = "product-lookup-id"
+
+        return format_html(
+            '<span class="product-lookup" data-lookup-url="{}" data-details-url="{}"><input{} />'
+            '<input type="text" class="product-lookup-search vTextField" autocomplete="off" '
+            'placeholder="Start typing a product name" /><ul class="product-lookup-results"></ul></span>',
+            reverse('warehouse_product_lookup'), reverse('warehouse_products_details'), flatatt(attrs)
+        )
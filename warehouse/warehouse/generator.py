@@ -0,0 +1,63 @@
+"""
+Synthetic data for benchmarks and profiling: units, warehouses, products and processings with their nodes. Random
+choices are seeded, so the same arguments always generate the same data.
+"""
+import random
+
+from decimal import Decimal
+
+from .closing import close_processings_batch
+from .models import Product, ProductsProcessing, ProductProcessingNode, Unit, Warehouse, WarehouseStock
+from .search import index_processings
+
+# Stock of every product in every warehouse
+INITIAL_QUANTITY = Decimal(100000)
+
+
+def generate(units=3, products=50, warehouses=3, processings=20, nodes=5, closed=0.5, seed=0):
+    """
+    Creates the given numbers of objects and returns the created processings. Every processing gets a warehouse and
+    nodes of distinct products. The given share of processings gets closed, in one batch.
+    """
+    rng = random.Random(seed)
+
+    created_units = [Unit.objects.create(name="Unit {}".format(i), slug="u{}".format(i)) for i in range(units)]
+    created_warehouses = [Warehouse.objects.create(name="Warehouse {}".format(i)) for i in range(warehouses)]
+    created_products = []
+
+    for i in range(products):
+        product = Product.objects.create(name="Product {}".format(i), unit=rng.choice(created_units),
+                                         price=Decimal(rng.randint(1, 100000)).scaleb(-2),
+                                         quantity=INITIAL_QUANTITY * len(created_warehouses))
+        product.warehouses.add(*rng.sample(created_warehouses, rng.randint(1, len(created_warehouses))))
+        created_products.append(product)
+
+    WarehouseStock.objects.bulk_create([
+        WarehouseStock(product=product, warehouse=warehouse, quantity=INITIAL_QUANTITY)
+        for product in created_products for warehouse in created_warehouses
+    ])
+
+    created_processings = []
+    created_nodes = []
+
+    for i in range(processings):
+        processing = ProductsProcessing.objects.create(
+            name="Processing {}".format(i),
+            type=rng.choice([ProductsProcessing.PROCESSING_ADMISSION, ProductsProcessing.PROCESSING_RELEASE]),
+            warehouse=rng.choice(created_warehouses)
+        )
+        created_processings.append(processing)
+
+        for product in rng.sample(created_products, min(nodes, len(created_products))):
+            created_nodes.append(ProductProcessingNode(processing=processing, product=product,
+                                                       quantity_change=Decimal(rng.randint(1, 10000)).scaleb(-3)))
+
+    ProductProcessingNode.objects.bulk_create(created_nodes)
+    Product.objects.refresh_reservations([product.pk for product in created_products])
+    index_processings([processing.pk for processing in created_processings])
+
+    if closed:
+        closed_processings = rng.sample(created_processings, int(len(created_processings) * closed))
+        close_processings_batch([processing.pk for processing in closed_processings])
+
+    return created_processings
@@ -0,0 +1,236 @@
+"""
+Bulk import of products processings and their nodes from CSV or JSON. Every line describes a single node and lines
+sharing the same processing reference make up one processing:
+
+    processing, name, type, description, product, unit, quantity_change, custom_price
+
+Product references are resolved with a single query per batch of lines and the whole import is validated before
+anything is written, so all errors are reported together. Nodes are inserted with bulk creates.
+"""
+import csv
+import json
+
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import six
+
+from .audit import audit_context
+from .models import Product, ProductsProcessing, ProductProcessingNode
+from .search import deferred_indexing
+
+BATCH_SIZE = 1000
+
+PROCESSING_TYPES = {
+    'rs': ProductsProcessing.PROCESSING_RELEASE,
+    'release': ProductsProcessing.PROCESSING_RELEASE,
+    'an': ProductsProcessing.PROCESSING_ADMISSION,
+    'admission': ProductsProcessing.PROCESSING_ADMISSION,
+}
+
+
+def read_csv(fileobj):
+    "Yields the lines of a CSV file with a header as dictionaries"
+    if six.PY2:
+        for row in csv.DictReader(fileobj):
+            yield dict((key, value.decode('utf-8') if value is not None else None) for key, value in row.items())
+    else:
+        lines = (line.decode('utf-8') if isinstance(line, bytes) else line for line in fileobj)
+
+        for row in csv.DictReader(lines):
+            yield row
+
+
+def read_json(fileobj):
+    "Yields the lines of a JSON array or of JSON Lines as dictionaries"
+    content = fileobj.read()
+
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+
+    if content.lstrip().startswith('['):
+        for row in json.loads(content):
+            yield row
+    else:
+        for line in content.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+}
+
+
+class ProcessingsImportResult(object):
+    "Errors are (row, message) pairs, rows are numbered from 1 without the CSV header"
+
+    def __init__(self):
+        self.errors = []
+        self.processings = 0
+        self.nodes = 0
+
+    def add_error(self, number, message):
+        self.errors.append((number, message))
+
+    @property
+    def is_valid(self):
+        return not self.errors
+
+
+class ProcessingsImport(object):
+    """
+    Validates the lines of an import in batches and writes all of them at once if none of them is invalid
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or BATCH_SIZE
+
+    def _value(self, row, key):
+        value = row.get(key)
+
+        return six.text_type(value).strip() if value is not None else ''
+
+    def _decimal(self, value):
+        try:
+            value = Decimal(value)
+        except InvalidOperation:
+            return None
+
+        return value if value.is_finite() else None
+
+    def _resolve_products(self, rows):
+        """
+        Returns a function resolving (product, unit) references of the given lines, looked up with a single query.
+        References are product ids or product names, disambiguated by the unit slug.
+        """
+        ids, names = set(), set()
+
+        for _, row in rows:
+            reference = self._value(row, 'product')
+            (ids if reference.isdigit() else names).add(reference)
+
+        products_by_id, products_by_name = {}, {}
+        products = Product.objects.filter(Q(pk__in=ids) | Q(name__in=names)).values_list('id', 'name', 'unit__slug')
+
+        for product_id, name, unit in products:
+            products_by_id[str(product_id)] = (product_id, unit)
+            products_by_name.setdefault(name, []).append((product_id, unit))
+
+        def resolve(reference, unit):
+            if reference.isdigit():
+                candidates = [products_by_id[reference]] if reference in products_by_id else []
+            else:
+                candidates = products_by_name.get(reference, [])
+
+            if unit:
+                candidates = [candidate for candidate in candidates if candidate[1] == unit]
+
+            if not candidates:
+                return None, u"Product '{}'{} does not exist".format(reference, u" in unit '{}'".format(unit) if unit else u"")
+
+            if len(candidates) > 1:
+                return None, u"Product '{}' is ambiguous, specify its unit".format(reference)
+
+            return candidates[0][0], None
+
+        return resolve
+
+    def _validate_batch(self, rows, result, processings, nodes):
+        resolve = self._resolve_products(rows)
+
+        for number, row in rows:
+            reference = self._value(row, 'processing')
+
+            if not reference:
+                result.add_error(number, "Processing reference is missing")
+                continue
+
+            header = (
+                self._value(row, 'name') or reference,
+                PROCESSING_TYPES.get(self._value(row, 'type').lower()),
+                self._value(row, 'description') or None
+            )
+
+            if header[1] is None:
+                result.add_error(number, u"Processing type '{}' is not valid".format(self._value(row, 'type')))
+                continue
+
+            if processings.setdefault(reference, (number, header))[1] != header:
+                result.add_error(number, u"Processing '{}' differs from its first row {}".format(reference, processings[reference][0]))
+                continue
+
+            product_id, error = resolve(self._value(row, 'product'), self._value(row, 'unit'))
+
+            if error:
+                result.add_error(number, error)
+                continue
+
+            quantity_change = self._decimal(self._value(row, 'quantity_change'))
+            custom_price = self._decimal(self._value(row, 'custom_price')) if self._value(row, 'custom_price') else None
+
+            if quantity_change is None:
+                result.add_error(number, u"Quantity change '{}' is not valid".format(self._value(row, 'quantity_change')))
+                continue
+
+            if custom_price is None and self._value(row, 'custom_price'):
+                result.add_error(number, u"Custom price '{}' is not valid".format(self._value(row, 'custom_price')))
+                continue
+
+            key = (reference, product_id)
+
+            if key in nodes:
+                result.add_error(number, u"Product '{}' is already imported to processing '{}' in row {}".format(
+                    self._value(row, 'product'), reference, nodes[key][0]))
+                continue
+
+            nodes[key] = (number, quantity_change, custom_price)
+
+    def run(self, rows, dry_run=False, user=None):
+        """
+        Imports the given lines, auditing the created processings as changes of the given user. Nothing is written
+        unless all of them are valid.
+        """
+        result = ProcessingsImportResult()
+        processings, nodes = {}, {}
+        batch = []
+
+        for number, row in enumerate(rows, 1):
+            batch.append((number, row))
+
+            if len(batch) == self.batch_size:
+                self._validate_batch(batch, result, processings, nodes)
+                batch = []
+
+        if batch:
+            self._validate_batch(batch, result, processings, nodes)
+
+        if not result.is_valid:
+            return result
+
+        result.processings = len(processings)
+        result.nodes = len(nodes)
+
+        if dry_run:
+            return result
+
+        with transaction.atomic(), audit_context(user=user, comment="Bulk import"), deferred_indexing():
+            created = {}
+
+            for reference, (_, (name, processing_type, description)) in processings.items():
+                created[reference] = ProductsProcessing.objects.create(name=name, type=processing_type,
+                                                                       description=description)
+
+            ProductProcessingNode.objects.bulk_create([
+                ProductProcessingNode(processing=created[reference], product_id=product_id,
+                                      quantity_change=quantity_change, custom_price=custom_price)
+                for (reference, product_id), (_, quantity_change, custom_price) in nodes.items()
+            ], batch_size=self.batch_size)
+
+            # Bulk creates do not send signals, the reserved quantities are refreshed at once. The created processings
+            # are indexed with their nodes at the end of the deferred indexing.
+            Product.objects.refresh_reservations([product_id for _, product_id in nodes.keys()])
+
+        return result
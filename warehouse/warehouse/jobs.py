@@ -0,0 +1,149 @@
+"""
+Background closing of processings. A close handed off to the background is stored as a ClosingJob and performed by
+the process_closing_jobs command. The job table is the only queue, so no broker is needed. Jobs are claimed with a
+conditional UPDATE, so several workers can run at once without taking the same job. A running job beats its heartbeat
+from a thread of its worker, so a job is recovered only once its worker has stopped beating, however long it runs.
+"""
+import datetime
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import six, timezone
+
+from .closing import ClosingError, ProcessingsClosing, close_processings
+from .models import ClosingJob, ProductsProcessing
+
+logger = logging.getLogger(__name__)
+
+
+def closing_processing_ids(processing_ids):
+    "Returns the ids of the given processings which wait for a background close or are being closed by one"
+    return set(ClosingJob.objects.filter(processing__in=processing_ids, status__in=ClosingJob.ACTIVE_STATUSES)
+               .values_list('processing', flat=True))
+
+
+def enqueue_close(processing_id, user=None):
+    """
+    Queues the close of the processing, raising ClosingError if it is closed or queued already. The processing row
+    is locked, so the same processing cannot be queued twice by parallel requests.
+    """
+    with transaction.atomic():
+        processing = ProductsProcessing.objects.select_for_update().filter(pk=processing_id).first()
+
+        if processing is None:
+            raise ClosingError("Products Processing Entry does not exist")
+
+        if processing.closed:
+            raise ClosingError("You cannot close Products Processing Entry which has been already closed")
+
+        if processing.is_closing():
+            raise ClosingError("Products Processing Entry is already being closed in the background")
+
+        return ClosingJob.objects.create(processing=processing, user=user, message="Waiting for a worker")
+
+
+def claim_job():
+    "Marks the oldest queued job as running and returns it, or returns None when no job is queued"
+    for job_id in ClosingJob.objects.filter(status=ClosingJob.STATUS_QUEUED).order_by('created', 'pk') \
+            .values_list('pk', flat=True)[:10]:
+        claimed = ClosingJob.objects.filter(pk=job_id, status=ClosingJob.STATUS_QUEUED) \
+            .update(status=ClosingJob.STATUS_RUNNING, started=timezone.now(), heartbeat=timezone.now(),
+                    message="Starting")
+
+        if claimed:
+            return ClosingJob.objects.select_related('processing', 'user').get(pk=job_id)
+
+    return None
+
+
+class Heartbeat(threading.Thread):
+    """
+    Thread storing the current time as the heartbeat of a running job every interval seconds, on its own connection,
+    so the heartbeat is committed while the close holds its transaction open
+    """
+
+    def __init__(self, job_id, interval=None):
+        super(Heartbeat, self).__init__(name="closing-job-{}-heartbeat".format(job_id))
+        self.daemon = True
+        self.job_id = job_id
+        self.interval = interval if interval is not None else getattr(settings, 'WAREHOUSE_CLOSING_JOB_HEARTBEAT', 30)
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                ClosingJob.objects.filter(pk=self.job_id).update(heartbeat=timezone.now())
+        except DatabaseError:
+            logger.exception("Heartbeat of closing job %s has failed", self.job_id)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _report(job, progress, message, status=None):
+    "Stores the progress of the job at once, outside of the transaction of the close, so it can be polled"
+    job.progress, job.message, job.heartbeat = progress, message[:255], timezone.now()
+    update_fields = ['progress', 'message', 'heartbeat']
+
+    if status is not None:
+        job.status, job.finished = status, timezone.now()
+        update_fields += ['status', 'finished']
+
+    job.save(update_fields=update_fields)
+
+
+def run_job(job):
+    """
+    Closes the processing of a claimed job. The nodes are validated without locks first, so a close bound to fail
+    does not lock the products. The close itself validates them again under the locks.
+    """
+    processing = job.processing
+    heartbeat = Heartbeat(job.pk)
+    heartbeat.start()
+
+    try:
+        lines = processing.nodes.count()
+        _report(job, 10, "Validating {} line(s)".format(lines))
+
+        if not ProcessingsClosing([processing]).is_clean():
+            raise ClosingError("Operation has been terminated due to the validation errors.")
+
+        _report(job, 30, "Closing {} line(s)".format(lines))
+        close_processings([processing.pk], user=job.user)
+    except ClosingError as error:
+        _report(job, job.progress, six.text_type(error), ClosingJob.STATUS_FAILED)
+    except Exception as error:
+        logger.exception("Closing job %s of processing %s has failed", job.pk, processing.pk)
+        _report(job, job.progress, u"Closing has failed: {}".format(error), ClosingJob.STATUS_FAILED)
+    else:
+        _report(job, 100, "Entry has been closed. Products quantities have been modified.", ClosingJob.STATUS_DONE)
+    finally:
+        heartbeat.stop()
+
+    return job
+
+
+def recover_stale_jobs(timeout=None):
+    """
+    Handles the running jobs without a heartbeat for longer than the timeout, whose workers have died. Closes are
+    transactional, so the jobs of closed processings are done and the others are queued again.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'WAREHOUSE_CLOSING_JOB_TIMEOUT', 300)
+
+    stale = ClosingJob.objects.filter(status=ClosingJob.STATUS_RUNNING,
+                                      heartbeat__lt=timezone.now() - datetime.timedelta(seconds=timeout))
+
+    done = stale.filter(processing__closed=True).update(
+        status=ClosingJob.STATUS_DONE, progress=100, finished=timezone.now(),
+        message="Entry has been closed. Products quantities have been modified.")
+    queued = stale.filter(processing__closed=False).update(
+        status=ClosingJob.STATUS_QUEUED, progress=0, started=None, heartbeat=None,
+        message="Queued again after a worker failure")
+
+    return done + queued
@@ -0,0 +1,38 @@
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from warehouse.archiving import BATCH_SIZE, archive_cutoff, archive_processings
+
+
+class Command(BaseCommand):
+    help = ("Moves closed processings of the months before the cutoff into the archive tables. Schedule it with cron "
+            "to keep the processings table small, the cutoff follows WAREHOUSE_ARCHIVE_AFTER_DAYS by default.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', action='store', type='int', dest='days', default=None,
+                    help="Archive the months ended at least this many days ago"),
+        make_option('--before', action='store', dest='before', default=None,
+                    help="Archive the months before this one, given as YYYY-MM"),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=BATCH_SIZE,
+                    help="Number of processings archived in one transaction"),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Only count the processings which would be archived"),
+    )
+
+    def handle(self, *args, **options):
+        if options['before']:
+            try:
+                cutoff = datetime.datetime.strptime(options['before'], "%Y-%m").replace(tzinfo=timezone.utc)
+            except ValueError:
+                raise CommandError("Month has to be given as YYYY-MM")
+        else:
+            cutoff = archive_cutoff(options['days'])
+
+        processings, nodes = archive_processings(cutoff, options['batch_size'], options['dry_run'])
+
+        self.stdout.write("{} processing(s) with {} node(s) created before {} {}".format(
+            processings, nodes, cutoff.strftime("%Y-%m-%d"), "would be archived" if options['dry_run'] else "archived"))
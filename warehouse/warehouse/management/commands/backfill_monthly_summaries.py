@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from warehouse.models import ArchivedProcessingNode, MonthlyProductSummary, ProductProcessingNode, ProductsProcessing
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the monthly product summaries from the nodes of all closed and archived processings"
+
+    def handle(self, *args, **options):
+        summaries = {}
+
+        for nodes in (ProductProcessingNode.objects.filter(processing__closed=True), ArchivedProcessingNode.objects):
+            rows = nodes.values_list('processing__created', 'processing__type', 'product_id', 'quantity_change')
+
+            for created, processing_type, product_id, quantity_change in rows.iterator():
+                key = MonthlyProductSummary.period_of(created) + (processing_type, product_id)
+                summaries[key] = summaries.get(key, 0) + quantity_change
+
+        with transaction.atomic():
+            MonthlyProductSummary.objects.all().delete()
+            MonthlyProductSummary.objects.bulk_create([
+                MonthlyProductSummary(year=year, month=month, type=processing_type, product_id=product_id,
+                                      quantity_change=quantity_change)
+                for (year, month, processing_type, product_id), quantity_change in summaries.items()
+            ], batch_size=500)
+
+        ProductsProcessing.objects.invalidate_reviews()
+
+        self.stdout.write("{} monthly summaries rebuilt".format(len(summaries)))
@@ -0,0 +1,80 @@
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from reversion.models import Revision, Version
+
+from warehouse.audit import audited_values, build_entry
+from warehouse.models import AuditEntry, Product, ProductsProcessing, ProductProcessingNode
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = "Converts the django-reversion versions of processings, nodes and products into delta-only audit entries"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--delete', action='store_true', dest='delete', default=False,
+                    help="Delete the converted versions and the revisions left without versions"),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=BATCH_SIZE,
+                    help="Number of audit entries inserted at once"),
+    )
+
+    def _entries(self, content_type):
+        """
+        Yields the audit entries of the versions of one model. Versions are full snapshots, so every one is compared
+        with the previous version of the same object and only the differences are kept.
+        """
+        versions = Version.objects.filter(content_type=content_type).select_related('revision') \
+            .order_by('object_id_int', 'revision__date_created', 'pk')
+        object_id, previous = None, None
+
+        for version in versions.iterator():
+            deserialized = next(serializers.deserialize(version.format, version.serialized_data,
+                                                        ignorenonexistent=True))
+            instance = deserialized.object
+            current = audited_values(instance)
+
+            if version.object_id_int != object_id:
+                entry = build_entry(instance, AuditEntry.ACTION_CREATED, {}, current)
+            else:
+                entry = build_entry(instance, AuditEntry.ACTION_CHANGED, previous, current)
+
+            object_id, previous = version.object_id_int, current
+
+            if entry is not None:
+                entry.created = version.revision.date_created
+                entry.user_id = version.revision.user_id
+                entry.comment = version.revision.comment[:255]
+
+                yield entry
+
+    def handle(self, *args, **options):
+        content_types = [ContentType.objects.get_for_model(model)
+                         for model in (ProductsProcessing, ProductProcessingNode, Product)]
+        converted = 0
+
+        with transaction.atomic():
+            for content_type in content_types:
+                batch = []
+
+                for entry in self._entries(content_type):
+                    batch.append(entry)
+
+                    if len(batch) == options['batch_size']:
+                        AuditEntry.objects.bulk_create(batch)
+                        converted += len(batch)
+                        batch = []
+
+                AuditEntry.objects.bulk_create(batch)
+                converted += len(batch)
+
+            if options['delete']:
+                Version.objects.filter(content_type__in=content_types).delete()
+                Revision.objects.filter(version__isnull=True).delete()
+
+        self.stdout.write("{} audit entr{} created{}".format(
+            converted, "y" if converted == 1 else "ies", ", versions deleted" if options['delete'] else ""))
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from warehouse.models import ProductsProcessing
+from warehouse.reviews import build_requested_archives, write_reviews_archive
+
+
+class Command(BaseCommand):
+    args = "<year> <archive.zip>"
+    help = ("Renders the monthly reviews of a whole year in parallel and writes them to a ZIP archive. With --requested "
+            "it builds the archives requested from the review page into the review storage, schedule it with cron.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', action='store', type='int', dest='processes', default=None,
+                    help="Number of rendering processes (WAREHOUSE_REVIEW_EXPORT_PROCESSES by default)"),
+        make_option('--requested', action='store_true', dest='requested', default=False,
+                    help="Build the requested archives into the review storage"),
+    )
+
+    def handle(self, *args, **options):
+        if options['requested']:
+            years = build_requested_archives(processes=options['processes'])
+            self.stdout.write("{} archive(s) built".format(len(years)))
+
+            return
+
+        if len(args) != 2 or not args[0].isdigit():
+            raise CommandError("Usage: export_reviews {}".format(self.args))
+
+        year, path = int(args[0]), args[1]
+        periods = [review for review in ProductsProcessing.objects.reviews() if review[0] == year]
+
+        with open(path, 'wb') as archive:
+            write_reviews_archive(periods, archive, processes=options['processes'])
+
+        self.stdout.write("{} review(s) written to {}".format(len(periods), path))
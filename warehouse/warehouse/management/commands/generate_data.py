@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from warehouse.generator import generate
+
+
+class Command(BaseCommand):
+    help = "Generates synthetic units, warehouses, products and processings for benchmarks and profiling"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--units', action='store', type='int', dest='units', default=3),
+        make_option('--products', action='store', type='int', dest='products', default=50),
+        make_option('--warehouses', action='store', type='int', dest='warehouses', default=3),
+        make_option('--processings', action='store', type='int', dest='processings', default=20),
+        make_option('--nodes', action='store', type='int', dest='nodes', default=5,
+                    help="Number of nodes of every processing"),
+        make_option('--closed', action='store', type='float', dest='closed', default=0.5,
+                    help="Share of the processings which get closed"),
+        make_option('--seed', action='store', type='int', dest='seed', default=0),
+    )
+
+    def handle(self, *args, **options):
+        processings = generate(units=options['units'], products=options['products'],
+                               warehouses=options['warehouses'], processings=options['processings'],
+                               nodes=options['nodes'], closed=options['closed'], seed=options['seed'])
+
+        self.stdout.write("{} processing(s) generated".format(len(processings)))
@@ -0,0 +1,42 @@
+import os
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from warehouse.importing import READERS, ProcessingsImport
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = "Imports products processings and their nodes from a CSV or JSON file"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+                    help="csv or json (guessed from the file extension by default)"),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=None,
+                    help="Number of lines validated and inserted at once"),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Only validate the file"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: import_processings {}".format(self.args))
+
+        file_format = options['format'] or os.path.splitext(args[0])[1].lstrip('.').lower()
+
+        if file_format not in READERS:
+            raise CommandError("Format has to be one of: {}".format(", ".join(sorted(READERS))))
+
+        with open(args[0], 'rb') as fileobj:
+            result = ProcessingsImport(options['batch_size']).run(READERS[file_format](fileobj), dry_run=options['dry_run'])
+
+        for number, message in result.errors:
+            self.stderr.write(u"Row {}: {}".format(number, message))
+
+        if not result.is_valid:
+            raise CommandError("{} error(s) found, nothing has been imported".format(len(result.errors)))
+
+        self.stdout.write("{} processing(s) with {} node(s) {}".format(
+            result.processings, result.nodes, "are valid" if options['dry_run'] else "imported"))
@@ -0,0 +1,42 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from warehouse.valuation import valuation_report
+
+
+class Command(BaseCommand):
+    args = "[YYYY-MM]"
+    help = "Values the stock per warehouse and product and, for the given month, the processings created in it"
+
+    def _write_totals(self, title, totals):
+        self.stdout.write(title)
+
+        for name, total in totals:
+            self.stdout.write(u"  {}: {} PLN".format(name, total))
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Usage: inventory_valuation {}".format(self.args))
+
+        year = month = None
+
+        if args:
+            try:
+                date = datetime.datetime.strptime(args[0], "%Y-%m")
+            except ValueError:
+                raise CommandError("Month has to be given as YYYY-MM")
+
+            year, month = date.year, date.month
+
+        report = valuation_report(year, month)
+
+        self.stdout.write("Stock value: {} PLN".format(report['stock_total']))
+        self._write_totals("Stock per warehouse:", report['stock_warehouses'])
+        self._write_totals("Stock per product:", report['stock_products'])
+
+        if args:
+            self.stdout.write("Processings of {}: {} PLN".format(args[0], report['processings_total']))
+            self._write_totals("Per processing:", report['processings'])
+            self._write_totals("Per product, at current prices:", report['processings_products'])
+            self._write_totals("Per warehouse:", report['processings_warehouses'])
@@ -0,0 +1,37 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Sum
+from django.utils import timezone
+
+from warehouse.models import Product, StockMovement
+
+
+class Command(BaseCommand):
+    help = ("Opens the stock ledger of every product without an opening movement. The opening balance is the current "
+            "quantity less the changes already recorded, dated before the first of them.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        products = Product.objects.exclude(pk__in=StockMovement.objects.filter(processing__isnull=True)
+                                           .values('product'))
+        recorded = dict((row['product'], (row['recorded'], row['first'])) for row in
+                        StockMovement.objects.filter(product__in=products.values('pk')).values('product')
+                        .annotate(recorded=Sum('quantity_change'), first=Min('created')))
+        movements = []
+
+        for product_id, quantity in products.values_list('id', 'quantity'):
+            quantity_change, first = recorded.get(product_id, (0, None))
+            balance = quantity - quantity_change
+
+            # The opening has to come strictly before the recorded movements, whose balances already include it
+            created = first - datetime.timedelta(seconds=1) if first is not None else now
+
+            movements.append(StockMovement(product_id=product_id, quantity_change=balance, balance=balance,
+                                           created=created))
+
+        with transaction.atomic():
+            StockMovement.objects.bulk_create(movements, batch_size=500)
+
+        self.stdout.write("{} product ledger(s) opened".format(len(movements)))
@@ -0,0 +1,37 @@
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from warehouse.reviews import get_review, invalidate_review
+
+
+class Command(BaseCommand):
+    args = "[YYYY-MM ...]"
+    help = "Renders and stores the monthly review PDFs of the given months (the previous month by default)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help="Render the reviews again even if they are already stored"),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            try:
+                periods = [(date.year, date.month) for date in
+                           [datetime.datetime.strptime(arg, "%Y-%m") for arg in args]]
+            except ValueError:
+                raise CommandError("Months have to be given as YYYY-MM")
+        else:
+            previous_month = timezone.now().replace(day=1) - datetime.timedelta(days=1)
+            periods = [(previous_month.year, previous_month.month)]
+
+        for year, month in periods:
+            if options['force']:
+                invalidate_review(year, month)
+
+            get_review(year, month)
+
+            self.stdout.write("Review {}/{} is ready".format(year, str(month).zfill(2)))
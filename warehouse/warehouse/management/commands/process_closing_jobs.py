@@ -0,0 +1,40 @@
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from warehouse.jobs import claim_job, recover_stale_jobs, run_job
+
+POLL_INTERVAL = 2.0
+
+
+class Command(BaseCommand):
+    help = "Runs the queued background closes of processings, waiting for new ones unless --once is given"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help="Exit when the queue is empty"),
+        make_option('--interval', action='store', type='float', dest='interval', default=POLL_INTERVAL,
+                    help="Seconds to wait before checking an empty queue again"),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+
+            recovered = recover_stale_jobs()
+
+            if recovered:
+                self.stdout.write("{} stale job(s) recovered".format(recovered))
+
+            job = claim_job()
+
+            if job is not None:
+                run_job(job)
+                self.stdout.write(u"Job {} of {}: {}".format(job.pk, job.processing, job.message))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from warehouse.models import Product, ProductsProcessing, ProductProcessingNode
+
+
+class Command(BaseCommand):
+    help = "Recomputes the reserved quantity of every product from scratch and reports the drifted ones"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Only report the drift, do not store the recomputed values"),
+    )
+
+    def handle(self, *args, **options):
+        reservations = dict(
+            ProductProcessingNode.objects
+            .filter(processing__type=ProductsProcessing.PROCESSING_RELEASE, processing__closed=False)
+            .values_list('product')
+            .annotate(reservation=Sum('quantity_change'))
+        )
+
+        drifted = []
+
+        for product_id, name, reserved_quantity in Product.objects.values_list('id', 'name', 'reserved_quantity'):
+            reservation = reservations.get(product_id) or 0
+
+            if reserved_quantity != reservation:
+                drifted.append(product_id)
+                self.stdout.write(u"{} (#{}): stored {}, actual {}".format(name, product_id, reserved_quantity, reservation))
+
+        if drifted and not options['dry_run']:
+            with transaction.atomic():
+                Product.objects.refresh_reservations(drifted)
+
+        self.stdout.write("{} product(s) drifted{}".format(len(drifted), "" if options['dry_run'] or not drifted else ", fixed"))
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from warehouse.models import ProcessingSearchToken, ProductsProcessing
+from warehouse.search import CHUNK_SIZE, index_processings
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the search index of all processings from their names and the names of their products"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=CHUNK_SIZE,
+                    help="Number of processings indexed in one transaction"),
+    )
+
+    def handle(self, *args, **options):
+        # Tokens of processings deleted without signals are left behind by the reindexing
+        ProcessingSearchToken.objects.exclude(processing__in=ProductsProcessing.objects.values('pk')).delete()
+
+        last_pk, indexed = 0, 0
+
+        while True:
+            processing_ids = list(ProductsProcessing.objects.filter(pk__gt=last_pk).order_by('pk')
+                                  .values_list('pk', flat=True)[:options['batch_size']])
+
+            if not processing_ids:
+                break
+
+            with transaction.atomic():
+                index_processings(processing_ids)
+
+            last_pk = processing_ids[-1]
+            indexed += len(processing_ids)
+
+        self.stdout.write("{} processing(s) indexed, {} token(s)".format(indexed, ProcessingSearchToken.objects.count()))
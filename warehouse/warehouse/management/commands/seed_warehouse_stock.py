@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Sum
+
+from warehouse.models import Product, Warehouse, WarehouseStock
+
+
+class Command(BaseCommand):
+    help = ("Seeds the stock of warehouses from the quantities of products, so their releases are validated per "
+            "warehouse. The quantity of a product not stored in the warehouses yet goes to the only warehouse the "
+            "product is linked to, or to the --warehouse one for products linked to several warehouses or to none. "
+            "Products it cannot place are listed and stay limited by their total quantity only.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--warehouse', action='store', type='int', dest='warehouse', default=None,
+                    help="Id of the warehouse storing the products linked to several warehouses or to none"),
+    )
+
+    def handle(self, *args, **options):
+        default = options['warehouse']
+
+        if default is not None and not Warehouse.objects.filter(pk=default).exists():
+            raise CommandError("Warehouse {} does not exist".format(default))
+
+        links = {}
+
+        for product_id, warehouse_id in Product.warehouses.through.objects.values_list('product', 'warehouse'):
+            links.setdefault(product_id, []).append(warehouse_id)
+
+        seeded, skipped = 0, 0
+
+        # Closes lock the products before writing their stock, so the seeded quantities cannot race with them
+        with transaction.atomic():
+            products = list(Product.objects.select_for_update().order_by('pk').values_list('id', 'name', 'quantity'))
+            stored = dict(WarehouseStock.objects.values_list('product').annotate(Sum('quantity')))
+
+            for product_id, name, quantity in products:
+                missing = quantity - (stored.get(product_id) or 0)
+
+                if not missing:
+                    continue
+
+                warehouses = links.get(product_id, [])
+                warehouse_id = warehouses[0] if len(warehouses) == 1 else default
+
+                if missing < 0 or warehouse_id is None:
+                    skipped += 1
+                    self.stdout.write(u"{} (#{}): {} not placed, linked to {} warehouse(s)".format(
+                        name, product_id, missing, len(warehouses)))
+                    continue
+
+                stock, created = WarehouseStock.objects.get_or_create(product_id=product_id, warehouse_id=warehouse_id,
+                                                                      defaults={'quantity': missing})
+
+                if not created:
+                    WarehouseStock.objects.filter(pk=stock.pk).update(quantity=F('quantity') + missing)
+
+                seeded += 1
+
+        self.stdout.write("{} product(s) seeded, {} skipped".format(seeded, skipped))
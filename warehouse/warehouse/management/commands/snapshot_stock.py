@@ -0,0 +1,30 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from warehouse.models import Product, StockMovement, StockSnapshot
+
+
+class Command(BaseCommand):
+    args = "[YYYY-MM-DD]"
+    help = "Stores the quantities of all products at the start of the given day (today by default) computed from the stock ledger"
+
+    def handle(self, *args, **options):
+        try:
+            day = datetime.datetime.strptime(args[0], "%Y-%m-%d") if args else timezone.now().replace(tzinfo=None)
+        except ValueError:
+            raise CommandError("The day has to be given as YYYY-MM-DD")
+
+        taken = timezone.make_aware(datetime.datetime(day.year, day.month, day.day), timezone.utc)
+        quantities = StockMovement.objects.quantities_at(taken)
+
+        with transaction.atomic():
+            StockSnapshot.objects.filter(taken=taken).delete()
+            StockSnapshot.objects.bulk_create([
+                StockSnapshot(taken=taken, product_id=product_id, quantity=quantities.get(product_id, 0))
+                for product_id in Product.objects.values_list('id', flat=True)
+            ], batch_size=500)
+
+        self.stdout.write("Stock snapshot taken at {}".format(taken))
@@ -0,0 +1,151 @@
+import multiprocessing
+import random
+import time
+
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.db.models import Sum
+
+from warehouse.closing import ClosingError, close_processings
+from warehouse.models import Product, ProductsProcessing, ProductProcessingNode, StockMovement, Unit
+
+INITIAL_QUANTITY = Decimal(1000)
+
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+def _close(arguments):
+    "Returns whether the processing has been closed, rejected or failed after all attempts, with the duration"
+    processing_id, attempts = arguments
+    started = time.time()
+
+    try:
+        close_processings([processing_id], attempts=attempts)
+    except ClosingError:
+        return 'rejected', time.time() - started
+    except OperationalError:
+        return 'failed', time.time() - started
+
+    return 'closed', time.time() - started
+
+
+class Command(BaseCommand):
+    help = "Closes many overlapping processings in parallel, verifying the final quantities and measuring throughput"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processings', action='store', type='int', dest='processings', default=200,
+                    help="Number of processings closed at once"),
+        make_option('--products', action='store', type='int', dest='products', default=10,
+                    help="Number of products shared by the processings"),
+        make_option('--nodes', action='store', type='int', dest='nodes', default=3,
+                    help="Number of nodes of every processing"),
+        make_option('--processes', action='store', type='int', dest='processes', default=None,
+                    help="Number of closing processes (number of CPUs by default)"),
+        make_option('--attempts', action='store', type='int', dest='attempts', default=None,
+                    help="Number of attempts of every close (CLOSE_ATTEMPTS by default)"),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help="Keep the generated products and processings"),
+    )
+
+    def _generate(self, options):
+        unit = Unit.objects.create(name="stress test", slug="stress")
+        products = [Product.objects.create(name="Stress test product {}".format(i), unit=unit, price="1.00",
+                                           quantity=INITIAL_QUANTITY)
+                    for i in range(options['products'])]
+        processings = []
+
+        for i in range(options['processings']):
+            processing = ProductsProcessing.objects.create(
+                name="Stress test processing {}".format(i),
+                type=random.choice([ProductsProcessing.PROCESSING_ADMISSION, ProductsProcessing.PROCESSING_RELEASE])
+            )
+
+            ProductProcessingNode.objects.bulk_create([
+                ProductProcessingNode(processing=processing, product=product, quantity_change=random.randint(1, 50))
+                for product in random.sample(products, min(options['nodes'], len(products)))
+            ])
+            processings.append(processing.pk)
+
+        Product.objects.refresh_reservations([product.pk for product in products])
+
+        return unit, products, processings
+
+    def _verify(self, products, processings):
+        "Returns the products whose quantity, reservation or ledger does not match the closed processings"
+        nodes = ProductProcessingNode.objects.filter(processing__in=processings)
+        changes = dict((product.pk, [INITIAL_QUANTITY, Decimal(0)]) for product in products)
+
+        for product_id, processing_type, closed, quantity_change in nodes.values_list(
+                'product', 'processing__type', 'processing__closed', 'quantity_change'):
+            if closed:
+                changes[product_id][0] += quantity_change if processing_type == ProductsProcessing.PROCESSING_ADMISSION \
+                    else -quantity_change
+            elif processing_type == ProductsProcessing.PROCESSING_RELEASE:
+                changes[product_id][1] += quantity_change
+
+        ledger = dict(StockMovement.objects.filter(product__in=products).values_list('product')
+                      .annotate(Sum('quantity_change')))
+        mismatches = []
+
+        for product_id, quantity, reserved_quantity in Product.objects.filter(pk__in=changes.keys()) \
+                .values_list('id', 'quantity', 'reserved_quantity'):
+            expected_quantity, expected_reservation = changes[product_id]
+
+            if quantity != expected_quantity or reserved_quantity != expected_reservation \
+                    or ledger.get(product_id) != quantity or quantity < 0:
+                mismatches.append(product_id)
+                self.stderr.write("Product #{}: quantity {} (expected {}), reserved {} (expected {}), ledger {}".format(
+                    product_id, quantity, expected_quantity, reserved_quantity, expected_reservation,
+                    ledger.get(product_id)))
+
+        return mismatches
+
+    def handle(self, *args, **options):
+        unit, products, processings = self._generate(options)
+        pool = None
+
+        arguments = [(processing_id, options['attempts']) for processing_id in processings]
+
+        try:
+            started = time.time()
+
+            if options['processes'] == 1:
+                results = [_close(argument) for argument in arguments]
+            else:
+                # Forked processes must not share the database connections of the parent
+                _close_connections()
+
+                pool = multiprocessing.Pool(options['processes'], initializer=_close_connections)
+                results = list(pool.imap_unordered(_close, arguments))
+
+            elapsed = time.time() - started
+
+            closed = [duration for status, duration in results if status == 'closed']
+            failed = len([status for status, _ in results if status == 'failed'])
+            mismatches = self._verify(products, processings)
+
+            self.stdout.write("{} processing(s) closed, {} rejected, {} failed in {:.2f} s: {:.1f} closes/s, "
+                              "{:.1f} ms per close".format(
+                                  len(closed), len(results) - len(closed) - failed, failed, elapsed,
+                                  len(closed) / elapsed if elapsed else 0,
+                                  1000 * sum(closed) / len(closed) if closed else 0))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            if not options['keep']:
+                ProductsProcessing.objects.filter(pk__in=processings).delete()
+                Product.objects.filter(unit=unit).delete()
+                unit.delete()
+
+        if mismatches:
+            raise CommandError("{} product(s) do not match the closed processings".format(len(mismatches)))
+
+        self.stdout.write("All quantities match the closed processings")
@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from warehouse.models import Product, StockMovement
+
+
+class Command(BaseCommand):
+    help = ("Verifies that the quantity of every product matches its stock ledger. Products whose ledger has no "
+            "opening movement are only reported, open their ledgers with open_stock_ledger first.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help="Overwrite the mismatching product quantities with the ledger quantities"),
+    )
+
+    def handle(self, *args, **options):
+        ledger = dict(StockMovement.objects.values_list('product').annotate(Sum('quantity_change')))
+        opened = set(StockMovement.objects.filter(processing__isnull=True).values_list('product', flat=True))
+        mismatches = []
+        unopened = 0
+
+        for product_id, name, quantity in Product.objects.values_list('id', 'name', 'quantity'):
+            if product_id not in opened:
+                unopened += 1
+                self.stdout.write(u"{} (#{}): ledger not opened".format(name, product_id))
+                continue
+
+            ledger_quantity = ledger.get(product_id) or 0
+
+            if quantity != ledger_quantity:
+                mismatches.append((product_id, ledger_quantity))
+                self.stdout.write(u"{} (#{}): quantity {}, ledger {}".format(name, product_id, quantity,
+                                                                             ledger_quantity))
+
+        if options['rebuild']:
+            with transaction.atomic():
+                for product_id, ledger_quantity in mismatches:
+                    Product.objects.filter(pk=product_id).update(quantity=ledger_quantity)
+
+        self.stdout.write("{} product(s) mismatched{}".format(len(mismatches), ", rebuilt" if options['rebuild'] and mismatches else ""))
+
+        if unopened:
+            self.stdout.write("{} product(s) skipped without an opened ledger, run open_stock_ledger".format(unopened))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('quantity', models.DecimalField(default=b'0.00', max_digits=10, decimal_places=3)),
+                ('price', models.DecimalField(default=b'0.00', max_digits=10, decimal_places=2)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ProductProcessingNode',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('quantity_change', models.DecimalField(default=b'0.000', max_digits=10, decimal_places=3)),
+                ('custom_price', models.DecimalField(null=True, max_digits=10, decimal_places=2, blank=True)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ProductsProcessing',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.TextField(null=True, blank=True)),
+                ('type', models.CharField(max_length=2, choices=[(b'', b'Choose the type'), (b'RS', b'Release'), (b'AN', b'Admission')])),
+                ('closed', models.BooleanField(default=False, verbose_name=b'Status')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Unit',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=32)),
+                ('slug', models.CharField(max_length=6)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Warehouse',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='productprocessingnode',
+            name='processing',
+            field=models.ForeignKey(related_name='nodes', to='warehouse.ProductsProcessing'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='productprocessingnode',
+            name='product',
+            field=models.ForeignKey(related_name='nodes', to='warehouse.Product'),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='productprocessingnode',
+            unique_together=set([('product', 'processing')]),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='unit',
+            field=models.ForeignKey(to='warehouse.Unit'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='warehouses',
+            field=models.ManyToManyField(to='warehouse.Warehouse'),
+            preserve_default=True,
+        ),
+    ]
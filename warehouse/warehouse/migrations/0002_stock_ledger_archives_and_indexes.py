@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Adds the warehouse stock, the stock ledger, the archives, the audit log, the closing jobs, the search index and the
+monthly summaries, together with the reserved quantities, the warehouses and the frozen total costs of processings
+and the indexes of the filtered and sorted columns.
+
+Upgrading an installation created before the migrations: its tables match 0001_initial, which "manage.py migrate"
+then marks as applied without running it (or run "manage.py migrate warehouse 0001 --fake" first), before applying
+the rest. 0003_reserved_quantities computes the reserved quantities. The other new data is built by management
+commands afterwards:
+
+    manage.py open_stock_ledger            # opening movements of the stock ledger
+    manage.py seed_warehouse_stock         # stock per warehouse, --warehouse for products in several of them
+    manage.py backfill_monthly_summaries   # monthly summaries of the processings closed so far
+    manage.py rebuild_search_index         # search index of the processings
+
+Processings closed before the upgrade have no frozen total cost, so they keep being valued at the current prices.
+"""
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+import warehouse.models
+import django.db.models.deletion
+from django.conf import settings
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0001_initial'),
+        ('warehouse', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedProcessing',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.TextField(null=True, blank=True)),
+                ('type', models.CharField(max_length=2, choices=[(b'', b'Choose the type'), (b'RS', b'Release'), (b'AN', b'Admission')])),
+                ('closed_total_cost', models.DecimalField(null=True, max_digits=20, decimal_places=2, blank=True)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('modified', models.DateTimeField()),
+                ('archived', models.DateTimeField()),
+                ('warehouse', models.ForeignKey(related_name='archived_processings', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to='warehouse.Warehouse', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ArchivedProcessingNode',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('quantity_change', models.DecimalField(max_digits=10, decimal_places=3)),
+                ('custom_price', models.DecimalField(null=True, max_digits=10, decimal_places=2, blank=True)),
+                ('created', models.DateTimeField()),
+                ('modified', models.DateTimeField()),
+                ('processing', models.ForeignKey(related_name='nodes', to='warehouse.ArchivedProcessing')),
+                ('product', models.ForeignKey(related_name='archived_nodes', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, to='warehouse.Product')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='AuditEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('action', models.CharField(max_length=1, choices=[(b'C', b'Created'), (b'U', b'Changed'), (b'D', b'Deleted')])),
+                ('object_id', models.PositiveIntegerField()),
+                ('quantity_change', models.DecimalField(null=True, max_digits=10, decimal_places=3, blank=True)),
+                ('changes', models.TextField(help_text=b'JSON object of the changed fields with their previous and new values', blank=True)),
+                ('comment', models.CharField(max_length=255, blank=True)),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('processing', models.ForeignKey(related_name='audit_entries', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to='warehouse.ProductsProcessing', null=True)),
+                ('product', models.ForeignKey(related_name='audit_entries', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to='warehouse.Product', null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'audit entries',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ClosingJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(default=b'Q', max_length=1, choices=[(b'Q', b'Queued'), (b'R', b'Running'), (b'D', b'Done'), (b'F', b'Failed')])),
+                ('progress', models.PositiveSmallIntegerField(default=0, help_text=b'Percentage of the close done')),
+                ('message', models.CharField(max_length=255, blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started', models.DateTimeField(null=True, blank=True)),
+                ('heartbeat', models.DateTimeField(help_text=b'Last time the worker has shown it is alive', null=True, blank=True)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('processing', models.ForeignKey(related_name='closing_jobs', to='warehouse.ProductsProcessing')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='MonthlyProductSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('type', models.CharField(max_length=2, choices=[(b'', b'Choose the type'), (b'RS', b'Release'), (b'AN', b'Admission')])),
+                ('quantity_change', models.DecimalField(default=b'0.000', max_digits=15, decimal_places=3)),
+                ('product', models.ForeignKey(related_name='monthly_summaries', to='warehouse.Product')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ProcessingSearchToken',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('token', models.CharField(max_length=64)),
+                ('processing', models.ForeignKey(related_name='search_tokens', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, to='warehouse.ProductsProcessing')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ReviewArchive',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('year', models.PositiveIntegerField(unique=True)),
+                ('requested', models.DateTimeField(default=django.utils.timezone.now)),
+                ('built', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('quantity_change', models.DecimalField(max_digits=10, decimal_places=3)),
+                ('balance', models.DecimalField(max_digits=10, decimal_places=3)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('processing', models.ForeignKey(related_name='movements', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to='warehouse.ProductsProcessing', null=True)),
+                ('product', models.ForeignKey(related_name='movements', to='warehouse.Product')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('taken', models.DateTimeField()),
+                ('quantity', models.DecimalField(max_digits=10, decimal_places=3)),
+                ('product', models.ForeignKey(related_name='snapshots', to='warehouse.Product')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='WarehouseStock',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('quantity', models.DecimalField(default=b'0.000', max_digits=10, decimal_places=3)),
+                ('product', models.ForeignKey(related_name='warehouse_stocks', to='warehouse.Product')),
+                ('warehouse', models.ForeignKey(related_name='stocks', to='warehouse.Warehouse')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='warehousestock',
+            unique_together=set([('product', 'warehouse')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stocksnapshot',
+            unique_together=set([('taken', 'product')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='stockmovement',
+            index_together=set([('product', 'created')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='processingsearchtoken',
+            unique_together=set([('token', 'processing')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlyproductsummary',
+            unique_together=set([('year', 'month', 'type', 'product')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='closingjob',
+            index_together=set([('status', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='auditentry',
+            index_together=set([('product', 'created'), ('processing', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedprocessing',
+            index_together=set([('type', 'created')]),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='reserved_quantity',
+            field=models.DecimalField(default=b'0.000', editable=False, max_digits=10, decimal_places=3),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='productsprocessing',
+            name='closed_total_cost',
+            field=models.DecimalField(null=True, editable=False, max_digits=20, decimal_places=2, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='productsprocessing',
+            name='warehouse',
+            field=models.ForeignKey(related_name='processings', blank=True, to='warehouse.Warehouse', help_text=b'Warehouse the products are admitted to or released from', null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='name',
+            field=models.CharField(max_length=255, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='unit',
+            field=warehouse.models.CachedForeignKey(to='warehouse.Unit'),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='productsprocessing',
+            name='created',
+            field=django_extensions.db.fields.CreationDateTimeField(default=django.utils.timezone.now, db_index=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
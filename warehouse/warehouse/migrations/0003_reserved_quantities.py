@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def compute_reserved_quantities(apps, schema_editor):
+    "Reserves the quantities of the open releases, like Product.objects.refresh_reservations()"
+    Product = apps.get_model('warehouse', 'Product')
+    ProductProcessingNode = apps.get_model('warehouse', 'ProductProcessingNode')
+
+    reservations = (ProductProcessingNode.objects.filter(processing__type='RS', processing__closed=False)
+                    .values_list('product').annotate(reservation=models.Sum('quantity_change')))
+
+    for product_id, reservation in reservations:
+        Product.objects.filter(pk=product_id).update(reserved_quantity=reservation)
+
+
+def keep_reserved_quantities(apps, schema_editor):
+    "The reserved_quantity column is dropped by the reversed 0002 migration"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0002_stock_ledger_archives_and_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(compute_reserved_quantities, keep_reserved_quantities),
+    ]
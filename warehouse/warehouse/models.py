@@ -1,24 +1,145 @@
-from decimal import Context, Decimal
-
-from django.db import models
+import json
+import threading
+import uuid
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache, caches
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models
+from django.db.models import Max, Sum
+from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django_extensions.db import fields
 
-import reversion
+class WarehouseQuerySet(models.QuerySet):
+    def with_stock_totals(self):
+        """
+        Annotates every warehouse with products_total, the number of products in stock, and stock_value_total
+        computed by the database. Products not tracked per warehouse yet are counted in the warehouses they are
+        linked to.
+        """
+        return self.extra(select={
+            'products_total': "(SELECT COUNT(*) FROM warehouse_warehousestock AS ws "
+                              "WHERE ws.warehouse_id = warehouse_warehouse.id AND ws.quantity > 0) + "
+                              "(SELECT COUNT(*) FROM warehouse_product_warehouses AS pw "
+                              "WHERE pw.warehouse_id = warehouse_warehouse.id AND NOT EXISTS "
+                              "(SELECT 1 FROM warehouse_warehousestock AS tracked WHERE tracked.product_id = pw.product_id))",
+            'stock_value_total': "SELECT SUM(ws.quantity * p.price) FROM warehouse_warehousestock AS ws "
+                                 "INNER JOIN warehouse_product AS p ON p.id = ws.product_id "
+                                 "WHERE ws.warehouse_id = warehouse_warehouse.id"
+        })
+
 
 class Warehouse(models.Model):
+    objects = WarehouseQuerySet.as_manager()
+
     name = models.CharField(max_length=255)
 
     created = fields.CreationDateTimeField()
     modified = fields.ModificationDateTimeField()
 
     def products_count(self):
-        return self.product_set.count()
+        if hasattr(self, 'products_total'):
+            return self.products_total
+
+        return self.stocks.filter(quantity__gt=0).count() + \
+            self.product_set.filter(warehouse_stocks__isnull=True).count()
+
+    def stock_value(self):
+        if not hasattr(self, 'stock_value_total'):
+            self.stock_value_total = Warehouse.objects.with_stock_totals().filter(pk=self.pk) \
+                .values_list('stock_value_total', flat=True)[0]
+
+        return "{0:.2f} PLN".format(self.stock_value_total or 0)
 
     def __str__(self):
         return self.name
 
 
+UNIT_CACHE_VERSION_KEY = 'warehouse:units:version'
+
+
+class UnitManager(models.Manager):
+    """
+    Keeps all units of the process in memory, keyed by id, as the table is tiny and almost never changes. The whole
+    table is loaded at the first lookup. Changes of units clear the memory and store a new version in the shared cache
+    given by WAREHOUSE_UNIT_CACHE, which other processes compare with their own at the start of every request. A change
+    made in a transaction is announced once the transaction has ended, so no process keeps the units loaded before the
+    change is committed.
+    """
+
+    def __init__(self):
+        super(UnitManager, self).__init__()
+        self._units = None
+        self._version = None
+        self._pending = threading.local()
+
+    def _shared_cache(self):
+        alias = getattr(settings, 'WAREHOUSE_UNIT_CACHE', None)
+
+        return caches[alias] if alias else None
+
+    def get_cached(self, pk):
+        "Returns the unit with the given id from memory. The returned instance is shared, so it must not be modified."
+        self.publish_pending()
+        units = self._units
+
+        if units is None or pk not in units:
+            units = self._units = dict((unit.pk, unit) for unit in self.get_queryset())
+
+        try:
+            return units[pk]
+        except KeyError:
+            raise self.model.DoesNotExist("Unit {} does not exist".format(pk))
+
+    def invalidate(self, using=DEFAULT_DB_ALIAS):
+        """
+        Clears the units in memory and makes other processes clear theirs. In a transaction, the memory is cleared again
+        and other processes are told once it has ended, as units may be loaded from it until then.
+        """
+        self._units = None
+
+        if connections[using].in_atomic_block:
+            self._pending.using = using
+            return
+
+        shared_cache = self._shared_cache()
+
+        if shared_cache is not None:
+            self._version = uuid.uuid4().hex
+            shared_cache.set(UNIT_CACHE_VERSION_KEY, self._version, None)
+
+    def publish_pending(self):
+        "Announces the change of units deferred by the transaction of the current thread, when it has ended"
+        using = getattr(self._pending, 'using', None)
+
+        if using is not None and not connections[using].in_atomic_block:
+            self._pending.using = None
+            self.invalidate(using)
+
+    def synchronize(self):
+        "Clears the units in memory when another process has changed them"
+        self.publish_pending()
+        shared_cache = self._shared_cache()
+
+        if shared_cache is None:
+            return
+
+        version = shared_cache.get(UNIT_CACHE_VERSION_KEY)
+
+        if version != self._version:
+            self._units = None
+            self._version = version
+
+
 class Unit(models.Model):
+    objects = UnitManager()
+
     name = models.CharField(max_length=32)
     slug = models.CharField(max_length=6)
 
@@ -29,12 +150,70 @@ class Unit(models.Model):
         return "{} ({})".format(self.slug, self.name)
 
 
+class CachedRelatedObjectDescriptor(ReverseSingleRelatedObjectDescriptor):
+    def __get__(self, instance, instance_type=None):
+        if instance is None or hasattr(instance, self.cache_name):
+            return super(CachedRelatedObjectDescriptor, self).__get__(instance, instance_type)
+
+        pk = getattr(instance, self.field.attname)
+
+        if pk is None:
+            return super(CachedRelatedObjectDescriptor, self).__get__(instance, instance_type)
+
+        related = self.field.rel.to._default_manager.get_cached(pk)
+        setattr(instance, self.cache_name, related)
+
+        return related
+
+
+class CachedForeignKey(models.ForeignKey):
+    "Foreign key resolving the related object with get_cached() of the default manager of the related model"
+
+    def contribute_to_class(self, cls, name, virtual_only=False):
+        super(CachedForeignKey, self).contribute_to_class(cls, name, virtual_only)
+        setattr(cls, self.name, CachedRelatedObjectDescriptor(self))
+
+
+class ProductManager(models.Manager):
+    def refresh_reservations(self, product_ids=None):
+        """
+        Recomputes the stored reserved quantity of the given products (all of them by default) with a single UPDATE
+        """
+        if product_ids is not None:
+            product_ids = [product_id for product_id in set(product_ids) if product_id is not None]
+
+            if not product_ids:
+                return
+
+        sql = (
+            "UPDATE {product} SET "
+            "reserved_quantity = COALESCE((SELECT SUM(ppn.quantity_change) FROM {node} AS ppn "
+            "INNER JOIN {processing} AS pp ON pp.id = ppn.processing_id "
+            "WHERE ppn.product_id = {product}.id AND pp.type = %s AND pp.closed = %s), 0)"
+        ).format(
+            product=Product._meta.db_table,
+            node=ProductProcessingNode._meta.db_table,
+            processing=ProductsProcessing._meta.db_table
+        )
+        params = [ProductsProcessing.PROCESSING_RELEASE, False]
+
+        if product_ids is not None:
+            sql += " WHERE id IN ({})".format(", ".join(["%s"] * len(product_ids)))
+            params += product_ids
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+
 class Product(models.Model):
+    objects = ProductManager()
+
     warehouses = models.ManyToManyField(Warehouse)
 
-    name = models.CharField(max_length=255)
-    unit = models.ForeignKey(Unit)
+    name = models.CharField(max_length=255, db_index=True)
+    unit = CachedForeignKey(Unit)
     quantity = models.DecimalField(max_digits=10, decimal_places=3, default='0.00')
+    reserved_quantity = models.DecimalField(max_digits=10, decimal_places=3, default='0.000', editable=False)
 
     price = models.DecimalField(max_digits=10, decimal_places=2, default='0.00')
 
@@ -48,25 +227,75 @@ class Product(models.Model):
         return "{} PLN".format(self.price)
 
     def reservation_amount(self):
-        return "{} {}".format(self.reservation(), self.unit.slug)
+        return "{} {}".format(self.reserved_quantity, self.unit.slug)
+
+    def warehouse_quantities(self):
+        "Returns the quantities of the product stored in every warehouse, keyed by warehouse id"
+        return dict(self.warehouse_stocks.values_list('warehouse', 'quantity'))
 
     def reservation(self):
+        "Computes the reserved quantity from the open releases. The stored reserved_quantity is kept equal to it."
         nodes = self.nodes.filter(processing__type=ProductsProcessing.PROCESSING_RELEASE, processing__closed=False)
-        quantity_changes = [product_processing_node.quantity_change for product_processing_node in nodes]
 
-        return sum(quantity_changes)
+        return nodes.aggregate(reservation=Sum('quantity_change'))['reservation'] or 0
 
     def __str__(self):
         return self.name
 
 
-class ProductsProcessingManager(models.Manager):
+class ProductsProcessingQuerySet(models.QuerySet):
+    # Custom price of zero falls back to the product price, just like ProductProcessingNode.total_cost() does
+    TOTAL_COST_SQL = (
+        "SELECT SUM(ppn.quantity_change * COALESCE(NULLIF(ppn.custom_price, 0), p.price)) "
+        "FROM warehouse_productprocessingnode AS ppn INNER JOIN warehouse_product AS p ON p.id = ppn.product_id "
+        "WHERE ppn.processing_id = warehouse_productsprocessing.id"
+    )
+
+    def with_total_cost(self):
+        """
+        Annotates every processing with total_cost_value computed by the database. Closed processings read the
+        total frozen at closing time instead of summing their nodes again.
+        """
+        return self.extra(select={
+            'total_cost_value': "COALESCE(warehouse_productsprocessing.closed_total_cost, ({}))".format(self.TOTAL_COST_SQL)
+        })
+
+    def with_closing_jobs(self):
+        "Annotates every processing with closing_jobs_count, the number of its queued and running background closes"
+        return self.extra(select={
+            'closing_jobs_count': "SELECT COUNT(*) FROM warehouse_closingjob AS cj "
+                                  "WHERE cj.processing_id = warehouse_productsprocessing.id AND cj.status IN (%s, %s)"
+        }, select_params=ClosingJob.ACTIVE_STATUSES)
+
+
+class ProductsProcessingManager(models.Manager.from_queryset(ProductsProcessingQuerySet)):
+    REVIEWS_CACHE_KEY = 'warehouse:productsprocessing:reviews'
+
     def reviews(self):
-        return set([(d['created'].year, d['created'].month) for d in ProductsProcessing.objects.values('created')])
+        """
+        Returns the sorted (year, month) periods having closed processings. The distinct periods are read from the
+        monthly summaries index and cached until the summaries change, or for WAREHOUSE_REVIEWS_CACHE_TIMEOUT seconds
+        at most, as the caches of other processes are not cleared by the changes made in this one.
+        """
+        reviews = cache.get(self.REVIEWS_CACHE_KEY)
 
-    def __get_review(self, year, month, op_type):
-        return Product.objects.raw("SELECT p.id, p.name, SUM(ppn.quantity_change) AS `change` FROM warehouse_product AS p LEFT JOIN warehouse_productprocessingnode AS ppn ON ppn.product_id = p.id LEFT JOIN warehouse_productsprocessing AS pp ON pp.id = ppn.processing_id WHERE pp.closed = 1 AND pp.type = %s AND YEAR(pp.created) = %s AND MONTH(pp.created) = %s GROUP BY p.name ORDER BY p.name ASC", [op_type, year, month])
+        if reviews is None:
+            reviews = list(MonthlyProductSummary.objects.values_list('year', 'month').distinct().order_by('year', 'month'))
+
+            cache.set(self.REVIEWS_CACHE_KEY, reviews, getattr(settings, 'WAREHOUSE_REVIEWS_CACHE_TIMEOUT', 300))
 
+        return reviews
+
+    def invalidate_reviews(self):
+        "Clears the cached review periods, after the monthly summaries have been changed"
+        cache.delete(self.REVIEWS_CACHE_KEY)
+
+    def __get_review(self, year, month, op_type):
+        return Product.objects \
+            .filter(monthly_summaries__year=year, monthly_summaries__month=month, monthly_summaries__type=op_type) \
+            .values('name') \
+            .annotate(change=Sum('monthly_summaries__quantity_change')) \
+            .order_by('name')
 
     def review_for_month(self, year, month):
         return { 
@@ -89,25 +318,32 @@ class ProductsProcessing(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     type = models.CharField(choices=PROCESSING_TYPES, max_length=2)
+    warehouse = models.ForeignKey(Warehouse, related_name="processings", blank=True, null=True,
+                                  help_text="Warehouse the products are admitted to or released from")
 
     closed = models.BooleanField(default=False, verbose_name="Status")
+    closed_total_cost = models.DecimalField(max_digits=20, decimal_places=2, blank=True, null=True, editable=False)
 
-    created = fields.CreationDateTimeField()
+    created = fields.CreationDateTimeField(db_index=True)
     modified = fields.ModificationDateTimeField()
 
     def __str__(self):
         return self.name
 
     def total_cost_amount(self):
-        if self.nodes.all().count() > 0:
-            return "{} PLN".format(self.total_cost())
+        if not hasattr(self, 'total_cost_value'):
+            self.total_cost_value = ProductsProcessing.objects.with_total_cost().filter(pk=self.pk) \
+                .values_list('total_cost_value', flat=True)[0]
+
+        if self.total_cost_value is not None:
+            return "{0:.2f} PLN".format(self.total_cost_value)
         else:
             return "(None)"
 
     total_cost_amount.short_description = "Total"
 
     def total_cost(self):
-        return "{0:.2f}".format(sum([ppn.total_cost() for ppn in self.nodes.all()]))
+        return "{0:.2f}".format(sum([ppn.total_cost() for ppn in self.nodes.select_related('product')]))
 
     def is_release(self):
         return self.type == self.PROCESSING_RELEASE
@@ -115,27 +351,27 @@ class ProductsProcessing(models.Model):
     def is_admission(self):
         return self.type == self.PROCESSING_ADMISSION
 
+    def is_closing(self):
+        "Checks whether the processing waits for a background close or is being closed by one"
+        if hasattr(self, 'closing_jobs_count'):
+            return self.closing_jobs_count > 0
+
+        return self.closing_jobs.filter(status__in=ClosingJob.ACTIVE_STATUSES).exists()
+
     def clean_for_processing(self):
         if self.closed:
             return False
 
-        for product_node in self.nodes.all():
-            if not product_node.clean_for_processing():
-                return False
+        from .closing import ProcessingsClosing
 
-        return True
+        return ProcessingsClosing([self]).is_clean()
 
     def close(self):
-        self.closed = True
-
-        self._perform_nodes_operation(self.type)
+        from .closing import ProcessingsClosing
 
-    def _perform_nodes_operation(self, processing_type):
-        for product_node in self.nodes.all():
-            if processing_type == self.PROCESSING_ADMISSION:
-                product_node.perform_admission()
-            else:
-                product_node.perform_release()
+        closing = ProcessingsClosing([self])
+        closing.close()
+        closing.invalidate_reviews()
 
 
 class ProductProcessingNode(models.Model):
@@ -161,10 +397,10 @@ class ProductProcessingNode(models.Model):
         return self.processing.is_release()
 
     def total_cost(self):
-        return Context().multiply(Decimal(self.quantity_change), Decimal(self.custom_price or self.product.price))
+        return Decimal(self.quantity_change) * Decimal(self.custom_price or self.product.price)
 
     def total_cost_amount(self):
-        return "{0:.2f}".format(Context().multiply(Decimal(self.quantity_change), Decimal(self.custom_price or self.product.price)))
+        return "{0:.2f}".format(self.total_cost())
 
     def clean_for_processing(self):
         "Check whether the node is eglible for processing. If Processing is Release, check if the quality allows it. If not, return True. Admission does not need to be checked for quantity."
@@ -182,4 +418,377 @@ class ProductProcessingNode(models.Model):
 
     def perform_release(self):
         self.product.quantity = Decimal(self.product.quantity) - Decimal(self.quantity_change)
-        self.product.save()
\ No newline at end of file
+        self.product.save()
+
+
+class MonthlyProductSummary(models.Model):
+    """
+    Quantity changes of closed processings summed per month (in UTC), product and processing type
+    """
+
+    class Meta:
+        unique_together = ('year', 'month', 'type', 'product')
+
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    type = models.CharField(choices=ProductsProcessing.PROCESSING_TYPES, max_length=2)
+    product = models.ForeignKey(Product, related_name="monthly_summaries")
+
+    quantity_change = models.DecimalField(max_digits=15, decimal_places=3, default='0.000')
+
+    @staticmethod
+    def period_of(value):
+        "Returns the (year, month) a datetime belongs to. Periods are always computed in UTC."
+        if timezone.is_aware(value):
+            value = value.astimezone(timezone.utc)
+
+        return value.year, value.month
+
+
+class WarehouseStock(models.Model):
+    "Quantity of a product stored in a warehouse, moved by the processings of that warehouse"
+
+    class Meta:
+        unique_together = ('product', 'warehouse')
+
+    product = models.ForeignKey(Product, related_name="warehouse_stocks")
+    warehouse = models.ForeignKey(Warehouse, related_name="stocks")
+
+    quantity = models.DecimalField(max_digits=10, decimal_places=3, default='0.000')
+
+
+class StockMovementManager(models.Manager):
+    def quantity_at(self, product, moment):
+        "Returns the quantity of a single product at the given moment with one indexed lookup"
+        balances = self.filter(product=product, created__lte=moment).order_by('-created', '-id') \
+            .values_list('balance', flat=True)[:1]
+
+        return balances[0] if balances else 0
+
+    def quantities_at(self, moment):
+        """
+        Returns the quantities of all products at the given moment, as a dictionary keyed by product id. Quantities
+        are taken from the last snapshot before the moment, plus the movements recorded between the two.
+        """
+        quantities = {}
+        movements = self.filter(created__lte=moment)
+        taken = StockSnapshot.objects.filter(taken__lte=moment).aggregate(taken=Max('taken'))['taken']
+
+        if taken is not None:
+            quantities = dict(StockSnapshot.objects.filter(taken=taken).values_list('product', 'quantity'))
+            movements = movements.filter(created__gt=taken)
+
+        for product_id, quantity_change in movements.values_list('product').annotate(Sum('quantity_change')):
+            quantities[product_id] = quantities.get(product_id, 0) + quantity_change
+
+        return quantities
+
+
+class StockMovement(models.Model):
+    """
+    Append-only ledger of product quantity changes. Every movement stores the resulting quantity of its product, so
+    the quantity at any moment is the balance of the last movement before it. Movements without a processing open
+    the ledger of a product.
+    """
+    objects = StockMovementManager()
+
+    class Meta:
+        index_together = (('product', 'created'),)
+
+    product = models.ForeignKey(Product, related_name="movements")
+    processing = models.ForeignKey(ProductsProcessing, related_name="movements", blank=True, null=True,
+                                   on_delete=models.DO_NOTHING, db_constraint=False)
+
+    quantity_change = models.DecimalField(max_digits=10, decimal_places=3)
+    balance = models.DecimalField(max_digits=10, decimal_places=3)
+
+    created = models.DateTimeField(db_index=True)
+
+
+class StockSnapshot(models.Model):
+    "Quantities of all products at a given moment, computed from the ledger"
+
+    class Meta:
+        unique_together = ('taken', 'product')
+
+    taken = models.DateTimeField()
+    product = models.ForeignKey(Product, related_name="snapshots")
+
+    quantity = models.DecimalField(max_digits=10, decimal_places=3)
+
+
+class ArchivedProcessing(models.Model):
+    """
+    Closed processing moved out of the processings table by the archive_processings command. It keeps its primary
+    key, so the ledger movements and audit entries of the processing still point to it. Its total cost is frozen.
+    """
+
+    class Meta:
+        index_together = (('type', 'created'),)
+
+    id = models.IntegerField(primary_key=True)
+
+    name = models.CharField(max_length=255)
+    description = models.TextField(blank=True, null=True)
+    type = models.CharField(choices=ProductsProcessing.PROCESSING_TYPES, max_length=2)
+    warehouse = models.ForeignKey(Warehouse, related_name="archived_processings", blank=True, null=True,
+                                  on_delete=models.DO_NOTHING, db_constraint=False)
+
+    closed_total_cost = models.DecimalField(max_digits=20, decimal_places=2, blank=True, null=True)
+
+    created = models.DateTimeField(db_index=True)
+    modified = models.DateTimeField()
+    archived = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+    def total_cost_amount(self):
+        if self.closed_total_cost is not None:
+            return "{0:.2f} PLN".format(self.closed_total_cost)
+        else:
+            return "(None)"
+
+    total_cost_amount.short_description = "Total"
+
+
+class ArchivedProcessingNode(models.Model):
+    "Node of an archived processing, keeping the primary key it had among the nodes"
+
+    id = models.IntegerField(primary_key=True)
+
+    processing = models.ForeignKey(ArchivedProcessing, related_name="nodes")
+    product = models.ForeignKey(Product, related_name="archived_nodes", on_delete=models.DO_NOTHING,
+                                db_constraint=False)
+
+    quantity_change = models.DecimalField(max_digits=10, decimal_places=3)
+    custom_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+
+
+class ClosingJob(models.Model):
+    """
+    Close of a processing handed off to the process_closing_jobs worker. The worker reports its progress in the row,
+    so it can be polled while the close runs.
+    """
+    STATUS_QUEUED = 'Q'
+    STATUS_RUNNING = 'R'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+
+    STATUSES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    class Meta:
+        index_together = (('status', 'created'),)
+
+    processing = models.ForeignKey(ProductsProcessing, related_name="closing_jobs")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.SET_NULL)
+
+    status = models.CharField(choices=STATUSES, max_length=1, default=STATUS_QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0, help_text="Percentage of the close done")
+    message = models.CharField(max_length=255, blank=True)
+
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True, help_text="Last time the worker has shown it is alive")
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def is_active(self):
+        return self.status in self.ACTIVE_STATUSES
+
+
+class ReviewArchive(models.Model):
+    """
+    Request of the ZIP archive of the reviews of a year, built into the review storage by the export_reviews command.
+    built is the request time the stored archive answers, so an archive requested again is built again.
+    """
+    year = models.PositiveIntegerField(unique=True)
+
+    requested = models.DateTimeField(default=timezone.now)
+    built = models.DateTimeField(blank=True, null=True)
+
+    def is_pending(self):
+        return self.built is None or self.built < self.requested
+
+
+class ProcessingSearchToken(models.Model):
+    """
+    Normalized token of the name of a processing or of one of its products, maintained by the search module. The
+    tokens of a processing are removed by a signal when it is deleted, so the table has no constraint.
+    """
+
+    class Meta:
+        unique_together = ('token', 'processing')
+
+    token = models.CharField(max_length=64)
+    processing = models.ForeignKey(ProductsProcessing, related_name="search_tokens", on_delete=models.DO_NOTHING,
+                                   db_constraint=False)
+
+
+class AuditEntry(models.Model):
+    """
+    Narrow audit trail of processings, their nodes and products. An entry stores only the changed fields with their
+    previous and new values and the quantity delta, together with who made the change and the processing and product
+    it concerns. Entries outlive the objects they describe.
+    """
+    ACTION_CREATED = 'C'
+    ACTION_CHANGED = 'U'
+    ACTION_DELETED = 'D'
+
+    ACTIONS = (
+        (ACTION_CREATED, 'Created'),
+        (ACTION_CHANGED, 'Changed'),
+        (ACTION_DELETED, 'Deleted'),
+    )
+
+    class Meta:
+        index_together = (('processing', 'created'), ('product', 'created'))
+        verbose_name_plural = "audit entries"
+
+    created = models.DateTimeField(db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.SET_NULL)
+    action = models.CharField(choices=ACTIONS, max_length=1)
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    processing = models.ForeignKey(ProductsProcessing, related_name="audit_entries", blank=True, null=True,
+                                   on_delete=models.DO_NOTHING, db_constraint=False)
+    product = models.ForeignKey(Product, related_name="audit_entries", blank=True, null=True,
+                                on_delete=models.DO_NOTHING, db_constraint=False)
+
+    quantity_change = models.DecimalField(max_digits=10, decimal_places=3, blank=True, null=True)
+    changes = models.TextField(blank=True, help_text="JSON object of the changed fields with their previous and new values")
+    comment = models.CharField(max_length=255, blank=True)
+
+    def changed_fields(self):
+        "Returns the changes as sorted (field, previous value, new value) triples"
+        if not self.changes:
+            return []
+
+        return sorted((field, values[0], values[1]) for field, values in json.loads(self.changes).items())
+
+
+@receiver(post_save, sender=Product)
+def open_product_ledger(sender, instance, created, raw=False, **kwargs):
+    # Every product gets an opening movement, even an empty one, so its ledger can be verified
+    if created and not raw:
+        StockMovement.objects.create(product=instance, quantity_change=instance.quantity, balance=instance.quantity,
+                                     created=instance.created)
+
+
+@receiver(post_init, sender=ProductProcessingNode)
+def remember_node_product(sender, instance, **kwargs):
+    instance._loaded_product_id = instance.product_id
+
+
+@receiver(post_save, sender=ProductProcessingNode)
+def refresh_node_reservations(sender, instance, **kwargs):
+    Product.objects.refresh_reservations([instance.product_id, instance._loaded_product_id])
+
+    instance._loaded_product_id = instance.product_id
+
+
+@receiver(post_delete, sender=ProductProcessingNode)
+def refresh_deleted_node_reservations(sender, instance, **kwargs):
+    Product.objects.refresh_reservations([instance.product_id])
+
+
+@receiver(post_save, sender=ProductsProcessing)
+def refresh_processing_reservations(sender, instance, created, **kwargs):
+    if not created:
+        Product.objects.refresh_reservations(instance.nodes.values_list('product_id', flat=True))
+
+
+@receiver(post_init, sender=Product)
+@receiver(post_init, sender=ProductsProcessing)
+@receiver(post_init, sender=ProductProcessingNode)
+def remember_audited_values(sender, instance, **kwargs):
+    from .audit import remember_values
+
+    remember_values(instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductsProcessing)
+@receiver(post_save, sender=ProductProcessingNode)
+def audit_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if not raw:
+        from .audit import record_change
+
+        record_change(instance, AuditEntry.ACTION_CREATED if created else AuditEntry.ACTION_CHANGED, update_fields)
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductsProcessing)
+@receiver(post_delete, sender=ProductProcessingNode)
+def audit_deleted(sender, instance, **kwargs):
+    from .audit import record_change
+
+    record_change(instance, AuditEntry.ACTION_DELETED)
+
+
+@receiver(post_init, sender=Product)
+@receiver(post_init, sender=ProductsProcessing)
+@receiver(post_init, sender=ProductProcessingNode)
+def remember_indexed_value(sender, instance, **kwargs):
+    instance._indexed_value = instance.__dict__.get('product_id' if sender is ProductProcessingNode else 'name')
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductsProcessing)
+@receiver(post_save, sender=ProductProcessingNode)
+def index_saved(sender, instance, created, raw=False, **kwargs):
+    "Reindexes the processings whose tokens the saved instance may have changed"
+    indexed_value = getattr(instance, 'product_id' if sender is ProductProcessingNode else 'name')
+
+    if raw or (not created and indexed_value == instance._indexed_value):
+        return
+
+    from .search import schedule_indexing
+
+    if sender is ProductsProcessing:
+        schedule_indexing([instance.pk])
+    elif sender is ProductProcessingNode:
+        schedule_indexing([instance.processing_id])
+    elif not created:
+        schedule_indexing(product_ids=[instance.pk])
+
+    instance._indexed_value = indexed_value
+
+
+@receiver(post_delete, sender=ProductProcessingNode)
+def index_deleted_node(sender, instance, **kwargs):
+    from .search import schedule_indexing
+
+    schedule_indexing([instance.processing_id])
+
+
+@receiver(post_delete, sender=ProductsProcessing)
+def delete_search_tokens(sender, instance, **kwargs):
+    ProcessingSearchToken.objects.filter(processing=instance.pk).delete()
+
+
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+def invalidate_units(sender, using, **kwargs):
+    Unit.objects.invalidate(using)
+
+
+@receiver(request_started)
+def synchronize_units(sender, **kwargs):
+    Unit.objects.synchronize()
+
+
+@receiver(request_finished)
+def publish_units(sender, **kwargs):
+    Unit.objects.publish_pending()
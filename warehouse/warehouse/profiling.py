@@ -0,0 +1,226 @@
+"""
+Per-request SQL profiling. While a request is profiled, the cursors of all database connections count and time the
+executed statements. Statements executed with the same parameters more than once are duplicates. Statements executed
+at least WAREHOUSE_SQL_PROFILING_N1_THRESHOLD times in one request are N+1 suspects, reported with the project code
+which executed them. The call stack is inspected only once per suspect, so profiling is cheap enough for production.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+ENDPOINTS_CACHE_KEY = 'warehouse:profiling:endpoints'
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_MODULE_PATH = os.path.splitext(os.path.abspath(__file__))[0]
+
+logger = logging.getLogger(__name__)
+
+
+def _caller():
+    "Returns the innermost frame of the project code outside of this module as 'path:line in function'"
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+
+        if filename.startswith(PROJECT_DIR) and os.path.splitext(filename)[0] != _MODULE_PATH \
+                and 'site-packages' not in filename:
+            function = frame.f_code.co_name
+            instance = frame.f_locals.get('self')
+
+            if instance is not None:
+                function = "{}.{}".format(type(instance).__name__, function)
+
+            return "{}:{} in {}".format(os.path.relpath(filename, PROJECT_DIR), frame.f_lineno, function)
+
+        frame = frame.f_back
+
+    return None
+
+
+class QueryProfile(object):
+    "Number, time and repetitions of the statements executed while profiling"
+
+    def __init__(self, threshold=None):
+        if threshold is None:
+            threshold = getattr(settings, 'WAREHOUSE_SQL_PROFILING_N1_THRESHOLD', 3)
+
+        self.threshold = threshold
+        self.count = 0
+        self.time = 0.0
+        self.duplicates = 0
+        self.statements = {}
+        self.executions = set()
+
+    def add(self, sql, params, duration):
+        self.count += 1
+        self.time += duration
+
+        execution = (sql, repr(params))
+
+        if execution in self.executions:
+            self.duplicates += 1
+        else:
+            self.executions.add(execution)
+
+        statement = self.statements.setdefault(sql, [0, 0.0, None])
+        statement[0] += 1
+        statement[1] += duration
+
+        if statement[0] == self.threshold:
+            statement[2] = _caller()
+
+    def suspects(self):
+        "Returns the N+1 suspects as dictionaries, the most executed first"
+        suspects = [{'sql': sql, 'count': count, 'time': round(duration * 1000, 3), 'caller': caller}
+                    for sql, (count, duration, caller) in self.statements.items() if count >= self.threshold]
+
+        return sorted(suspects, key=lambda suspect: -suspect['count'])
+
+    def summary(self):
+        return {
+            'queries': self.count,
+            'time': round(self.time * 1000, 3),
+            'duplicates': self.duplicates,
+            'suspects': self.suspects(),
+        }
+
+
+class ProfilingCursorWrapper(CursorWrapper):
+    def __init__(self, cursor, db, profile):
+        super(ProfilingCursorWrapper, self).__init__(cursor, db)
+        self.profile = profile
+
+    def execute(self, sql, params=None):
+        started = time.time()
+
+        try:
+            return super(ProfilingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.profile.add(sql, params, time.time() - started)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+
+        try:
+            return super(ProfilingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.profile.add(sql, None, time.time() - started)
+
+
+@contextmanager
+def profiling(profile=None):
+    """
+    Profiles the statements executed by the current thread in the block. Connections are per thread, so the cursors
+    of other threads are not affected. Connections logging their queries keep logging them.
+    """
+    profile = profile or QueryProfile()
+    patched = []
+
+    for connection in connections.all():
+        logged = connection.queries_logged
+        make_debug_cursor = connection.make_debug_cursor
+
+        def make_profiling_cursor(cursor, connection=connection, logged=logged, make_debug_cursor=make_debug_cursor):
+            return ProfilingCursorWrapper(make_debug_cursor(cursor) if logged else cursor, connection, profile)
+
+        patched.append((connection, connection.use_debug_cursor))
+        connection.make_debug_cursor = make_profiling_cursor
+        connection.use_debug_cursor = True
+
+    try:
+        yield profile
+    finally:
+        for connection, use_debug_cursor in patched:
+            del connection.make_debug_cursor
+            connection.use_debug_cursor = use_debug_cursor
+
+
+def record_endpoint(endpoint, summary):
+    """
+    Adds the profile of a request to the statistics of its endpoint kept in the cache. Concurrent requests may
+    overwrite each other's update, which is acceptable for statistics.
+    """
+    endpoints = cache.get(ENDPOINTS_CACHE_KEY) or {}
+    statistics = endpoints.setdefault(endpoint, {'requests': 0, 'queries': 0, 'time': 0.0, 'max_queries': 0,
+                                                 'suspects': []})
+
+    statistics['requests'] += 1
+    statistics['queries'] += summary['queries']
+    statistics['time'] += summary['time']
+    statistics['max_queries'] = max(statistics['max_queries'], summary['queries'])
+
+    if summary['suspects']:
+        statistics['suspects'] = summary['suspects']
+
+    cache.set(ENDPOINTS_CACHE_KEY, endpoints, None)
+
+
+def worst_endpoints():
+    "Returns the statistics of the profiled endpoints, the most queries per request first"
+    endpoints = []
+
+    for endpoint, statistics in (cache.get(ENDPOINTS_CACHE_KEY) or {}).items():
+        endpoints.append(dict(statistics, endpoint=endpoint,
+                              average_queries=float(statistics['queries']) / statistics['requests'],
+                              average_time=statistics['time'] / statistics['requests']))
+
+    return sorted(endpoints, key=lambda statistics: (-statistics['average_queries'], -statistics['average_time']))
+
+
+class QueryProfilingMiddleware(object):
+    """
+    Profiles a share of the requests given by WAREHOUSE_SQL_PROFILING_SAMPLE_RATE when WAREHOUSE_SQL_PROFILING is
+    enabled. The results are sent in X-SQL-* response headers, logged as a JSON line by the warehouse.profiling logger
+    and added to the endpoint statistics.
+    """
+
+    def __init__(self):
+        if not getattr(settings, 'WAREHOUSE_SQL_PROFILING', False):
+            raise MiddlewareNotUsed
+
+        self.sample_rate = getattr(settings, 'WAREHOUSE_SQL_PROFILING_SAMPLE_RATE', 1.0)
+
+    def process_request(self, request):
+        if random.random() < self.sample_rate:
+            profile = QueryProfile()
+            context = profiling(profile)
+            context.__enter__()
+            request._sql_profiling = (profile, context)
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_sql_profiling'):
+            return response
+
+        profile, context = request._sql_profiling
+        del request._sql_profiling
+        context.__exit__(None, None, None)
+
+        summary = profile.summary()
+        resolver_match = getattr(request, 'resolver_match', None)
+        endpoint = "{} {}".format(request.method, resolver_match.view_name if resolver_match else request.path)
+
+        response['X-SQL-Queries'] = str(summary['queries'])
+        response['X-SQL-Time'] = str(summary['time'])
+        response['X-SQL-Duplicates'] = str(summary['duplicates'])
+        response['X-SQL-Suspects'] = str(len(summary['suspects']))
+
+        record_endpoint(endpoint, summary)
+
+        logger.log(logging.WARNING if summary['suspects'] else logging.INFO,
+                   json.dumps(dict(summary, endpoint=endpoint, path=request.path, status=response.status_code),
+                              sort_keys=True))
+
+        return response
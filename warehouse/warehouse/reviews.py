@@ -0,0 +1,209 @@
+"""
+Rendering and storage of the monthly review PDFs. A rendered review is kept in the review storage until a processing
+of its month gets closed. The archives of the reviews of a year are built into the same storage by the export_reviews
+command, since rendering a whole year takes far longer than a request may. A review or an archive is only stored if the
+monthly summaries it is made of have not changed while it was rendered, so a close committed meanwhile, whose
+invalidation has nothing to delete yet, cannot leave the rendering from before it stored.
+"""
+import multiprocessing
+import os
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import get_storage_class
+from django.db import connections
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from wkhtmltopdf.views import PDFTemplateResponse
+
+from .models import MonthlyProductSummary, ProductsProcessing, ReviewArchive
+
+REVIEW_TEMPLATE = "warehouse/productsprocessing/review/pdf/review.html"
+
+
+def review_storage():
+    storage_class = get_storage_class(getattr(settings, 'WAREHOUSE_REVIEW_STORAGE', None))
+
+    return storage_class(**getattr(settings, 'WAREHOUSE_REVIEW_STORAGE_OPTIONS', {}))
+
+
+def review_name(year, month):
+    return "review-{}-{}.pdf".format(year, str(month).zfill(2))
+
+
+def archive_name(year):
+    return "reviews-{}.zip".format(year)
+
+
+def summaries_version(year, month=None):
+    """
+    Returns a value changing with every close of a processing of the month, or of the year when no month is given,
+    read from the monthly summaries the reviews are made of
+    """
+    summaries = MonthlyProductSummary.objects.filter(year=year)
+
+    if month is not None:
+        summaries = summaries.filter(month=month)
+
+    return summaries.aggregate(count=Count('pk'), total=Sum('quantity_change'))
+
+
+def _replace(storage, name, content):
+    """
+    Stores the content under the name, replacing the stored file. Storages of local files get it written to a
+    temporary file renamed over the stored one, so concurrent writers do not leave files under names picked by the
+    storage behind.
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        storage.delete(name)
+        storage.save(name, content)
+        return
+
+    os.rename(storage.path(storage.save(name + ".tmp", content)), path)
+
+
+def _store(storage, name, content, is_current):
+    """
+    Stores the content if is_current tells the data it was rendered from has not changed, returning whether it has been
+    stored. The data is checked again once it is stored, since an invalidation run before the store had nothing to
+    delete.
+    """
+    if not is_current():
+        return False
+
+    _replace(storage, name, content)
+
+    if not is_current():
+        storage.delete(name)
+        return False
+
+    return True
+
+
+def render_review(year, month):
+    "Runs the review queries and wkhtmltopdf, returning the PDF content"
+    response = PDFTemplateResponse(request=None, template=REVIEW_TEMPLATE, context={
+        'processings': ProductsProcessing.objects.review_for_month(year=year, month=month)
+    })
+
+    return response.rendered_content
+
+
+def get_review(year, month):
+    "Returns the PDF content of the review, rendering and storing it only if it is not stored yet"
+    storage = review_storage()
+    name = review_name(year, month)
+
+    if storage.exists(name):
+        with storage.open(name) as review:
+            return review.read()
+
+    version = summaries_version(year, month)
+    content = render_review(year, month)
+    _store(storage, name, ContentFile(content), lambda: summaries_version(year, month) == version)
+
+    return content
+
+
+def invalidate_review(year, month):
+    storage = review_storage()
+    storage.delete(review_name(year, month))
+    storage.delete(archive_name(year))
+
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+def _get_review_of_period(period):
+    year, month = period
+
+    return year, month, get_review(year, month)
+
+
+def write_reviews_archive(periods, fileobj, processes=None):
+    """
+    Writes the reviews of the given (year, month) periods to a ZIP archive. Reviews are rendered across a pool of
+    processes and every one is written to the archive as soon as it is ready, so only a single PDF is held in memory
+    at a time. A single process renders the reviews in the current process.
+    """
+    if processes is None:
+        processes = getattr(settings, 'WAREHOUSE_REVIEW_EXPORT_PROCESSES', None)
+
+    pool = None
+
+    if processes == 1:
+        reviews = (_get_review_of_period(period) for period in periods)
+    else:
+        # Forked processes must not share the database connections of the parent
+        _close_connections()
+
+        pool = multiprocessing.Pool(processes, initializer=_close_connections)
+        reviews = pool.imap_unordered(_get_review_of_period, periods)
+
+    try:
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for year, month, content in reviews:
+                archive.writestr(review_name(year, month), content)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def open_reviews_archive(year):
+    """
+    Returns the stored archive of the year opened for reading. If it is not stored, its build is requested and None
+    is returned.
+    """
+    storage = review_storage()
+    name = archive_name(year)
+
+    if storage.exists(name):
+        return storage.open(name)
+
+    archive, created = ReviewArchive.objects.get_or_create(year=year)
+
+    if not created and not archive.is_pending():
+        ReviewArchive.objects.filter(pk=archive.pk).update(requested=timezone.now())
+
+    return None
+
+
+def build_reviews_archive(year, processes=None):
+    """
+    Renders the reviews of the year into an archive replacing the stored one. Returns whether it has been stored, which
+    it is not when a processing of the year has been closed meanwhile.
+    """
+    version = summaries_version(year)
+    periods = list(MonthlyProductSummary.objects.filter(year=year).values_list('year', 'month').distinct()
+                   .order_by('month'))
+    storage = review_storage()
+
+    with tempfile.TemporaryFile() as archive:
+        write_reviews_archive(periods, archive, processes=processes)
+        archive.seek(0)
+
+        return _store(storage, archive_name(year), File(archive), lambda: summaries_version(year) == version)
+
+
+def build_requested_archives(processes=None):
+    "Builds the archives requested since they were built last, returning their years"
+    years = []
+
+    for archive in ReviewArchive.objects.filter(Q(built__isnull=True) | Q(built__lt=F('requested'))).order_by('year'):
+        # An archive outdated by a close while it was being built stays pending, to be built on the next run
+        if not build_reviews_archive(archive.year, processes):
+            continue
+
+        # An archive requested again while it was being built stays pending
+        ReviewArchive.objects.filter(pk=archive.pk).update(built=archive.requested)
+        years.append(archive.year)
+
+    return years
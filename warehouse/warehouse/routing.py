@@ -0,0 +1,105 @@
+"""
+Routing of the read only reporting paths to a read replica. Views decorated with replica_view (reports, exports and
+changelists) read from the WAREHOUSE_REPLICA_DATABASE alias, everything else uses the default database. A client whose
+request has written anything is pinned to the default database for WAREHOUSE_REPLICA_PIN_SECONDS with a cookie, so it
+reads its own writes while the replica catches up. Views storing what they read in a cache, like the reviews and their
+archives, read from the default database, as a lagging read would be cached until the next invalidation.
+"""
+import threading
+
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'warehouse_primary'
+
+_state = threading.local()
+
+
+def replica_database():
+    "Returns the alias of the read replica, or None when no configured database is the replica"
+    alias = getattr(settings, 'WAREHOUSE_REPLICA_DATABASE', None)
+
+    return alias if alias in connections.databases else None
+
+
+def read_database():
+    "Returns the alias the reads of the current thread go to"
+    if getattr(_state, 'replica', False) and not getattr(_state, 'pinned', False) \
+            and not getattr(_state, 'wrote', False):
+        return replica_database() or DEFAULT_DB_ALIAS
+
+    return DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_replica():
+    "Sends the reads of the block to the replica, unless the thread is pinned to the default database"
+    previous = getattr(_state, 'replica', False)
+    _state.replica = True
+
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def replica_view(view):
+    """
+    Decorator serving safe requests of the view from the replica. Template responses are rendered in the block, since
+    their querysets are evaluated when they are rendered.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        with use_replica():
+            response = view(request, *args, **kwargs)
+
+            if callable(getattr(response, 'render', None)) and not response.is_rendered:
+                response.render()
+
+        return response
+
+    return wrapped
+
+
+class ReplicaRouter(object):
+    "Sends the writes to the default database and the reads of replica views to the replica"
+
+    def db_for_read(self, model, **hints):
+        return read_database()
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, model):
+        return db != replica_database()
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Pins clients to the default database for a while after a request of theirs has written, using a cookie, so they
+    read their own writes. It has to come after the session middleware, whose writes do not pin.
+    """
+
+    def process_request(self, request):
+        _state.pinned = PIN_COOKIE in request.COOKIES
+        _state.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(_state, 'wrote', False):
+            response.set_cookie(PIN_COOKIE, '1', max_age=getattr(settings, 'WAREHOUSE_REPLICA_PIN_SECONDS', 15),
+                                httponly=True)
+
+        _state.pinned = _state.wrote = False
+
+        return response
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Search index of processings. Every processing has one row per distinct token of its name and of the names of its
+products, so a search term is looked up as a prefix range in the token index instead of a LIKE scan joining the nodes
+and the products. Tokens are lower case words stripped of diacritics.
+"""
+import re
+import threading
+import unicodedata
+
+from contextlib import contextmanager
+
+from django.utils import six
+
+from .models import ProcessingSearchToken, ProductsProcessing, ProductProcessingNode
+
+TOKEN_LENGTH = ProcessingSearchToken._meta.get_field('token').max_length
+
+# Upper bound of the tokens starting with a prefix
+TOKEN_END = u"\uffff"
+
+CHUNK_SIZE = 500
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Letters without a decomposition into a base letter and a diacritic
+LETTERS = {ord(u"ł"): u"l", ord(u"ø"): u"o", ord(u"đ"): u"d", ord(u"ß"): u"ss"}
+
+_local = threading.local()
+
+
+def tokenize(text):
+    "Returns the distinct tokens of the text"
+    if not text:
+        return set()
+
+    text = unicodedata.normalize('NFKD', six.text_type(text).lower().translate(LETTERS))
+    text = u"".join(character for character in text if not unicodedata.combining(character))
+
+    return set(word[:TOKEN_LENGTH] for word in WORD.findall(text))
+
+
+def index_processings(processing_ids):
+    "Replaces the tokens of the given processings with the tokens of their current names and product names"
+    processing_ids = sorted(set(pk for pk in processing_ids if pk is not None))
+
+    for start in range(0, len(processing_ids), CHUNK_SIZE):
+        chunk = processing_ids[start:start + CHUNK_SIZE]
+        tokens = dict((pk, tokenize(name)) for pk, name in
+                      ProductsProcessing.objects.filter(pk__in=chunk).values_list('pk', 'name'))
+
+        for processing_id, name in ProductProcessingNode.objects.filter(processing__in=chunk) \
+                .values_list('processing', 'product__name'):
+            tokens[processing_id].update(tokenize(name))
+
+        ProcessingSearchToken.objects.filter(processing__in=chunk).delete()
+        ProcessingSearchToken.objects.bulk_create([
+            ProcessingSearchToken(processing_id=processing_id, token=token)
+            for processing_id, processing_tokens in tokens.items() for token in processing_tokens
+        ])
+
+
+@contextmanager
+def deferred_indexing():
+    """
+    Collects the processings and products changed in the block and reindexes each affected processing once at its
+    end, instead of after every change of a processing, its nodes or its products. Nested blocks are reindexed by the
+    outermost one. Nothing is reindexed when the block raises.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+
+    _local.pending = (set(), set())
+
+    try:
+        yield
+        processing_ids, product_ids = _local.pending
+    finally:
+        _local.pending = None
+
+    _index(processing_ids, product_ids)
+
+
+def _index(processing_ids, product_ids):
+    processing_ids = set(processing_ids)
+
+    if product_ids:
+        processing_ids.update(ProductProcessingNode.objects.filter(product__in=product_ids)
+                              .values_list('processing', flat=True).distinct())
+
+    index_processings(processing_ids)
+
+
+def schedule_indexing(processing_ids=(), product_ids=()):
+    """
+    Reindexes the given processings and the processings of the given products at once, or at the end of the current
+    deferred_indexing() block
+    """
+    pending = getattr(_local, 'pending', None)
+
+    if pending is None:
+        _index(processing_ids, product_ids)
+    else:
+        pending[0].update(processing_ids)
+        pending[1].update(product_ids)
+
+
+def search_processings(queryset, search_term):
+    "Filters the processings to those with a token starting with every word of the search term"
+    for term in tokenize(search_term):
+        queryset = queryset.filter(pk__in=ProcessingSearchToken.objects
+                                   .filter(token__gte=term, token__lt=term + TOKEN_END).values('processing'))
+
+    return queryset
@@ -53,7 +53,9 @@ INSTALLED_APPS = THIRDPARTY_APPS + BUILTIN_APPS + LOCAL_APPS
 
 
 MIDDLEWARE_CLASSES = (
+    'warehouse.profiling.QueryProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'warehouse.routing.ReplicaPinningMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -81,6 +83,16 @@ DATABASES = {
     }
 }
 
+# A read replica is added as another alias, e.g. a second SQLite database standing in for it locally:
+#
+# DATABASES['replica'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+#     'TEST': {'MIRROR': 'default'},
+# }
+
+DATABASE_ROUTERS = ['warehouse.routing.ReplicaRouter']
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -109,4 +121,52 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 
 TEMPLATE_DIRS = (os.path.join(BASE_DIR, 'templates'),)
 
-GRAPPELLI_ADMIN_TITLE="Warehouse"
\ No newline at end of file
+GRAPPELLI_ADMIN_TITLE="Warehouse"
+
+# Storage of the rendered monthly review PDFs
+
+WAREHOUSE_REVIEW_STORAGE = 'django.core.files.storage.FileSystemStorage'
+
+WAREHOUSE_REVIEW_STORAGE_OPTIONS = {
+    'location': os.path.join(BASE_DIR, 'reviews')
+}
+
+# Seconds the review periods are cached for. Processes using a local memory cache see the periods of the closes made by
+# other processes after this time
+
+WAREHOUSE_REVIEWS_CACHE_TIMEOUT = 300
+
+# Number of processes rendering the reviews of an archive (the number of CPUs by default)
+
+WAREHOUSE_REVIEW_EXPORT_PROCESSES = None
+
+# Per-request SQL profiling: the share of the profiled requests and the number of executions of the same statement in
+# a request reported as an N+1 suspect
+
+WAREHOUSE_SQL_PROFILING = False
+
+WAREHOUSE_SQL_PROFILING_SAMPLE_RATE = 1.0
+
+WAREHOUSE_SQL_PROFILING_N1_THRESHOLD = 3
+
+# Cache shared by the processes in which changes of units are announced (None when there is a single process). It has
+# to be a backend all the processes reach, like memcached or the database cache, not the per process local memory cache
+
+WAREHOUSE_UNIT_CACHE = None
+
+# Seconds between the heartbeats of a running background close, and seconds without a heartbeat after which it is
+# considered abandoned by a dead worker
+
+WAREHOUSE_CLOSING_JOB_HEARTBEAT = 30
+WAREHOUSE_CLOSING_JOB_TIMEOUT = 300
+
+# Age in days after which the months of closed processings are moved to the archive by archive_processings
+
+WAREHOUSE_ARCHIVE_AFTER_DAYS = 730
+
+# Database alias of the read replica serving the reports, exports and changelists, and the seconds a client stays on
+# the default database after writing
+
+WAREHOUSE_REPLICA_DATABASE = 'replica'
+
+WAREHOUSE_REPLICA_PIN_SECONDS = 15
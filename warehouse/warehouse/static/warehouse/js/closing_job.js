@@ -0,0 +1,27 @@
+(function(window, $) {
+    var callback = function() {
+        var $job = $('.closing-job');
+        var interval = 2000;
+
+        var poll = function() {
+            $.getJSON($job.data('status-url'), function(job) {
+                $('.closing-job-status', $job).text(job.status_display);
+                $('.closing-job-progress', $job).text(job.progress);
+                $('.closing-job-message', $job).text(job.message);
+
+                if (job.active) {
+                    window.setTimeout(poll, interval);
+                } else {
+                    // The closed processing is shown read only, which needs the page to be rendered again
+                    window.location.reload();
+                }
+            });
+        };
+
+        if ($job.length && $job.data('active')) {
+            window.setTimeout(poll, interval);
+        }
+    };
+
+    $(document).ready(callback)
+})(window, django.jQuery);
@@ -1,19 +1,56 @@
 (function(window, $) {
     var callback = function() {
         var calculation = {
-            url: '/warehouse/product/',
-            node: function($row) {
-                var id = $('.product select', $row).val();
+            url: '/warehouse/product/details/',
+            products: {},
+            fetch: function(ids, done) {
+                var missing = $.grep(ids, function(id) {
+                    return id && !calculation.products.hasOwnProperty(id);
+                });
+
+                if (!missing.length) {
+                    done();
+                    return;
+                }
+
+                $.getJSON(calculation.url, { ids: missing.join(',') }, function(response) {
+                    $.extend(calculation.products, response.products);
+                    done();
+                });
+            },
+            rows: function() {
+                return $('.grp-table .grp-tbody').not('.grp-empty-form').find('.grp-tr');
+            },
+            productId: function($row) {
+                return $('.product .product-lookup-id', $row).val();
+            },
+            render: function($row) {
+                var product = calculation.products[calculation.productId($row)];
+
+                if (!product) {
+                    return;
+                }
 
-                $.getJSON(calculation.url + id + '/details', null, function(product) {
-                    var custom_price = $('.custom_price input', $row).val();
-                    var quantity_change = $('.quantity_change input', $row).val();
+                var custom_price = $('.custom_price input', $row).val();
+                var quantity_change = $('.quantity_change input', $row).val();
 
-                    var price = custom_price || product.price;
+                var price = custom_price || product.price;
 
-                    $('.total_cost div', $row).html(price * quantity_change);
-                    $('.currency div', $row).html(product.currency.slug);
-                })
+                $('.total_cost_amount div', $row).html(price * quantity_change);
+            },
+            node: function($row) {
+                calculation.fetch([calculation.productId($row)], function() {
+                    calculation.render($row);
+                });
+            },
+            all: function() {
+                var $rows = calculation.rows();
+
+                calculation.fetch($.map($rows, function(row) { return calculation.productId($(row)); }), function() {
+                    $rows.each(function() {
+                        calculation.render($(this));
+                    });
+                });
             }
         };
 
@@ -21,12 +58,14 @@
             $('.grp-table').trigger('django.admin.calculate_node', [ $(this).parents('.grp-tr') ])
         }).on('change', '.custom_price input', function() {
             $('.grp-table').trigger('django.admin.calculate_node', [ $(this).parents('.grp-tr') ])
-        }).on('change', '.product select', function() {
+        }).on('change', '.product .product-lookup-id', function() {
             $('.grp-table').trigger('django.admin.calculate_node', [ $(this).parents('.grp-tr') ])
         }).on('django.admin.calculate_node', function(e, $row) {
             calculation.node($row);
         });
+
+        calculation.all();
     };
 
     $(document).ready(callback)
-})(window, django.jQuery);
\ No newline at end of file
+})(window, django.jQuery);
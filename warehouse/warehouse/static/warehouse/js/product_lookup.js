@@ -0,0 +1,81 @@
+(function(window, $) {
+    var callback = function() {
+        var lookup = {
+            delay: 250,
+            timer: null,
+            label: function(product) {
+                return product.name + ' (' + product.unit.slug + ')';
+            },
+            labels: function() {
+                var $pickers = $('.product-lookup').filter(function() {
+                    return $('.product-lookup-id', this).val();
+                });
+
+                if (!$pickers.length) {
+                    return;
+                }
+
+                var ids = $.map($pickers, function(picker) { return $('.product-lookup-id', picker).val(); });
+
+                $.getJSON($pickers.data('details-url'), { ids: ids.join(',') }, function(response) {
+                    $pickers.each(function() {
+                        var product = response.products[$('.product-lookup-id', this).val()];
+
+                        if (product) {
+                            $('.product-lookup-search', this).val(lookup.label(product));
+                        }
+                    });
+                });
+            },
+            search: function($picker, page) {
+                var $results = $('.product-lookup-results', $picker);
+                var params = {
+                    q: $('.product-lookup-search', $picker).val(),
+                    warehouse: $('#id_warehouse').val() || '',
+                    page: page
+                };
+
+                $.getJSON($picker.data('lookup-url'), params, function(response) {
+                    if (page === 1) {
+                        $results.empty();
+                    }
+
+                    $('.product-lookup-more', $results).remove();
+
+                    $.each(response.results, function(i, product) {
+                        $('<li class="product-lookup-result"></li>').text(product.text).data('id', product.id)
+                            .appendTo($results);
+                    });
+
+                    if (response.more) {
+                        $('<li class="product-lookup-more">More&hellip;</li>').data('page', page + 1).appendTo($results);
+                    }
+
+                    $results.show();
+                });
+            },
+            select: function($picker, $result) {
+                $('.product-lookup-search', $picker).val($result.text());
+                $('.product-lookup-id', $picker).val($result.data('id')).trigger('change');
+                $('.product-lookup-results', $picker).empty().hide();
+            }
+        };
+
+        $(document).on('input', '.product-lookup-search', function() {
+            var $picker = $(this).parents('.product-lookup');
+
+            window.clearTimeout(lookup.timer);
+            lookup.timer = window.setTimeout(function() {
+                lookup.search($picker, 1);
+            }, lookup.delay);
+        }).on('click', '.product-lookup-result', function() {
+            lookup.select($(this).parents('.product-lookup'), $(this));
+        }).on('click', '.product-lookup-more', function() {
+            lookup.search($(this).parents('.product-lookup'), $(this).data('page'));
+        });
+
+        lookup.labels();
+    };
+
+    $(document).ready(callback)
+})(window, django.jQuery);
@@ -1,13 +1,21 @@
 from django.conf.urls import patterns, include, url
 from django.contrib import admin
-from .views import productsprocessing_close, product_details, monthly_review, MonthlyReviewPDF
+from .views import productsprocessing_close, product_details, products_details, product_lookup, monthly_review, reviews_archive, inventory_valuation, \
+    sql_profile, productsprocessing_close_in_background, closing_job_status, MonthlyReviewPDF
 
 urlpatterns = patterns('',
     # Custom admin actions
     url(r'^warehouse/product/(\d+)/details/$', product_details, name="warehouse_product_details"),
+    url(r'^warehouse/product/details/$', products_details, name="warehouse_products_details"),
+    url(r'^warehouse/product/lookup/$', product_lookup, name="warehouse_product_lookup"),
     url(r'^warehouse/productsprocessing/(\d+)/close/$', productsprocessing_close, name="warehouse_productsprocessing_close"),
+    url(r'^warehouse/productsprocessing/(\d+)/close/background/$', productsprocessing_close_in_background, name="warehouse_productsprocessing_close_in_background"),
+    url(r'^warehouse/closingjob/(\d+)/$', closing_job_status, name="warehouse_closing_job_status"),
     url(r'^warehouse/productsprocessing/review/$', monthly_review, name="warehouse_productsprocessing_review"),
     url(r'^warehouse/productsprocessing/review/(\d+-\d+-01)/$', MonthlyReviewPDF.as_view(), name="warehouse_productsprocessing_review_pdf"),
+    url(r'^warehouse/productsprocessing/review/(\d{4})/archive/$', reviews_archive, name="warehouse_productsprocessing_review_archive"),
+    url(r'^warehouse/valuation/$', inventory_valuation, name="warehouse_inventory_valuation"),
+    url(r'^warehouse/profiling/$', sql_profile, name="warehouse_sql_profile"),
 
     # Default admin implementations
     url(r'^grappelli/', include('grappelli.urls')),
@@ -0,0 +1,274 @@
+"""
+Batch valuation of processings and stock. Quantities and prices are loaded as integers in minor units (thousandths
+of a unit and cents) into array columns, so values are multiplied and summed without creating Decimal objects. Totals
+are exact in hundred-thousandths and rounded half to even to cents only when they are returned, which gives the same
+results as formatting the Decimal totals of ProductProcessingNode.total_cost().
+"""
+import datetime
+
+from array import array
+from decimal import Decimal
+from operator import mul
+
+from django.utils import timezone
+
+from .models import ArchivedProcessing, ArchivedProcessingNode, Product, ProductsProcessing, ProductProcessingNode, \
+    Warehouse, WarehouseStock
+
+QUANTITY_SCALE = 1000
+PRICE_SCALE = 100
+TOTAL_SCALE = QUANTITY_SCALE * PRICE_SCALE
+
+CENT = TOTAL_SCALE // PRICE_SCALE
+
+CHUNK_SIZE = 10000
+
+try:
+    array('q')
+    INTEGER_TYPECODE = 'q'
+except ValueError:
+    INTEGER_TYPECODE = 'l'
+
+
+def to_minor(value, scale):
+    "Returns the decimal value as an integer number of 1/scale units"
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(value) if isinstance(value, float) else value)
+
+    return int((value * scale).to_integral_value())
+
+
+def to_cents(total):
+    "Rounds a total in hundred-thousandths half to even, returning a Decimal with two decimal places"
+    cents, remainder = divmod(total, CENT)
+
+    if remainder * 2 > CENT or (remainder * 2 == CENT and cents % 2):
+        cents += 1
+
+    return Decimal(cents).scaleb(-2)
+
+
+class ValuationColumns(object):
+    """
+    Lines to value stored column-wise: one integer array per key, the quantities in thousandths and the prices in
+    cents. Missing keys are stored as zero.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.columns = dict((key, array(INTEGER_TYPECODE)) for key in keys)
+        self.quantities = array(INTEGER_TYPECODE)
+        self.prices = array(INTEGER_TYPECODE)
+
+    def __len__(self):
+        return len(self.quantities)
+
+    def append(self, keys, quantity, price):
+        for key, value in zip(self.keys, keys):
+            self.columns[key].append(value or 0)
+
+        self.quantities.append(to_minor(quantity, QUANTITY_SCALE))
+        self.prices.append(to_minor(price, PRICE_SCALE))
+
+    def line_totals(self):
+        "Returns the totals of all lines in hundred-thousandths, computed in a single pass"
+        return list(map(mul, self.quantities, self.prices))
+
+    def exact_totals_by(self, key, line_totals=None):
+        "Returns the totals grouped by the given key column in hundred-thousandths"
+        if line_totals is None:
+            line_totals = self.line_totals()
+
+        totals = {}
+
+        for value, total in zip(self.columns[key], line_totals):
+            totals[value] = totals.get(value, 0) + total
+
+        totals.pop(0, None)
+
+        return totals
+
+    def totals_by(self, key, line_totals=None):
+        "Returns the totals grouped by the given key column as Decimals rounded to cents"
+        return dict((value, to_cents(total)) for value, total in self.exact_totals_by(key, line_totals).items())
+
+    def total(self, line_totals=None):
+        return to_cents(sum(self.line_totals() if line_totals is None else line_totals))
+
+
+def _iterate(queryset, fields, chunk_size):
+    "Reads the values of the queryset in primary key chunks, so big tables are not loaded at once"
+    last_pk = 0
+
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', *fields)[:chunk_size])
+
+        for row in rows:
+            yield row[1:]
+
+        if len(rows) < chunk_size:
+            break
+
+        last_pk = rows[-1][0]
+
+
+def load_processing_lines(queryset=None, chunk_size=None, archived_queryset=None):
+    """
+    Loads the nodes of the given processings into columns keyed by node, processing, product and warehouse. A custom
+    price of zero falls back to the product price. The nodes of the archived processings of archived_queryset are
+    loaded as well, they keep their primary keys, so the keys do not collide.
+    """
+    nodes = ProductProcessingNode.objects.all()
+
+    if queryset is not None:
+        nodes = nodes.filter(processing__in=queryset.values('pk'))
+
+    sources = [nodes]
+
+    if archived_queryset is not None:
+        sources.append(ArchivedProcessingNode.objects.filter(processing__in=archived_queryset.values('pk')))
+
+    columns = ValuationColumns(('line', 'processing', 'product', 'warehouse'))
+    fields = ('id', 'processing', 'product', 'processing__warehouse', 'quantity_change', 'custom_price', 'product__price')
+
+    for source in sources:
+        for line, processing, product, warehouse, quantity, custom_price, price in _iterate(source, fields, chunk_size or CHUNK_SIZE):
+            columns.append((line, processing, product, warehouse), quantity, custom_price or price)
+
+    return columns
+
+
+def load_stock_lines(chunk_size=None):
+    "Loads the stock of every warehouse into columns keyed by product and warehouse"
+    columns = ValuationColumns(('product', 'warehouse'))
+    fields = ('product', 'warehouse', 'quantity', 'product__price')
+
+    for product, warehouse, quantity, price in _iterate(WarehouseStock.objects.all(), fields, chunk_size or CHUNK_SIZE):
+        columns.append((product, warehouse), quantity, price)
+
+    return columns
+
+
+def load_product_lines(chunk_size=None):
+    "Loads the total quantity of every product into columns keyed by product"
+    columns = ValuationColumns(('product',))
+
+    for product, quantity, price in _iterate(Product.objects.all(), ('id', 'quantity', 'price'), chunk_size or CHUNK_SIZE):
+        columns.append((product,), quantity, price)
+
+    return columns
+
+
+def load_frozen_totals(queryset=None, archived_queryset=None):
+    """
+    Returns the total costs frozen when the given processings (all by default) and archived processings were closed,
+    keyed by processing, as (warehouse, total in hundred-thousandths) pairs
+    """
+    processings = ProductsProcessing.objects.all() if queryset is None else queryset
+    sources = [processings]
+
+    if archived_queryset is not None:
+        sources.append(archived_queryset)
+
+    frozen = {}
+
+    for source in sources:
+        rows = source.filter(closed_total_cost__isnull=False).values_list('pk', 'warehouse', 'closed_total_cost')
+
+        for processing, warehouse, total_cost in rows:
+            frozen[processing] = (warehouse or 0, to_minor(total_cost, TOTAL_SCALE))
+
+    return frozen
+
+
+def value_processings(queryset=None, archived_queryset=None):
+    """
+    Returns the totals of the nodes of the given processings (all by default) and archived processings per line,
+    processing, product and warehouse of the processing, together with the grand total. Closed processings count
+    with the total cost frozen when they were closed in the processing, warehouse and grand totals, while their lines
+    and products are revalued at the current prices.
+    """
+    columns = load_processing_lines(queryset, archived_queryset=archived_queryset)
+    line_totals = columns.line_totals()
+
+    processings = columns.exact_totals_by('processing', line_totals)
+    warehouses = dict(zip(columns.columns['processing'], columns.columns['warehouse']))
+
+    for processing, (warehouse, total) in load_frozen_totals(queryset, archived_queryset).items():
+        processings[processing] = total
+        warehouses[processing] = warehouse
+
+    warehouse_totals = {}
+
+    for processing, total in processings.items():
+        warehouse = warehouses[processing]
+        warehouse_totals[warehouse] = warehouse_totals.get(warehouse, 0) + total
+
+    warehouse_totals.pop(0, None)
+
+    return {
+        'lines': columns.totals_by('line', line_totals),
+        'processings': dict((processing, to_cents(total)) for processing, total in processings.items()),
+        'products': columns.totals_by('product', line_totals),
+        'warehouses': dict((warehouse, to_cents(total)) for warehouse, total in warehouse_totals.items()),
+        'total': to_cents(sum(processings.values())),
+    }
+
+
+def value_stock():
+    "Returns the value of the stock per product and per warehouse, together with the grand total"
+    products = load_product_lines()
+    product_totals = products.line_totals()
+    warehouses = load_stock_lines()
+
+    return {
+        'products': products.totals_by('product', product_totals),
+        'warehouses': warehouses.totals_by('warehouse'),
+        'total': products.total(product_totals),
+    }
+
+
+def _named(queryset, totals, *querysets):
+    "Returns (name, total) pairs of the totals keyed by primary keys of the rows of the querysets"
+    names = {}
+
+    for rows in (queryset,) + querysets:
+        names.update(rows.values_list('pk', 'name'))
+
+    return [(names.get(pk, "#{}".format(pk)), total) for pk, total in sorted(totals.items())]
+
+
+def processings_of_month(year, month, model=ProductsProcessing):
+    "Returns the processings (or archived processings) created in the given month, in UTC like the monthly summaries"
+    start = datetime.datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+    return model.objects.filter(created__gte=start, created__lt=end)
+
+
+def valuation_report(year=None, month=None):
+    """
+    Returns the stock value per warehouse and per product and, for the given month, the totals of its processings
+    per processing, per product and per warehouse, all as (name, total) pairs. Closed processings keep their frozen
+    totals, except per product, where they are revalued at the current prices.
+    """
+    stock = value_stock()
+    report = {
+        'stock_total': stock['total'],
+        'stock_warehouses': _named(Warehouse.objects.all(), stock['warehouses']),
+        'stock_products': _named(Product.objects.all(), stock['products']),
+    }
+
+    if year is not None and month is not None:
+        queryset = processings_of_month(year, month)
+        archived_queryset = processings_of_month(year, month, ArchivedProcessing)
+        processings = value_processings(queryset, archived_queryset)
+
+        report.update({
+            'processings_total': processings['total'],
+            'processings': _named(queryset, processings['processings'], archived_queryset),
+            'processings_products': _named(Product.objects.all(), processings['products']),
+            'processings_warehouses': _named(Warehouse.objects.all(), processings['warehouses']),
+        })
+
+    return report
@@ -1,16 +1,27 @@
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.core.urlresolvers import reverse
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import six
 from django.utils.decorators import method_decorator
 from django.shortcuts import redirect, get_object_or_404, render
-from django.db import transaction
-from warehouse.models import ProductsProcessing, Product
-from warehouse.forms import ReviewForm
+from django.views.decorators.http import condition
+from warehouse.closing import ClosingError, close_processings
+from warehouse.jobs import enqueue_close
+from warehouse.models import ClosingJob, ProductsProcessing, Product, Unit
+from warehouse.forms import ReviewForm, ValuationForm
+from warehouse.profiling import worst_endpoints
+from warehouse.reviews import get_review, open_reviews_archive
+from warehouse.routing import replica_view
+from warehouse.valuation import valuation_report
 
-from wkhtmltopdf.views import PDFTemplateView
+from wkhtmltopdf.views import PDFResponse, PDFTemplateView
 
-import reversion
+from wsgiref.util import FileWrapper
+
+import hashlib
+
+PRODUCT_LOOKUP_PAGE_SIZE = 20
 
 
 def _redirect_to_with_error(request, url_name, object_id, message):
@@ -35,45 +46,144 @@ def _redirect_to_with_success(request, url_name, object_id, message):
 def productsprocessing_close(request, object_id):
     change_url = "admin:warehouse_productsprocessing_change"
 
-    products_processing = get_object_or_404(ProductsProcessing, pk=object_id)
+    products_processing = get_object_or_404(ProductsProcessing.objects.with_closing_jobs(), pk=object_id)
 
-    if products_processing.closed:
+    if products_processing.is_closing():
         return _redirect_to_with_error(request, change_url, object_id,
-                                        "You cannot close Products Processing Entry which has been already closed")
+                                       "Products Processing Entry is already being closed in the background")
 
-    if products_processing.clean_for_processing():
-        with transaction.atomic(), reversion.create_revision():
-            products_processing.close()
-            products_processing.save()
-            reversion.set_user(request.user)
-            reversion.set_comment("Processing closed")
+    try:
+        close_processings([products_processing.pk], user=request.user)
+    except ClosingError as error:
+        return _redirect_to_with_error(request, change_url, object_id, six.text_type(error))
 
-        return _redirect_to_with_success(request, change_url, object_id,
-                                        "Entry has been closed. Products quantities have been modified.")
-    else:
-        return _redirect_to_with_error(request, change_url, object_id,
-                                        "Operation has been terminated due to the validation errors.")
+    return _redirect_to_with_success(request, change_url, object_id,
+                                     "Entry has been closed. Products quantities have been modified.")
 
 
 @staff_member_required
-def product_details(request, object_id):
-    product = get_object_or_404(Product, pk=object_id)
+def productsprocessing_close_in_background(request, object_id):
+    change_url = "admin:warehouse_productsprocessing_change"
+
+    try:
+        enqueue_close(object_id, user=request.user)
+    except ClosingError as error:
+        return _redirect_to_with_error(request, change_url, object_id, six.text_type(error))
+
+    return _redirect_to_with_success(request, change_url, object_id,
+                                     "Entry will be closed in the background. Its progress is shown below.")
+
+
+@staff_member_required
+def closing_job_status(request, object_id):
+    job = get_object_or_404(ClosingJob, pk=object_id)
 
     return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'active': job.is_active(),
+        'progress': job.progress,
+        'message': job.message,
+        'finished': job.finished,
+    })
+
+
+def _product_details(product):
+    return {
         'name': product.name,
         'price': product.price,
         'quantity': product.quantity,
+        'reservation': product.reserved_quantity,
         'unit': {
             'slug': product.unit.slug,
             'name': product.unit.name
         }
+    }
+
+
+def _requested_product_ids(request, object_id=None):
+    if object_id is not None:
+        return [int(object_id)]
+
+    return [int(product_id) for product_id in request.GET.get('ids', '').split(',') if product_id.isdigit()]
+
+
+def _products_state(request, object_id=None):
+    "Returns the returned fields of the requested products and their units, read once per request"
+    if not hasattr(request, '_products_state'):
+        request._products_state = list(Product.objects.filter(pk__in=_requested_product_ids(request, object_id))
+                                       .order_by('pk').values_list('pk', 'name', 'price', 'quantity',
+                                                                   'reserved_quantity', 'unit__slug', 'unit__name'))
+
+    return request._products_state
+
+
+def _products_etag(request, object_id=None):
+    """
+    Returns the ETag of the details, computed from the returned fields, so it changes with the reserved quantities
+    as well, which are refreshed without touching the modification time of the products
+    """
+    state = _products_state(request, object_id)
+
+    if not state:
+        return None
+
+    key = u"|".join(u":".join(six.text_type(value) for value in row) for row in state)
+
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+@staff_member_required
+@condition(etag_func=_products_etag)
+def product_details(request, object_id):
+    product = get_object_or_404(Product.objects.select_related('unit'), pk=object_id)
+
+    return JsonResponse(_product_details(product))
+
+
+@staff_member_required
+@condition(etag_func=_products_etag)
+def products_details(request):
+    products = Product.objects.select_related('unit').filter(pk__in=_requested_product_ids(request))
+
+    return JsonResponse({'products': dict((product.pk, _product_details(product)) for product in products)})
+
+
+@staff_member_required
+def product_lookup(request):
+    """
+    Returns a page of the products whose name starts with the q parameter, optionally only those stored in the given
+    warehouse. Products are read in the order of the name index, one row beyond the page telling whether more follow.
+    """
+    products = Product.objects.order_by('name', 'pk')
+    term = request.GET.get('q', '').strip()
+    warehouse = request.GET.get('warehouse', '')
+    page = request.GET.get('page', '')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+
+    if term:
+        products = products.filter(name__istartswith=term)
+
+    if warehouse.isdigit():
+        products = products.filter(warehouses=warehouse)
+
+    start = (page - 1) * PRODUCT_LOOKUP_PAGE_SIZE
+    rows = list(products.values_list('pk', 'name', 'unit')[start:start + PRODUCT_LOOKUP_PAGE_SIZE + 1])
+
+    return JsonResponse({
+        'results': [{'id': pk, 'text': u"{} ({})".format(name, Unit.objects.get_cached(unit_id).slug)}
+                    for pk, name, unit_id in rows[:PRODUCT_LOOKUP_PAGE_SIZE]],
+        'more': len(rows) > PRODUCT_LOOKUP_PAGE_SIZE,
     })
 
 
 @staff_member_required
 def monthly_review(request):
+    reviews = ProductsProcessing.objects.reviews()
+
     return render(request, "warehouse/productsprocessing/review/review.html", {
-        'reviews': [{'date': "{}-{}-01".format(review[0], str(review[1]).zfill(2)), 'text': "{}/{}".format(review[0], str(review[1]).zfill(2))} for review in ProductsProcessing.objects.reviews()],
+        'reviews': [{'date': "{}-{}-01".format(review[0], str(review[1]).zfill(2)), 'text': "{}/{}".format(review[0], str(review[1]).zfill(2))} for review in reviews],
+        'years': sorted(set([review[0] for review in reviews])),
         'opts': {
             'app_label': 'warehouse',
             'app_config': {
@@ -82,6 +192,61 @@ def monthly_review(request):
         }
     });
 
+
+@staff_member_required
+@replica_view
+def inventory_valuation(request):
+    form = ValuationForm(request.GET or None)
+    month = form.cleaned_data['month'] if form.is_valid() else None
+
+    return render(request, "warehouse/valuation.html", {
+        'form': form,
+        'month': month,
+        'report': valuation_report(month.year, month.month) if month else valuation_report(),
+        'opts': {
+            'app_label': 'warehouse',
+            'app_config': {
+                'verbose_name': 'Warehouse'
+            }
+        }
+    })
+
+
+@staff_member_required
+def sql_profile(request):
+    return render(request, "warehouse/profiling.html", {
+        'endpoints': worst_endpoints(),
+        'opts': {
+            'app_label': 'warehouse',
+            'app_config': {
+                'verbose_name': 'Warehouse'
+            }
+        }
+    })
+
+
+@staff_member_required
+def reviews_archive(request, year):
+    periods = [review for review in ProductsProcessing.objects.reviews() if review[0] == int(year)]
+
+    if not periods:
+        return _redirect_to_with_error(request, 'warehouse_productsprocessing_review', None,
+                                       "There are no reviews for the specified year.")
+
+    # Archives are built by the export_reviews command, the request only streams a stored one
+    archive = open_reviews_archive(int(year))
+
+    if archive is None:
+        return _redirect_to_with_success(request, 'warehouse_productsprocessing_review', None,
+                                         "The archive of {} is being prepared. Download it again in a few minutes."
+                                         .format(year))
+
+    response = StreamingHttpResponse(FileWrapper(archive), content_type="application/zip")
+    response['Content-Disposition'] = "attachment; filename=reviews-{}.zip".format(year)
+
+    return response
+
+
 class MonthlyReviewPDF(PDFTemplateView):
     filename = "review.pdf"
     template_name = "warehouse/productsprocessing/review/pdf/review.html"
@@ -98,6 +263,9 @@ class MonthlyReviewPDF(PDFTemplateView):
             month = selected_date.month
             year = selected_date.year
 
+            if request.GET.get('as', '') != 'html':
+                return PDFResponse(get_review(year, month), filename=self.get_filename())
+
             processings = ProductsProcessing.objects.review_for_month(year=year, month=month)
             
             kwargs['processings'] = processings